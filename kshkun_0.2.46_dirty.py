@@ -1,7 +1,6 @@
 import asyncio, json, random, os, base64
 from datetime import datetime, timedelta, timezone
 
-from google import genai
 from google.genai.types import SafetySetting, HarmCategory, HarmBlockThreshold, Content, GenerateContentConfig, Part
 
 from pyrogram import Client, idle
@@ -20,30 +19,39 @@ from pyrogram.raw.types import UpdateMessagePollVote
 from io import BytesIO
 
 from kshkun_modules.react_checker import ReactChecker
+from kshkun_modules.mobyk_ingest import ingestChannel
 from kshkun_modules.handlers import (
     KshkunLogger,
+    Levels,
     DatabaseHandler,
     NetworkHandler,
     KeyboardHandler,
     SimpleDataHandler,
     PredatorHandler,
-    DuzhocoinHandler as dcoinhandler,
+    DuzhocoinHandler,
     KshkunGenaiFilesHandler,
     MenstruationHandler,
+    MembershipHandler,
+    CommandRouter,
+    CommandStage,
+    KshkunCommand,
+    WorkerPool,
+    WorkerStatus,
+    KshkunGeminiClient,
+    GeminiScheduler,
+    GeminiPriority,
+    GeminiQuotaExceeded,
+    LlmResponseCache,
+    PromptTemplates,
     HelperFuncs
 )
 from kshkun_types.quiz import Quiz
 
 
 async def getResponseFromGemini(model: str, contents: list, config: GenerateContentConfig):
-    client = genai.Client(api_key=SERVICES_API.get("gemini_api_key", ""),)
     response = None
     try:
-        response = await client.aio.models.generate_content(
-            model=model,
-            contents=contents,
-            config=config
-        )
+        response = await GEMINI_CLIENT.generateContent(model=model, contents=contents, config=config)
     except Exception as e:
         await klog.err(f"Failed to get response from Gemini: {e}")
 
@@ -66,6 +74,9 @@ async def generateImage(prompt_text: str = "", media_ids: dict = None, unique_me
         if not response:
             raise Exception("Request Gemini result is None")
 
+        if response == GEMINI_OVERLOADED_REPLY:
+            return response, "text"
+
         if not response.candidates:
             reason = "No candidates returned."
             if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
@@ -194,11 +205,16 @@ klog = KshkunLogger()
 sdh = SimpleDataHandler()
 dbh = DatabaseHandler()
 gfh = None
+GEMINI_CLIENT = None
 nh = NetworkHandler()
 mh = MenstruationHandler()
 kh = KeyboardHandler()
 ph = PredatorHandler()
 hf = HelperFuncs()
+dch = DuzhocoinHandler()
+mbh = MembershipHandler()
+llmc = LlmResponseCache()
+pt = PromptTemplates()
 
 class KshkunGeminiModels:
     FLASH_LITE = "gemini-2.0-flash-lite"
@@ -206,17 +222,42 @@ class KshkunGeminiModels:
     THINKING = "gemini-2.0-flash-thinking-exp-01-21"
     IMAGE_GEN = "gemini-2.0-flash-exp-image-generation"
 
+# requests/tokens per minute, EXTRA.gemini_limits overrides these per model
+GEMINI_LIMITS = {
+    KshkunGeminiModels.FLASH_LITE: {"rpm": 30, "tpm": 1000000},
+    KshkunGeminiModels.FLASH: {"rpm": 15, "tpm": 1000000},
+    KshkunGeminiModels.THINKING: {"rpm": 10, "tpm": 4000000},
+    KshkunGeminiModels.IMAGE_GEN: {"rpm": 10, "tpm": 200000},
+}
+# what requestGemini returns when the scheduler gives up on a request, text and image requests alike
+GEMINI_OVERLOADED_REPLY = "кшкун зараз перевантажений, спробуй трохи пізніше."
+
+# seconds a cached gemini answer is reused per command, EXTRA.llm_cache_ttls overrides these
+LLM_CACHE_TTLS = {
+    'scan': 7 * 24 * 3600,
+    'audio_transcript': 30 * 24 * 3600,
+    'fact_check': 6 * 3600, # same lifetime as the search results it is built from
+}
+
+# values each constructSysPrompt call site passes per template, checked against the template placeholders at startup.
+# custom_sys_prompt is filled for every call that passes uid
+PROMPT_TEMPLATE_VALUES = {
+    'scan_img_sys_prompt.txt': {'custom_sys_prompt', 'full_name', 'media_types'},
+    'google_search_sys_prompt.txt': {'custom_sys_prompt', 'full_name', 'google_results', 'crawled_content'},
+    'quizzes_sys_prompt.txt': {'quizzes_amount'},
+    'dialog_sys_prompt.txt': {'sender_custom_prompt', 'user_in_reply_custom_prompt', 'prompt'},
+    'tarot_sys_prompt.txt': {'custom_sys_prompt', 'full_name', 'prompt', 'chosen_tarot_cards'},
+    'karakal.txt': {'custom_sys_prompt', 'text_lower'},
+    'audio_transcript.txt': set(),
+    'think.txt': {'custom_sys_prompt'},
+    'check_fact.txt': {'custom_sys_prompt', 'full_name', 'google_results', 'crawled_content'},
+    'shluhobot_base_prompt.txt': set(),
+}
+
 class QuizHandler:
     def __init__(self):
         pass
 
-class KshkunCommand:
-    def __init__(self, keywords, func, args, condition):
-        self.keywords = keywords
-        self.func = func
-        self.args = args
-        self.condition = condition
-
 class Kshkun:
     def __init__(self, app: Client, kshkun_username: str, base_sys_prompt: str):
         pass
@@ -224,6 +265,7 @@ class Kshkun:
 KSHKUN_CREDENTIALS = {}
 SERVICES_API = {}
 ACCOUNT_IDS = {}
+COMMAND_ROUTER = None
 
 app = None
 checker_app = None
@@ -234,9 +276,7 @@ MOBYK_CHANNEL_USERNAME = ""
 BASE_SYS_PROMPT = ""
 BASE_CUSTOM_SYS_PROMPT = ""
 
-REQUESTS_LAST_TIMESTAMP = datetime.now().replace(second=0, microsecond=0)
-REQUESTS_THIS_MINUTE = 0
-TOKENS_THIS_MINUTE = 0
+GEMINI_SCHEDULER = None
 
 WHITELIST = []
 PENDING_GEN_UIDS = []
@@ -254,6 +294,9 @@ MOBYK_QUEUE = asyncio.Queue()
 MAGAHAT_PENDING = []
 MAGAHAT_WORKER_TASK = None
 MAGAHAT_QUEUE = asyncio.Queue()
+MAGAHAT_POOL = None
+MOBYK_POOL = None
+MOBYK_INGEST_TASK = None
 
 POLLS_DATA = {}
 PENDING_DUZHOCOINS_SEND_FOR_CHANNELS = {}
@@ -282,7 +325,8 @@ async def loadGlobals():
     global KSHKUN_USERNAME
     global MOBYK_CHANNEL_USERNAME
     global app, checker_app
-    global gfh
+    global gfh, GEMINI_CLIENT, GEMINI_SCHEDULER
+    global MAGAHAT_POOL, MOBYK_POOL
 
     BASE_SYS_PROMPT = await sdh.handleData('base_sys_prompt.txt')
     TRIGGER_GIFS = await sdh.handleData('gifs.json')
@@ -306,6 +350,9 @@ async def loadGlobals():
 
     KSHKUN_USERNAME = EXTRA.get("kshkun_username", "")
     MOBYK_CHANNEL_USERNAME = EXTRA.get("mobyk_channel_username", "")
+    KshkunLogger.configure(level=EXTRA.get("log_level"), log_file=EXTRA.get("log_file"))
+    MOBYK_POOL = WorkerPool('mobyk', ['python3', '-m', 'kshkun_modules.mobyk', '--serve'], size=EXTRA.get("mobyk_pool_size", 1), idle_timeout=300)
+    MAGAHAT_POOL = WorkerPool('magahat', ['python3', '-m', 'kshkun_modules.face_detect', '--serve'], size=EXTRA.get("magahat_pool_size", 1), idle_timeout=300)
 
     app = Client(
         name="kshkun", 
@@ -327,31 +374,33 @@ async def loadGlobals():
         admin=ACCOUNT_IDS.get("DUZHO", 0), 
         kshkunInstance=app
     )
-    gfh = KshkunGenaiFilesHandler(kshkunBotToken=KSHKUN_CREDENTIALS.get('token'), geminiApiKey=SERVICES_API.get("gemini_api_key"))
+    GEMINI_CLIENT = KshkunGeminiClient(
+        apiKey=SERVICES_API.get("gemini_api_key", ""),
+        maxConnections=EXTRA.get("gemini_max_connections", 20),
+        maxKeepalive=EXTRA.get("gemini_max_keepalive", 10),
+    )
+    LLM_CACHE_TTLS.update(EXTRA.get("llm_cache_ttls", {}))
+    llmc.maxEntries = EXTRA.get("llm_cache_max_entries", llmc.maxEntries)
+    GEMINI_SCHEDULER = GeminiScheduler(
+        limits={**GEMINI_LIMITS, **EXTRA.get("gemini_limits", {})},
+        maxQueue=EXTRA.get("gemini_max_queue", 32),
+    )
+    gfh = KshkunGenaiFilesHandler(kshkunBotToken=KSHKUN_CREDENTIALS.get('token'), geminiClient=GEMINI_CLIENT, maxConcurrentUploads=EXTRA.get("gemini_upload_concurrency", 4))
     await klog.log('Loaded global variables')
 
 async def constructSysPrompt(**kwargs):
-    template_filename = kwargs.get('template_filename')
-    template = await sdh.handleData(template_filename)
-    if template is None:
+    template_filename = kwargs.pop('template_filename', None)
+    uid = kwargs.pop('uid', None)
+    template, err = await pt.get(template_filename)
+    if err != None or template is None:
         await klog.err(f"COULD NOT LOAD TEMPLATE FROM FILE {template_filename}")
         return None
-    
-    uid = kwargs.get('uid')
-    if uid:
-        custom_sys_prompt = await getCustomSysPrompt(uid)
-        template = template.replace('{custom_sys_prompt}', custom_sys_prompt)
 
-    try:
-        if uid:
-            del kwargs['uid']
-        if template_filename:
-            del kwargs['template_filename']
-
-        for key, value in kwargs.items():
-            template = template.replace('{' + key + '}', f'{value}')
+    if uid and 'custom_sys_prompt' in template.placeholders:
+        kwargs['custom_sys_prompt'] = await getCustomSysPrompt(uid) or ''
 
-        return template
+    try:
+        return await pt.render(template, kwargs)
 
     except Exception as e:
         await klog.err(f"TEMPLATE FORMATTING ERROR: {e}")
@@ -377,24 +426,18 @@ async def requestGemini(
         response_mime_type="text/plain",
         response_schema=None,
         model_name=KshkunGeminiModels.FLASH,
-        response_modalities=["text"]
+        response_modalities=["text"],
+        priority=GeminiPriority.INTERACTIVE,
+        cache_ttl=None
         ):
     
-    global REQUESTS_THIS_MINUTE, REQUESTS_LAST_TIMESTAMP, TOKENS_THIS_MINUTE
-    if datetime.now() > REQUESTS_LAST_TIMESTAMP + timedelta(minutes=1):
-        REQUESTS_THIS_MINUTE = 0
-        TOKENS_THIS_MINUTE = 0
-        REQUESTS_LAST_TIMESTAMP = datetime.now().replace(second=0, microsecond=0)
-        await klog.log(f'Gemini Requests reset')
-
-    REQUESTS_THIS_MINUTE += 1
-    debug = True
+    debug = klog.isEnabledFor(Levels.DEBUG)
     if media_ids == None:
         media_ids = {'photos': [], 'animations': [], 'stickers': {'static': [], 'video': []}, 'audio': []}
 
     if debug:
-        await klog.log(f"SYS: {sys_prompt[:45]}")
-        await klog.log(f"USER: {prompt[:45]}")
+        await klog.debug(f"SYS: {sys_prompt[:45]}")
+        await klog.debug(f"USER: {prompt[:45]}")
 
     categories = [
         HarmCategory.HARM_CATEGORY_HATE_SPEECH,
@@ -421,6 +464,17 @@ async def requestGemini(
             response_mime_type=response_mime_type,
             response_schema=response_schema,
         )
+    # text answers of cache-enabled commands are reused for identical requests, media is keyed by file_unique_id
+    cache_key = None
+    if cache_ttl and not is_img_gen:
+        file_ids = media_ids.get('photos', []) + media_ids.get('animations', []) + media_ids.get('audio', []) + media_ids.get('stickers', {}).get('static', []) + media_ids.get('stickers', {}).get('video', [])
+        cache_key = llmc.makeKey(model_name, sys_prompt, prompt, [(unique_media_ids or {}).get(file_id, file_id) for file_id in file_ids], config.model_dump(mode='json', exclude_none=True))
+        cached_response, err = await llmc.load(cache_key)
+        if cached_response is not None:
+            if debug:
+                await klog.debug(f"KSHKUN (LLM CACHE HIT {cache_key[:12]}): {cached_response[:45]}")
+            return cached_response
+
     try:
         if media_ids:
             all_uploaded_files = await gfh.uploadAllMediaToGemini(media_ids, unique_media_ids)
@@ -433,25 +487,34 @@ async def requestGemini(
         image_parts = [Part.from_uri(file_uri=file.uri, mime_type=file.mime_type) for file in all_uploaded_files]
         contents = [Content(role="user", parts=[Part.from_text(text=prompt)])]
         input_data = image_parts + contents
+
+        estimated_tokens = GeminiScheduler.estimateTokens(sys_prompt, prompt, files=len(all_uploaded_files))
+        await GEMINI_SCHEDULER.acquire(model_name, estimated_tokens, priority)
         response = await getResponseFromGemini(model=model_name, contents=input_data, config=config)
+        usage = response and response.usage_metadata
+        GEMINI_SCHEDULER.settle(model_name, estimated_tokens, usage and usage.total_token_count)
         if is_img_gen:
-            TOKENS_THIS_MINUTE += response.usage_metadata.total_token_count
             return response
         try: 
             response_text = response.text.strip()
-            TOKENS_THIS_MINUTE += response.usage_metadata.total_token_count
         except:
             await klog.err(f"GET RESPONSE FROM GEMINI ERROR: {response}")
             raise Exception('gemini failed')
 
         if debug:
             if all_uploaded_files:
-                await klog.log(f"UPLOADED FILES: {all_uploaded_files}")
-            await klog.log(f'KSHKUN: {response_text[:45]}')
-            await klog.log(f"In/Out/Total: {response.usage_metadata.prompt_token_count}/{response.usage_metadata.candidates_token_count}/{response.usage_metadata.total_token_count}, Tokens/Requests/min: {TOKENS_THIS_MINUTE}/{REQUESTS_THIS_MINUTE}")
+                await klog.debug(f"UPLOADED FILES: {all_uploaded_files}")
+            await klog.debug(f'KSHKUN: {response_text[:45]}')
+            await klog.debug(f"In/Out/Total: {response.usage_metadata.prompt_token_count}/{response.usage_metadata.candidates_token_count}/{response.usage_metadata.total_token_count}, quota: {GEMINI_SCHEDULER.stats(model_name)}")
 
+        if cache_key and response_text:
+            await llmc.save(cache_key, model_name, response_text, cache_ttl)
         return response_text
 
+    except GeminiQuotaExceeded as e:
+        await klog.warn(f"GEMINI QUOTA EXCEEDED: {e}")
+        return GEMINI_OVERLOADED_REPLY
+
     except Exception as e:
         await klog.err(f"GEMINI_REQUEST ERROR: {e}")
         return "помилочка."
@@ -554,7 +617,7 @@ async def sendKshk(cli: Client, chat_id: int, msg_id: int=None):
     return await function(chat_id, media_id, reply_to_message_id=msg_id)
 
 
-async def handleNnknhtChat(cli: Client, msg: Message, uid: int, u_verified: bool, text_lower: str, verified_uids: list):
+async def handleNnknhtChat(cli: Client, msg: Message, uid: int, u_verified: bool, text_lower: str):
     has_link = await hf.checkLink(msg)
     if not u_verified and has_link:
         if msg.from_user:
@@ -572,8 +635,7 @@ async def handleNnknhtChat(cli: Client, msg: Message, uid: int, u_verified: bool
 
     elif uid in PENDING_VERIFICATION_CHANNEL_IDS:
         if text_lower.strip() == 'крим україна':
-            verified_uids.append(uid)
-            await sdh.handleData('verified_users.json', verified_uids)
+            await mbh.verified.add(uid)
             await msg.reply('✅ ми успішно підтвердили, що ви не маскалик')
         else:
             await msg.reply("⛔ мут бан 2000 днів, пака пака. Апеляція на розбан: @nnknht_bot")
@@ -690,7 +752,7 @@ async def scanImgGifSticker(cli: Client, msg: Message, uid: int, full_name: str,
     prompt = (text_lower or "").replace("кшкун скан", "").strip()
     sys_prompt = await constructSysPrompt(uid=uid, template_filename='scan_img_sys_prompt.txt', full_name=full_name, media_types=media_types)
 
-    await msg.reply(await requestGemini(sys_prompt=sys_prompt, prompt=prompt, media_ids=media_ids, unique_media_ids=unique_media_ids))
+    await msg.reply(await requestGemini(sys_prompt=sys_prompt, prompt=prompt, media_ids=media_ids, unique_media_ids=unique_media_ids, cache_ttl=LLM_CACHE_TTLS['scan']))
 
 
 async def searchGoogle(cli: Client, msg: Message, uid: int, full_name: str, text_lower: str):
@@ -698,7 +760,7 @@ async def searchGoogle(cli: Client, msg: Message, uid: int, full_name: str, text
     if not query:
         return await replyTempMsg(cli, msg, "ну і що шукати")
     
-    google_results, crawled_content, err = await nh.getSearchResults(query=query)
+    google_results, crawled_content, err = await nh.getSearchResults(query=query, api_key=SERVICES_API.get('google_api_key', ''), cse_id=SERVICES_API.get('google_cse_id', ''))
     if err != None:
         await klog.err(f"SEARCH_GOOGLE ERROR: {err}")
         return await replyTempMsg(cli, msg, "ой.. сталася якась помилочка")
@@ -828,75 +890,84 @@ async def resetCustomPrompt(cli: Client, msg: Message, uid: int):
     await replyTempMsg(cli, msg, 'промпт змінено на дефолтний' if data_saved == None else data_saved)
 
 
+async def runMobykConsumer():
+    while True:
+        try:
+            task = await asyncio.wait_for(MOBYK_QUEUE.get(), timeout=300)
+        except asyncio.TimeoutError:
+            return
+
+        future = task['future']
+        try:
+            mode = task.get('mode', EXTRA.get("mobyk_search_mode", "auto"))
+            nprobe = EXTRA.get("mobyk_nprobe", 8)
+            status, payload = await MOBYK_POOL.request([task['file_data'], mode.encode(), str(nprobe).encode()])
+            if status == WorkerStatus.ERR:
+                raise Exception(f"Subprocess error: {payload.decode(errors='replace')}")
+
+            result_json = json.loads(payload.decode('utf-8'))
+            if "error" in result_json:
+                future.set_exception(Exception(result_json["error"]))
+            elif "matches" in result_json:
+                future.set_result(result_json["matches"])
+            else:
+                future.set_exception(Exception("Unexpected subprocess output format"))
+        except Exception as worker_err:
+            await klog.err(f"MOBYK WORKER ERROR: {worker_err}")
+            if not future.done():
+                future.set_exception(worker_err)
+        finally:
+            MOBYK_QUEUE.task_done()
+
+
 async def MobykWorker():
     global MOBYK_WORKER_TASK
-    global MOBYK_QUEUE
     try:
-        while True:
-            try:
-                task = await asyncio.wait_for(MOBYK_QUEUE.get(), timeout=300)
-            except asyncio.TimeoutError:
-                break
-            file_data = task['file_data']
-            future = task['future']
-            try:
-                proc = await asyncio.create_subprocess_exec(
-                    'python3', 'kshkun_modules/mobyk.py',
-                    stdin=asyncio.subprocess.PIPE,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                await klog.log(f"Mobyk worker invoked. PID: {proc.pid}")
-                result_bytes, stderr = await proc.communicate(input=file_data)
-                if stderr:
-                    err_msg = stderr.decode()
-                    await klog.err(f"MOBYK SUBPROCESS STDERR: {err_msg}")
-                    future.set_exception(Exception(f"Subprocess error: {err_msg}"))
-                else:
-                    result_str = result_bytes.decode('utf-8')
-                    try:
-                        result_json = json.loads(result_str)
-                        if "error" in result_json:
-                            future.set_exception(Exception(result_json["error"]))
-                        elif "matches" in result_json:
-                            future.set_result(result_json["matches"])
-                        else:
-                            future.set_exception(Exception("Unexpected subprocess output format"))
-                    except Exception as e:
-                        await klog.err(f"MOBYK WORKER ERROR: {e}, output: {result_str}")
-                        future.set_exception(e)
-            except Exception as worker_err:
-                future.set_exception(worker_err)
-                await klog.err(f"MOBYK WORKER ERROR: {worker_err}")
-            finally:
-                MOBYK_QUEUE.task_done()
+        await asyncio.gather(*(runMobykConsumer() for _ in range(MOBYK_POOL.size)))
     finally:
         await klog.log("Stopping MobykWorker due to empty queue timeout")
         MOBYK_WORKER_TASK = None
 
 
+async def runMagaHatConsumer():
+    while True:
+        try:
+            tasks = [await asyncio.wait_for(MAGAHAT_QUEUE.get(), timeout=300)]
+        except asyncio.TimeoutError:
+            return
+
+        # whatever queued up meanwhile goes to the worker in the same request
+        while len(tasks) < EXTRA.get("magahat_batch_size", 4) and not MAGAHAT_QUEUE.empty():
+            tasks.append(MAGAHAT_QUEUE.get_nowait())
+
+        try:
+            reply = await MAGAHAT_POOL.request([task['file_data'] for task in tasks])
+            if len(reply) != 2 * len(tasks):
+                raise Exception(reply[-1].decode(errors='replace') if reply and reply[0] == WorkerStatus.ERR else 'BAD REPLY FROM WORKER')
+
+            for task, status, payload in zip(tasks, reply[::2], reply[1::2]):
+                if task['future'].done():
+                    continue
+                if status == WorkerStatus.ERR:
+                    await klog.err(f"MAGAHAT WORKER ERROR: {payload.decode(errors='replace')}")
+                    task['future'].set_exception(Exception(payload.decode(errors='replace')))
+                else:
+                    task['future'].set_result(None if status == WorkerStatus.EMPTY else payload)
+        except Exception as e:
+            await klog.err(f"MAGAHAT WORKER ERROR: {e}")
+            for task in tasks:
+                if not task['future'].done():
+                    task['future'].set_exception(e)
+        finally:
+            for _ in tasks:
+                MAGAHAT_QUEUE.task_done()
+
+
 async def MagaHatWorker():
     global MAGAHAT_WORKER_TASK
-    global MAGAHAT_QUEUE
     try:
-        while True:
-            try:
-                task = await asyncio.wait_for(MAGAHAT_QUEUE.get(), timeout=300)
-            except asyncio.TimeoutError:
-                break
-
-            file_data = task['file_data']
-            future = task['future']
-            proc = await asyncio.create_subprocess_exec(
-                'python3', 'kshkun_modules/face_detect.py',
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await klog.log(f"Magahat worker invoked. PID: {proc.pid}")
-            result, _ = await proc.communicate(input=file_data)
-            future.set_result(result)
-            MAGAHAT_QUEUE.task_done()
+        # one consumer per pool slot, the detector processes themselves stay warm in MAGAHAT_POOL
+        await asyncio.gather(*(runMagaHatConsumer() for _ in range(MAGAHAT_POOL.size)))
     finally:
         await klog.log("Stopping Magahat worker due to empty queue timeout")
         MAGAHAT_WORKER_TASK = None
@@ -994,7 +1065,7 @@ async def drawMagaHat(cli: Client, msg: Message, uid: int, reply_in_msg: Message
         await MAGAHAT_QUEUE.put({'file_data': file_data, 'future': fut})
         result = await fut
         
-        if result == b'SUBPROCESS_MAGA_HAT: NO_FACES\n':
+        if result is None:
             await replyTempMsg(cli, msg, 'обличчя не знайдено')
         else:
             image = BytesIO(result)
@@ -1023,10 +1094,20 @@ async def replyTempMsg(cli: Client, msg: Message, text: str, time: int = 30, rep
         await klog.err(f"replyTempMsg Error in chat {msg.chat.id}: {e}")
 
 
+async def ingestMobyks(msg: Message):
+    global MOBYK_INGEST_TASK
+    try:
+        added, total = await ingestChannel(checker_app.acc, MOBYK_CHANNEL_USERNAME, workers=EXTRA.get("mobyk_ingest_workers", 2), log=klog.log)
+        await msg.reply(f'додано {added} мобиків, в базі {total}')
+    except Exception as e:
+        await klog.err(f"MOBYK INGEST FAILED: {e}")
+        await msg.reply(f'не вийшло: {e}')
+    finally:
+        MOBYK_INGEST_TASK = None
+
 async def handleAdminCommands(cli: Client, msg: Message, text_lower: str):
-    global ACCEPT_UNI_MEDIA
+    global ACCEPT_UNI_MEDIA, MOBYK_INGEST_TASK
     media_data = await sdh.handleData('media_ids.json')
-    banned = await sdh.handleData('banned.json')
     media_id = (msg.photo and msg.photo.file_id) or (msg.animation and msg.animation.file_id) or (msg.video and msg.video.file_id)
     media_type = 'photo' if msg.photo else 'animation' if msg.animation else 'video' if msg.video else None
 
@@ -1044,7 +1125,7 @@ async def handleAdminCommands(cli: Client, msg: Message, text_lower: str):
             await asyncio.sleep(2)
 
     elif text_lower == 'банліст':
-        await msg.reply(banned)
+        await msg.reply(mbh.banned.toList())
 
     elif text_lower.startswith(('розбан', 'бан')):
         ban_id_str = msg.text.replace('розбан' if 'розбан' in text_lower else 'бан', '').strip()
@@ -1052,18 +1133,22 @@ async def handleAdminCommands(cli: Client, msg: Message, text_lower: str):
             return await msg.reply('(роз)бан (ід)')
 
         ban_id = int(ban_id_str)
-        in_ban = ban_id in banned
 
         if 'розбан' in text_lower:
-            if in_ban:
-                banned.remove(ban_id)
-                await sdh.handleData('banned.json', banned)
+            in_ban, _ = await mbh.banned.remove(ban_id)
             await msg.reply('розбанено' if in_ban else f'{ban_id} не забанений')
         else:
-            if not in_ban:
-                banned.append(ban_id)
-                await sdh.handleData('banned.json', banned)
-            await msg.reply('забанено' if not in_ban else f'{ban_id} вже забанений')
+            was_not_in_ban, _ = await mbh.banned.add(ban_id)
+            await msg.reply('забанено' if was_not_in_ban else f'{ban_id} вже забанений')
+
+    elif text_lower == 'мережа':
+        await msg.reply(f'{nh.getConnectionStats()}')
+
+    elif text_lower == 'мобики':
+        if MOBYK_INGEST_TASK:
+            return await msg.reply('вже оновлюю')
+        MOBYK_INGEST_TASK = asyncio.create_task(ingestMobyks(msg))
+        await msg.reply('оновлюю мобиків')
 
     elif text_lower.startswith('напиши'):
         number_of_letters_string = text_lower.replace('напиши', '').strip()
@@ -1204,7 +1289,7 @@ async def handleQuiz(cli: Client, msg: Message, chat_id: int, text_lower: str):
 
     prompt = f'{collected_data}'
 
-    response = await requestGemini(sys_prompt=sys_prompt, prompt=prompt, max_output_tokens=2000, response_mime_type="application/json", )
+    response = await requestGemini(sys_prompt=sys_prompt, prompt=prompt, max_output_tokens=2000, response_mime_type="application/json", priority=GeminiPriority.BACKGROUND)
 
     quizzes_list = []
     user_correct_answers = {}
@@ -1294,17 +1379,10 @@ async def handleQuiz(cli: Client, msg: Message, chat_id: int, text_lower: str):
         if participants_amount < minimum_participants_amount:
             result_message += f"\nмінімальна кількість учасників для отримання дужокоїнів: {minimum_participants_amount}"
         else:
-            for winner_id in winners:
-                winner, err = await dbh.loadInitializeOrUpdateUser(winner_id)
-                if err != None:
-                    await klog.err(f'QUIZ LOADING WINNER {winner_id} ERROR: {err}')
-                    await replyTempMsg(cli, msg, 'помилочка при завантаженні даних переможців')
-
-                winner['duzhocoins'] += win_share
-                _, err = await dbh.saveUserInDb(winner)
-                if err != None:
-                    await klog.err(f'QUIZ SAVING WINNER {winner_id} ERROR: {err}')
-                    await replyTempMsg(cli, msg, 'помилочка при збереженні даних переможців')
+            _, err = await dch.payoutDuzhocoins(winners, win_share, 'quiz win')
+            if err != None:
+                await klog.err(f'QUIZ PAYING OUT WINNERS {winners} ERROR: {err}')
+                await replyTempMsg(cli, msg, 'помилочка при збереженні даних переможців')
 
         result_message += f'\nвсього учасників: {participants_amount}'
         await msg.reply(result_message)
@@ -1320,22 +1398,35 @@ async def handleQuiz(cli: Client, msg: Message, chat_id: int, text_lower: str):
         QUIZZES_QUEUE.remove(chat_id)
 
 
+# the bet is debited before the dice is thrown, every failure after that gives it back
+async def refundCasinoBet(uid: int, bet: int):
+    _, err = await dch.creditDuzhocoins(uid, bet, 'casino refund')
+    if err != None:
+        await klog.err(f'CASINO REFUNDING {bet} TO USER {uid} ERROR: {err}')
+    return err
+
+
 async def handleCasino(cli: Client, msg: Message, uid: int, text_lower: str):
     bet_str = text_lower.replace('кшкун казик', '').strip()
     if not bet_str.isdigit() or int(bet_str) < 1:
         return await replyTempMsg(cli, msg, "ставка повинна бути цілим числом більшим за 0")
 
     bet = int(bet_str)
-    user, err = await dbh.loadInitializeOrUpdateUser(uid)
+    balance, err = await dch.debitDuzhocoins(uid, bet, 'casino bet')
+    if isinstance(err, ValueError):
+        return await replyTempMsg(cli, msg, f'недостатньо дужокоїнів. баланс: {balance} дужокоїн{await hf.getDuzhocoinsEnding(balance)}')
+
     if err != None:
-        await klog.err(f'CASINO LOADING USER {uid} ERROR: {err}')
+        await klog.err(f'CASINO DEBITING USER {uid} ERROR: {err}')
         return await replyTempMsg(cli, msg, 'помилочка при завантаженні датабази')
-    
-    if user['duzhocoins'] < bet:
-        return await replyTempMsg(cli, msg, f'недостатньо дужокоїнів. баланс: {user['duzhocoins']} дужокоїн{await hf.getDuzhocoinsEnding(user['duzhocoins'])}')
 
-    user['duzhocoins'] -= bet
-    dice_message = await cli.send_dice(chat_id=msg.chat.id, emoji="🎰", reply_to_message_id=msg.id)
+    try:
+        dice_message = await cli.send_dice(chat_id=msg.chat.id, emoji="🎰", reply_to_message_id=msg.id)
+    except Exception as e:
+        await klog.err(f'CASINO SEND DICE FOR USER {uid} ERROR: {e}')
+        refund_err = await refundCasinoBet(uid, bet)
+        return await replyTempMsg(cli, msg, 'помилочка, ставку повернуто' if refund_err == None else 'помилочка.')
+
     slots = ''.join([["⬛", "🍇", "🍋", "7️⃣"][(dice_message.dice.value - 1) // (4 ** i) % 4] for i in range(3)]) # i have no clue how this works
     win_slots = {
         "🍇🍇🍇": (3, "три виногради!"),
@@ -1353,7 +1444,13 @@ async def handleCasino(cli: Client, msg: Message, uid: int, text_lower: str):
     )
     win_amount = round(bet * multiplier)
     if win_amount > 0:
-        user['duzhocoins'] += win_amount
+        balance, err = await dch.creditDuzhocoins(uid, win_amount, 'casino win')
+        if err != None:
+            await klog.err(f'CASINO CREDITING USER {uid} ERROR: {err}')
+            await refundCasinoBet(uid, bet)
+            await replyTempMsg(cli, msg, 'помилочка при збереженні даних в датабазі')
+            return await cli.delete_messages(dice_message.chat.id, dice_message.id)
+
         win_or_loss = f'виграш: {win_amount} дужокоїн{await hf.getDuzhocoinsEnding(win_amount)} (х{multiplier})!'
     else:
         win_or_loss = f'програш: {bet} дужокоїн{await hf.getDuzhocoinsEnding(bet)}.'
@@ -1363,15 +1460,7 @@ async def handleCasino(cli: Client, msg: Message, uid: int, text_lower: str):
             win_or_loss += f'\n{text}'
             break
 
-    balance = user['duzhocoins']
     final_message = result + ' ' + win_or_loss + '\n' + f'баланс: {balance} дужокоїн{await hf.getDuzhocoinsEnding(balance)}'
-
-    result, err = await dbh.saveUserInDb(user)
-    if err != None:
-        await klog.err(f'CASINO SAVING USER {uid} ERROR: {err}')
-        await replyTempMsg(cli, msg, 'помилочка при збереженні даних в датабазі')
-        return await cli.delete_messages(dice_message.chat.id, dice_message.id)
-    
     await asyncio.sleep(4)
     await replyTempMsg(cli, msg, final_message, 12)
     await cli.delete_messages(dice_message.chat.id, dice_message.id)
@@ -1395,12 +1484,11 @@ async def handleDuzhocoinTransfer(cli: Client, msg: Message, uid: int, reply_in_
         return await replyTempMsg(cli, msg, "сума повинна бути цілим числом більшим за 0")
 
     amount = int(amount_str)
-    sender, err = await dbh.loadInitializeOrUpdateUser(uid)
+    sender_balance, err = await dch.getBalance(uid)
     if err != None:
-        await klog.err(f'DUZHOCOIN TRANSFER LOADING SENDER {uid} ERROR: {err}')
+        await klog.err(f'DUZHOCOIN TRANSFER LOADING SENDER {uid} BALANCE ERROR: {err}')
         return await replyTempMsg(cli, msg, 'сталася помилочка під час завантаження датабази')
 
-    sender_balance = sender["duzhocoins"]
     sender_balance_ending = await hf.getDuzhocoinsEnding(sender_balance)
     amount_ending = await hf.getDuzhocoinsEnding(amount)
     if sender_balance < amount:
@@ -1451,7 +1539,7 @@ async def confirmChannelDuzhocoinsTransfer(cli: Client, msg: Message, uid: int):
     sender_id = int(data[1])
     reciever_id = int(data[2])
     amount = int(data[3])
-    error_text, err = await dcoinhandler.transferDuzhocoins(sender_id, reciever_id, amount)
+    error_text, err = await dch.transferDuzhocoins(sender_id, reciever_id, amount)
     if err != None:
         await klog.err(f'CHANNEL DUZHOCOINS TRANSFER CONFIRMATION ERROR: {err}')
         return await replyTempMsg(cli, msg, error_text)
@@ -1465,15 +1553,13 @@ async def addRusosvyn(cli: Client, msg: Message, reply_in_msg: Message):
         return await replyTempMsg(cli, msg, 'потрібна відповідь на повідомлення русосвині')
     
     rusosvyn_id = await hf.extractUid(reply_in_msg)
-    rusosvyni = await sdh.handleData('rusosvyni.json')
-    if rusosvyn_id in rusosvyni:
-        rusosvyni.remove(rusosvyn_id)
+    if rusosvyn_id in mbh.rusosvyni:
+        await mbh.rusosvyni.remove(rusosvyn_id)
         added_or_removed = 'видалено'
     else:
-        rusosvyni.append(rusosvyn_id)
+        await mbh.rusosvyni.add(rusosvyn_id)
         added_or_removed = 'додано'
 
-    await sdh.handleData('rusosvyni.json', rusosvyni)
     await replyTempMsg(cli, msg, f'{added_or_removed} русосвин {rusosvyn_id}')
 
 
@@ -1502,7 +1588,7 @@ async def generateConvo(cli: Client, msg: Message, uid: int, text_lower: str):
     user_in_reply_custom_prompt = user_in_reply.get('custom_system_prompt') or BASE_SYS_PROMPT
 
     prompt = text_lower.replace('кшкун розмова ', '').strip()
-    sys_prompt = await constructSysPrompt(template_filename='dialog_sys_prompt.txt', sender_custom_prompt=sender_custom_prompt, user_in_reply_custom_prompt=user_in_reply_custom_prompt)
+    sys_prompt = await constructSysPrompt(template_filename='dialog_sys_prompt.txt', sender_custom_prompt=sender_custom_prompt, user_in_reply_custom_prompt=user_in_reply_custom_prompt, prompt=prompt)
 
     response = await requestGemini(sys_prompt=sys_prompt, prompt=prompt, max_output_tokens=2000)
     await msg.reply(response)
@@ -1598,9 +1684,9 @@ async def getPersonality(cli: Client, msg: Message, chat_id: int, reply_in_msg:
 
 
 async def handlePollVotes(cli: Client, update, users, chats):
-    debug = True
+    debug = klog.isEnabledFor(Levels.DEBUG)
     if debug:
-        await klog.log(f'CLIENT: {cli}\n\nUPDATE: {update}\n\nUSERS: {users}\n\nCHATS: {chats}')
+        await klog.debug(f'CLIENT: {cli}\n\nUPDATE: {update}\n\nUSERS: {users}\n\nCHATS: {chats}')
 
     poll_id = update.poll_id
     if not poll_id in POLLS_DATA:
@@ -1629,10 +1715,10 @@ async def handlePollVotes(cli: Client, update, users, chats):
     if selected_option == correct_answer:
         quiz.uids_answered_correctly.append(uid)
         if debug:
-            await klog.log(f"{full_name} answered correctly in {poll_id}")
+            await klog.debug(f"{full_name} answered correctly in {poll_id}")
     else:
         if debug:
-            await klog.log(f"{full_name} answered incorrectly in {poll_id}")
+            await klog.debug(f"{full_name} answered incorrectly in {poll_id}")
 
 
 async def sendMemeAmounts(cli: Client, msg: Message):
@@ -1676,7 +1762,7 @@ async def createAudioTranscript(cli: Client, msg: Message, reply_in_msg: Message
     
     prompt = text_lower.replace("кшкун музлотекст", "").strip() or '.'
     sys_prompt = await constructSysPrompt(template_filename='audio_transcript.txt')
-    response = await requestGemini(sys_prompt=sys_prompt, prompt=prompt, media_ids=media_ids, unique_media_ids=unique_media_ids)
+    response = await requestGemini(sys_prompt=sys_prompt, prompt=prompt, media_ids=media_ids, unique_media_ids=unique_media_ids, cache_ttl=LLM_CACHE_TTLS['audio_transcript'])
     await msg.reply(response)
 
 
@@ -1802,13 +1888,13 @@ async def checkFact(cli: Client, msg: Message, uid: int, full_name: str, text_lo
     if not query:
         return await replyTempMsg(cli, msg, 'що за питання то')
 
-    google_results, crawled_content, err = await nh.getSearchResults(query=query)
+    google_results, crawled_content, err = await nh.getSearchResults(query=query, api_key=SERVICES_API.get('google_api_key', ''), cse_id=SERVICES_API.get('google_cse_id', ''))
     if err != None or not (google_results or crawled_content):
         google_results = "Failed to get search results. Ignore"
         crawled_content = "Failed to get info from websites. Ignore"
     
     sys_prompt = await constructSysPrompt(template_filename='check_fact.txt', uid=uid, full_name=full_name, google_results=google_results, crawled_content=crawled_content)
-    response = await requestGemini(sys_prompt=sys_prompt, prompt=query, max_output_tokens=3000, model_name=KshkunGeminiModels.THINKING)
+    response = await requestGemini(sys_prompt=sys_prompt, prompt=query, max_output_tokens=3000, model_name=KshkunGeminiModels.THINKING, cache_ttl=LLM_CACHE_TTLS['fact_check'])
     image_id = None
     if response.endswith("<TRUE>"):
         image_id = EXTRA.get("factcheck_img_id_true")
@@ -1913,7 +1999,7 @@ async def sendShluhobotMessage(cli: Client, msg: Message, shluhobot_custom_promp
         media_ids, media_types, unique_media_ids = await processMedia(cli, msg, msg)
         sys_prompt += f" You also see these media in the post: {media_types}"
 
-    response = await requestGemini(sys_prompt, text_lower, model_name=KshkunGeminiModels.FLASH_LITE, unique_media_ids=unique_media_ids, media_ids=media_ids)
+    response = await requestGemini(sys_prompt, text_lower, model_name=KshkunGeminiModels.FLASH_LITE, unique_media_ids=unique_media_ids, media_ids=media_ids, priority=GeminiPriority.BACKGROUND)
     await msg.reply(response)
 
 
@@ -1938,24 +2024,22 @@ async def devushkaTransgenderOlen(cli: Client, msg: Message, text_lower: str):
 async def handleInlineQuery(cli: Client, i_q: InlineQuery):
     await klog.log(f'Inline query by {i_q.from_user.id}')
     uid = await hf.extractUid(i_q)
-    if uid in await sdh.handleData('banned.json'):
+    if uid in mbh.banned:
         return
 
-    msgs = await sdh.handleData('msgs.json')
-    user, err = await dbh.loadInitializeOrUpdateUser(uid)
+    duzhocoins, err = await dch.getBalance(uid)
     if err != None:
-        await klog.err(f'INLINE QUERY LOADING USER {uid} ERROR: {err}')
-        user = {'duzhocoins': 0}
+        await klog.err(f'INLINE QUERY LOADING USER {uid} BALANCE ERROR: {err}')
+        duzhocoins = 0
 
     seed = i_q.query.strip().lower()
-    random_msg = random.choice(msgs)
-    ms = [m for m in msgs if seed and seed in m.lower()][:49]
+    ms = await ph.searchMsgs(seed, limit=49)
+    random_msg = await ph.getRandomMsg()
 
     if seed:
         gen = await ph.generateMsg(seed)
         gen_msg_result = [InQuResArt(title="згенероване", description=gen, input_message_content=InpTxtMsgCont(gen), thumb_url=LINKS.get("generated_chat_bubble"))]
     else:
-        duzhocoins = user['duzhocoins']
         ending = await hf.getDuzhocoinsEnding(duzhocoins)
         duzhocoins_msg = [InQuResArt(title="дужокоїни", description=f'баланс: {duzhocoins}', input_message_content=InpTxtMsgCont(f'у тебе {duzhocoins} дужокоїн{ending}'), thumb_url=LINKS.get("duzhocoin_image"))]
 
@@ -2027,6 +2111,83 @@ async def mobikTest(cli: Client, msg: Message, uid: int, reply_in_msg: Message):
         MOBYK_PENDING.remove(uid)
 
 
+async def showUserData(cli: Client, msg: Message, reply_in_msg: Message):
+    if not reply_in_msg:
+        return await replyTempMsg(cli, msg, 'потрібна відповідь на повідомлення')
+    display_id = await hf.extractUid(reply_in_msg)
+    display_name = await hf.extractFullName(reply_in_msg)
+    return await replyTempMsg(cli, msg, f'айді {display_name}:\n`{display_id}` (натисни щоб скопіювати)')
+
+
+async def sendHelp(cli: Client, msg: Message):
+    return await msg.reply(await sdh.handleData('help_message.txt'))
+
+
+async def sendBalance(cli: Client, msg: Message, uid: int):
+    duzhocoins, err = await dch.getBalance(uid)
+    if err != None:
+        await klog.err(f"BALANCE LOAD ERROR FOR USER {uid}: {err}")
+        return await replyTempMsg(cli, msg, 'сталася помилочка під час завантаження датабази')
+
+    ending = await hf.getDuzhocoinsEnding(duzhocoins)
+    reply_text = f'у тебе {duzhocoins} дужокоїн{ending}' + (f'\n\nбаланс можна подивитися вписавши `{KSHKUN_USERNAME}` (копіюється, вставити і зачекати)' if msg.from_user else '')
+    return await replyTempMsg(cli, msg, reply_text)
+
+
+def buildCommandRouter():
+    trigger_word = 'кшкун'
+    nnknht_chat = INIT_CHAT_IDS.get("NNKNHT_CHAT", 0)
+    rusosvyn_admins = (nnknht_chat, INIT_CHAT_IDS.get("DUZHO_CHAN", 0), ACCOUNT_IDS.get("DUZHO", 0), ACCOUNT_IDS.get("ZEBRA", 0))
+    kw = lambda *keywords: tuple(f'{trigger_word} {keyword}' for keyword in keywords)
+
+    router = CommandRouter()
+    for command in [
+        KshkunCommand('юзердата', kw('юзердата'), showUserData, ('reply_in_msg',), stage=CommandStage.ANYWHERE, exact=True),
+        KshkunCommand('help', ('/help',) + kw('допомога', 'хелп'), sendHelp, stage=CommandStage.ANYWHERE),
+        KshkunCommand('balance', ('/balance',) + kw('баланс'), sendBalance, ('uid',), stage=CommandStage.ANYWHERE),
+        KshkunCommand('send', ('/send',) + kw('сенд'), handleDuzhocoinTransfer, ('uid', 'reply_in_msg', 'full_name', 'text_lower'), stage=CommandStage.GROUP),
+        KshkunCommand('скан', kw('скан'), scanImgGifSticker, ('uid', 'full_name', 'reply_in_msg', 'text_lower')),
+        KshkunCommand('ген', kw('ген'), genImageGemini, ('uid', 'text_lower')),
+        KshkunCommand('редакт', kw('редакт'), redactImageGemini, ('uid', 'text_lower')),
+        KshkunCommand('загугли', kw('загугли'), searchGoogle, ('uid', 'full_name', 'text_lower')),
+        KshkunCommand('погода', kw('погода'), getWeather, ('text_lower',)),
+        KshkunCommand('мапа', kw('мапа'), findAddress, ('text_lower',)),
+        KshkunCommand('русоскот', kw('русоскот'), handleRuLosses),
+        KshkunCommand('ресет промпт', kw('ресет промпт', 'промпт ресет'), resetCustomPrompt, ('uid',)),
+        KshkunCommand('промпт', kw('промпт'), handleCustomPrompts, ('uid', 'reply_in_msg', 'text_lower')),
+        KshkunCommand('магахет', kw('магахет', 'магахат'), drawMagaHat, ('uid', 'reply_in_msg')),
+        KshkunCommand('квиз', kw('квиз', 'квіз', 'каракалквиз'), handleQuiz, ('chat_id', 'text_lower')),
+        KshkunCommand('казик', kw('казик'), handleCasino, ('uid', 'text_lower')),
+        KshkunCommand('таро', kw('таро'), handleTarot, ('uid', 'full_name', 'text_lower')),
+        KshkunCommand('розмова', kw('розмова'), generateConvo, ('uid', 'text_lower')),
+        KshkunCommand('персона', kw('персона'), getPersonality, ('chat_id', 'reply_in_msg', 'text_lower')),
+        KshkunCommand('меми', kw('меми'), sendMemeAmounts, exact=True, chat_ids=(nnknht_chat,)),
+        KshkunCommand('русосвин', kw('русосвин'), addRusosvyn, ('reply_in_msg',), exact=True, uids=rusosvyn_admins),
+        KshkunCommand('каракал', kw('каракал'), createKarakalPost, ('uid', 'text_lower')),
+        KshkunCommand('мобик', kw('мобик'), compareFaces, ('uid', 'reply_in_msg')),
+        KshkunCommand('тестмобик', kw('тестмобик'), mobikTest, ('uid', 'reply_in_msg')),
+        KshkunCommand('музлотекст', kw('музлотекст'), createAudioTranscript, ('reply_in_msg', 'text_lower')),
+        KshkunCommand('подумай', kw('подумай'), think, ('uid', 'text_lower')),
+        KshkunCommand('ютуб', kw('ютуб'), downloadYoutubeVideo, ('uid',)),
+        KshkunCommand('менстра', kw('менстра'), handleMenstra, ('uid', 'text_lower')),
+        KshkunCommand('фактчек', kw('фактчек'), checkFact, ('uid', 'full_name', 'text_lower')),
+        KshkunCommand('шлюхобот', kw('шлюхобот'), handleShluhobot, ('chat_id', 'uid', 'text_lower')),
+        KshkunCommand('(!)', kw('(!)'), devushkaTransgenderOlen, ('text_lower',)),
+    ]:
+        router.register(command)
+
+    # bare "кшкун ..." and replies to kshkun that aren't any other command
+    router.setFallback(KshkunCommand('talk', (trigger_word,), talk, ('uid', 'reply_to_kshkun', 'reply_in_msg', 'full_name', 'text_lower')))
+    return router
+
+
+async def runCommand(cli: Client, msg: Message, command: KshkunCommand, context: dict):
+    cooldown_left = command.cooldownLeft(context['uid'])
+    if cooldown_left:
+        return await replyTempMsg(cli, msg, f'зачекай ще {int(cooldown_left) + 1} с.')
+    return await command.run(cli, msg, context)
+
+
 async def handleMessages(cli: Client, msg: Message):
     chat_id = msg.chat.id
     uid = await hf.extractUid(msg)
@@ -2046,11 +2207,10 @@ async def handleMessages(cli: Client, msg: Message):
         await cli.leave_chat(chat_id)
         return await klog.warn(f"Left chat {chat_name} ({chat_id}) because it's not in the whitelist")
 
-    banned = await sdh.handleData('banned.json')
-    if uid in banned:
+    if uid in mbh.banned:
         return
     
-    if uid in await sdh.handleData('rusosvyni.json'):
+    if uid in mbh.rusosvyni:
         return await handleRusosvyn(cli, msg)
 
     text = msg.text or msg.caption or ''
@@ -2113,28 +2273,23 @@ async def handleMessages(cli: Client, msg: Message):
     has_poll_in_reply = reply_in_msg and reply_in_msg.poll
 
     trigger_word = 'кшкун'
+    reply_to_kshkun = reply_in_msg and reply_in_msg.from_user and reply_in_msg.from_user.id == ACCOUNT_IDS.get("KSHKUN", 0)
 
-    if text_lower == f'{trigger_word} юзердата':
-        if not reply_in_msg:
-            return await replyTempMsg(cli, msg, 'потрібна відповідь на повідомлення')
-        display_id = await hf.extractUid(reply_in_msg)
-        display_name = await hf.extractFullName(reply_in_msg)
-        return await replyTempMsg(cli, msg, f'айді {display_name}:\n`{display_id}` (натисни щоб скопіювати)')
+    command_context = {
+        'uid': uid,
+        'chat_id': chat_id,
+        'msg_id': msg.id,
+        'full_name': full_name,
+        'reply_in_msg': reply_in_msg,
+        'reply_to_kshkun': reply_to_kshkun,
+        'text_lower': text_lower,
+    }
+    command_matches = COMMAND_ROUTER.match(text_lower)
 
-    if text_lower.startswith(('/help', f'/help{KSHKUN_USERNAME}', f'{trigger_word} допомога', f'{trigger_word} хелп')):
-        return await msg.reply(await sdh.handleData('help_message.txt'))
-        
-    elif text_lower.startswith(('/balance', f'/balance{KSHKUN_USERNAME}', f'{trigger_word} баланс')):
-        user, err = await dbh.loadInitializeOrUpdateUser(uid)
-        if err != None:
-            await klog.err(f"BALANCE LOAD ERROR FOR USER {uid}: {err}")
-            return await replyTempMsg(cli, msg, 'сталася помилочка під час завантаження датабази')
+    command = COMMAND_ROUTER.resolve(command_matches, CommandStage.ANYWHERE, text_lower, chat_id, uid, duzho)
+    if command:
+        return await runCommand(cli, msg, command, command_context)
 
-        duzhocoins = user['duzhocoins']
-        ending = await hf.getDuzhocoinsEnding(duzhocoins)
-        reply_text = f'у тебе {duzhocoins} дужокоїн{ending}' + (f'\n\nбаланс можна подивитися вписавши `{KSHKUN_USERNAME}` (копіюється, вставити і зачекати)' if msg.from_user else '')
-        return await replyTempMsg(cli, msg, reply_text)
-    
     if in_private_chat:
         if text_lower == "/lang":
             if msg.from_user and msg.from_user.language_code:
@@ -2143,24 +2298,21 @@ async def handleMessages(cli: Client, msg: Message):
             await handleAdminCommands(cli, msg, text_lower)
         return
 
-    if text_lower.startswith(('/send', f'{trigger_word} сенд')):
-        return await handleDuzhocoinTransfer(cli, msg, uid, reply_in_msg, full_name, text_lower)
-
-    verified_uids = await sdh.handleData('verified_users.json')
+    command = COMMAND_ROUTER.resolve(command_matches, CommandStage.GROUP, text_lower, chat_id, uid, duzho)
+    if command:
+        return await runCommand(cli, msg, command, command_context)
 
     all_txt_lower = (text_lower + full_name).lower()
 
-    u_verified = uid in verified_uids
+    u_verified = uid in mbh.verified
 
     has_ru_symbols = any(l in all_txt_lower for l in ['ы', 'э', 'ъ', 'ё', '🇷🇺'])
     has_ua_bel_letters = any(l in all_txt_lower for l in ['і', 'ў', 'є', 'ґ', 'ї'])
     has_ru_doesnt_have_ua_letters = has_ru_symbols and not has_ua_bel_letters
 
-    reply_to_kshkun = reply_in_msg and reply_in_msg.from_user and reply_in_msg.from_user.id == ACCOUNT_IDS.get("KSHKUN", 0)
     not_forward = not (msg.forward_from or msg.forward_sender_name or msg.forward_from_chat)
 
     nnknht_chat = INIT_CHAT_IDS.get("NNKNHT_CHAT", 0)
-    zebra = ACCOUNT_IDS.get("ZEBRA", 0)
 
     is_reply_to_linked_channel = (
         reply_in_msg
@@ -2170,51 +2322,11 @@ async def handleMessages(cli: Client, msg: Message):
         and reply_in_msg.views
     )
     #basically trying to determine whether a message is a comment or not. is there a way to check in a more straightforward way?
-    common_args = {
-        'uid': uid,
-        'chat_id': chat_id,
-        'msg_id': msg.id,
-        'full_name': full_name,
-        'reply_in_msg': reply_in_msg,
-        'reply_to_kshkun': reply_to_kshkun,
-        'text_lower': text_lower,
-    }
-
-    commands = {
-        ("скан",): (scanImgGifSticker, ['uid', 'full_name', 'reply_in_msg', 'text_lower'], None),
-        ("ген",): (genImageGemini, ['uid', 'text_lower'], None),
-        ("редакт",): (redactImageGemini, ['uid', 'text_lower'], None),
-        ("загугли",): (searchGoogle, ['uid', 'full_name', 'text_lower'], None),
-        ("погода",): (getWeather, ['text_lower'], None),
-        ("мапа",): (findAddress, ['text_lower'], None),
-        ("русоскот",): (handleRuLosses, [], None),
-        ("ресет промпт", "промпт ресет"): (resetCustomPrompt, ['uid'], None),
-        ("промпт",): (handleCustomPrompts, ['uid', 'reply_in_msg', 'text_lower'], None),
-        ("магахет", "магахат"): (drawMagaHat, ['uid', 'reply_in_msg'], None),
-        ("квиз", "квіз", "каракалквиз"): (handleQuiz, ['chat_id', 'text_lower'], None),
-        ("казик",): (handleCasino, ['uid', 'text_lower'], None),
-        ("таро",): (handleTarot, ['uid', 'full_name', 'text_lower'], None),
-        ("розмова",): (generateConvo, ['uid', 'text_lower'], None),
-        ("персона",): (getPersonality, ['chat_id', 'reply_in_msg', 'text_lower'], None),
-        ("меми",): (sendMemeAmounts, [], ((text_lower == f"{trigger_word} меми") and (chat_id == nnknht_chat))),
-        ("русосвин",): (addRusosvyn, ['reply_in_msg'], ((text_lower == f"{trigger_word} русосвин") and (uid in [nnknht_chat, INIT_CHAT_IDS.get("DUZHO_CHAN", 0), duzho, zebra]))),
-        ("каракал",): (createKarakalPost, ['uid', 'text_lower'], None),
-        ("мобик",): (compareFaces, ['uid', 'reply_in_msg'], None),
-        ("тестмобик",): (mobikTest, ['uid', 'reply_in_msg'], None),
-        ("музлотекст",): (createAudioTranscript, ['reply_in_msg', 'text_lower'], None),
-        ("подумай",): (think, ['uid', 'text_lower'], None),
-        ("ютуб",): (downloadYoutubeVideo, ['uid'], None),
-        ("менстра",): (handleMenstra, ['uid', 'text_lower'], None),
-        ("фактчек",): (checkFact, ['uid', 'full_name', 'text_lower'], None),
-        ("шлюхобот",): (handleShluhobot, ['chat_id', 'uid', 'text_lower'], None),
-        ("(!)",): (devushkaTransgenderOlen, ["text_lower"], None),
-        ("",): (talk, ['uid', 'reply_to_kshkun', 'reply_in_msg', 'full_name', 'text_lower'], reply_to_kshkun),
-    }
 
     meows = ["мяу", "няв", "мяв", "мрр"]
 
     if chat_id == nnknht_chat:
-        await handleNnknhtChat(cli, msg, uid, u_verified, text_lower, verified_uids)
+        await handleNnknhtChat(cli, msg, uid, u_verified, text_lower)
 
     if is_reply_to_linked_channel and has_ru_doesnt_have_ua_letters and (chat_id != nnknht_chat or (not u_verified and chat_id == nnknht_chat)):
         await sendRusniaGif(cli, msg, chat_id, uid, u_verified, all_txt_lower)
@@ -2223,13 +2335,8 @@ async def handleMessages(cli: Client, msg: Message):
         if uid in TEMPBAN_UIDS:
             return await checkApology(cli, msg, uid, text_lower)
 
-        for command_keywords_tuple, parts in commands.items():
-            function, args_list, condition = parts
-            for command_keyword in command_keywords_tuple:
-                condition = condition or text_lower.startswith((trigger_word + ' ' + command_keyword).strip())
-                if condition:
-                    args = [cli, msg] + [common_args[arg] for arg in args_list]
-                    return await function(*args)
+        command = COMMAND_ROUTER.resolve(command_matches, CommandStage.TRIGGER, text_lower, chat_id, uid, duzho) or COMMAND_ROUTER.fallback
+        return await runCommand(cli, msg, command, command_context)
 
     elif any(word in text_lower for word in ['петушок', 'петуч', 'петух', 'петушара', 'півень', 'півник', 'русск', '🇷🇺', 'russia', 'славяне']):
         await msg.reply_sticker("CAACAgIAAxkBAAMOZs3NuwdBl2vf2ijXGPt9rsZ73kQAAsYZAAK8knlJsc-8KnWcjoweBA")
@@ -2260,9 +2367,7 @@ async def handleCallbackQuery(cli: Client, c_q: CallbackQuery):
         await cli.edit_message_text(chat_id=chid, message_id=m_id, text="чий крим:", reply_markup=await kh.getVerificationConfirmationKeyboard(1, uid))
 
     elif act == 'ua':
-        verified_uids = await sdh.handleData('verified_users.json')
-        verified_uids.append(uid)
-        await sdh.handleData('verified_users.json', verified_uids)
+        await mbh.verified.add(uid)
         await cli.edit_message_text(chat_id=chid, message_id=m_id, text="✅ ми успішно підтвердили, що ви не маскалик.")
 
     elif act in ['wrong1', 'wrong2']:
@@ -2278,7 +2383,7 @@ async def handleCallbackQuery(cli: Client, c_q: CallbackQuery):
         sender_id = int(query_data[1])
         reciever_id = int(query_data[2])
         amount = int(query_data[3])
-        error_text, err = await dcoinhandler.transferDuzhocoins(sender_id, reciever_id, amount)
+        error_text, err = await dch.transferDuzhocoins(sender_id, reciever_id, amount)
         if err != None:
             await c_q.answer(error_text, show_alert=True)
             await cli.edit_message_text(chat_id=chid, message_id=m_id, text=error_text)
@@ -2332,15 +2437,39 @@ async def registerCheckerAppHandlers():
 
 
 async def startBots():
+    global COMMAND_ROUTER
     await loadGlobals()
+    err = await llmc.ensureTable() # drops expired and over-limit answers before the first request
+    if err != None:
+        await klog.err(f"COULD NOT PREPARE LLM CACHE: {err}")
+    broken_templates = await pt.validate(PROMPT_TEMPLATE_VALUES)
+    if broken_templates:
+        await klog.err(f"PROMPT TEMPLATES WITH UNFILLED PLACEHOLDERS OR LOAD ERRORS: {broken_templates}")
+    COMMAND_ROUTER = buildCommandRouter()
+    dbh.startUserCacheFlusher()
+    gfh.startBufferSweeper()
+    await nh.startSession()
+    await ph.loadCorpus()
+    await ph.loadMarkovModel()
     await registerAppHandlers()
     await registerCheckerAppHandlers()
     await app.start()
     await checker_app.start()
     await idle()
     await klog.log("STOPPING THE BOT...")
+    ingest_task = MOBYK_INGEST_TASK
+    if ingest_task:
+        ingest_task.cancel() # the finished part of the run is still written to the store
+        await asyncio.gather(ingest_task, return_exceptions=True)
     await app.stop()
     await checker_app.stop()
+    await nh.closeSession()
+    await MAGAHAT_POOL.close()
+    await MOBYK_POOL.close()
+    await GEMINI_CLIENT.close()
+    gfh.stopBufferSweeper()
+    await dbh.stopUserCacheFlusher()
+    await dbh.closeConnections()
 
 
 if __name__ == "__main__":
@@ -2350,3 +2479,4 @@ if __name__ == "__main__":
         klog.err(f"ERROR OCCURED WHEN RUNNING BOTS: {e}")
     finally:
         klog.log("STOPPING THE BOT...")
+        klog.flush()
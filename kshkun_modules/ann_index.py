@@ -0,0 +1,147 @@
+import argparse, os, sys, tempfile, time
+import numpy as np
+from kshkun_modules.encoding_store import EncodingStore
+
+def squaredDistances(x, centroids):
+    return (np.einsum('ij,ij->i', x, x)[:, None] - 2 * (x @ centroids.T) + np.einsum('ij,ij->i', centroids, centroids)[None, :])
+
+def assignNearest(x, centroids, batch: int = 65536):
+    labels = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), batch):
+        labels[start:start + batch] = squaredDistances(x[start:start + batch], centroids).argmin(axis=1)
+    return labels
+
+def kmeans(x, k: int, iters: int = 20, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rng.choice(len(x), size=k, replace=len(x) < k)].copy()
+    for _ in range(iters):
+        labels = assignNearest(x, centroids)
+        counts = np.bincount(labels, minlength=k)
+        empty = counts == 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[~empty]
+        sums = np.add.reduceat(x[np.argsort(labels, kind='stable')], starts)
+        centroids[~empty] = sums / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), size=int(empty.sum()))] # restart dead clusters on random points
+    return centroids
+
+# IVF coarse quantizer + product-quantized residuals.
+# rows are positions in the EncodingStore the index was built from; rows appended to the store
+# after the build are scanned exactly, so new faces are never missed before the next rebuild.
+# nprobe is the recall/speed knob: more probed lists = better recall, slower queries.
+class IvfPqIndex:
+    def __init__(self, coarse, codebooks, list_offsets, rows, codes, store_generation: int):
+        self.coarse = coarse               # (nlist, dim)
+        self.codebooks = codebooks         # (m, ksub, dim // m)
+        self.listOffsets = list_offsets    # (nlist + 1,), list i is [offsets[i], offsets[i + 1])
+        self.rows = rows                   # (n,) store row of each code, grouped by list
+        self.codes = codes                 # (n, m) uint8
+        self.storeGeneration = store_generation
+        self.m, self.ksub, self.subDim = codebooks.shape
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def build(cls, store: EncodingStore, nlist: int = None, m: int = 16, ksub: int = 256, train_size: int = 65536, iters: int = 20, seed: int = 0):
+        encodings = np.asarray(store.encodings, dtype=np.float32)
+        count, dim = encodings.shape
+        if dim % m:
+            raise ValueError(f"dim {dim} is not divisible into {m} subquantizers")
+        nlist = nlist or max(1, int(4 * np.sqrt(count)))
+        nlist = min(nlist, count)
+        ksub = min(ksub, count)
+
+        rng = np.random.default_rng(seed)
+        train = encodings[rng.choice(count, size=min(train_size, count), replace=False)]
+        coarse = kmeans(train, nlist, iters, seed)
+
+        labels = assignNearest(encodings, coarse)
+        residuals = encodings - coarse[labels]
+        sub_dim = dim // m
+        train_residuals = residuals[rng.choice(count, size=min(train_size, count), replace=False)]
+        codebooks = np.stack([kmeans(train_residuals[:, j * sub_dim:(j + 1) * sub_dim], ksub, iters, seed + j) for j in range(m)])
+        codes = np.stack([assignNearest(residuals[:, j * sub_dim:(j + 1) * sub_dim], codebooks[j]) for j in range(m)], axis=1).astype(np.uint8)
+
+        order = np.argsort(labels, kind='stable')
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=nlist), out=list_offsets[1:])
+        return cls(coarse, codebooks, list_offsets, order.astype(np.int64), codes[order], store.manifest['generation'])
+
+    def save(self, path: str):
+        folder = os.path.dirname(path) or '.'
+        os.makedirs(folder, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.ivfpq.', suffix='.npz')
+        with os.fdopen(fd, 'wb') as file:
+            np.savez(file, coarse=self.coarse, codebooks=self.codebooks, list_offsets=self.listOffsets,
+                     rows=self.rows, codes=self.codes, store_generation=self.storeGeneration)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(data['coarse'], data['codebooks'], data['list_offsets'], data['rows'], data['codes'], int(data['store_generation']))
+
+    # [(msg_id, distance)] closest first; the top `rerank` approximate hits get their exact distance from the store
+    def search(self, store: EncodingStore, query, k: int = 10, nprobe: int = 8, rerank: int = 100):
+        query = np.asarray(query, dtype=np.float32)
+        nprobe = min(nprobe, len(self.coarse))
+        coarse_distances = squaredDistances(query[None, :], self.coarse)[0]
+        probed = np.argpartition(coarse_distances, nprobe - 1)[:nprobe]
+
+        candidate_rows, candidate_distances = [], []
+        sub_queries = np.arange(self.m)
+        for list_id in probed:
+            start, end = self.listOffsets[list_id], self.listOffsets[list_id + 1]
+            if start == end:
+                continue
+            residual = (query - self.coarse[list_id]).reshape(self.m, 1, self.subDim)
+            table = ((self.codebooks - residual) ** 2).sum(axis=2) # (m, ksub) distance of every sub-centroid
+            candidate_distances.append(table[sub_queries, self.codes[start:end]].sum(axis=1))
+            candidate_rows.append(self.rows[start:end])
+
+        # rows added to the store after the build
+        indexed = len(self.rows)
+        if len(store) > indexed:
+            tail = np.asarray(store.encodings[indexed:], dtype=np.float32)
+            candidate_rows.append(np.arange(indexed, len(store)))
+            candidate_distances.append(((tail - query) ** 2).sum(axis=1))
+
+        if not candidate_rows:
+            return []
+        rows = np.concatenate(candidate_rows)
+        distances = np.concatenate(candidate_distances)
+
+        shortlist = min(max(k, rerank), len(rows))
+        shortlist_idx = np.argpartition(distances, shortlist - 1)[:shortlist]
+        rows = np.sort(rows[shortlist_idx]) # sorted rows read the mmapped matrix front to back
+        exact = ((np.asarray(store.encodings[rows], dtype=np.float32) - query) ** 2).sum(axis=1)
+
+        k = min(k, len(rows))
+        nearest = np.argpartition(exact, k - 1)[:k]
+        nearest = nearest[np.argsort(exact[nearest])]
+        return [(int(store.ids[rows[i]]), float(np.sqrt(exact[i]))) for i in nearest]
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m kshkun_modules.ann_index', description='offline IVF-PQ index for the mobyk encoding store')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build')
+    build.add_argument('--store', default='bin_files/mobyk_store/')
+    build.add_argument('--out', default=None, help='defaults to <store>/ivfpq.npz')
+    build.add_argument('--nlist', type=int, default=None, help='coarse lists, defaults to 4*sqrt(n)')
+    build.add_argument('--m', type=int, default=16, help='pq subquantizers, must divide 128')
+    build.add_argument('--iters', type=int, default=20)
+    args = parser.parse_args()
+
+    store = EncodingStore(args.store).load()
+    out = args.out or os.path.join(args.store, 'ivfpq.npz')
+    start = time.perf_counter()
+    index = IvfPqIndex.build(store, nlist=args.nlist, m=args.m, iters=args.iters)
+    index.save(out)
+    print(f"Built IVF-PQ index over {len(index)} encodings ({len(index.coarse)} lists, {index.m} subquantizers) in {time.perf_counter() - start:.1f}s -> {out}")
+
+if __name__ == "__main__":
+    sys.exit(main())
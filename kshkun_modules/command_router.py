@@ -0,0 +1,98 @@
+import time
+from operator import itemgetter
+
+class CommandStage:
+    ANYWHERE = 'anywhere' # before the private chat cutoff, works in dms too
+    GROUP = 'group'       # groups only, before the chat handlers
+    TRIGGER = 'trigger'   # "кшкун ..." and replies to kshkun
+
+class KshkunCommand:
+    def __init__(self, name: str, keywords: tuple, func, args: tuple = (), stage: str = CommandStage.TRIGGER,
+                 exact: bool = False, chat_ids: tuple = None, uids: tuple = None, admin_only: bool = False, cooldown: float = 0):
+        self.name = name
+        self.keywords = keywords
+        self.func = func
+        self.args = args
+        self.stage = stage
+        self.exact = exact
+        self.chatIds = frozenset(chat_ids) if chat_ids is not None else None
+        self.uids = frozenset(uids) if uids is not None else None
+        self.adminOnly = admin_only
+        self.cooldown = cooldown
+        self.lastUsed = {}
+
+        # bound once here instead of looking every arg name up per message
+        if not args:
+            self.getArgs = lambda context: ()
+        elif len(args) == 1:
+            self.getArgs = lambda context, key=args[0]: (context[key],)
+        else:
+            self.getArgs = itemgetter(*args)
+
+    def allows(self, text_lower: str, keyword: str, chat_id: int, uid: int, admin_id: int):
+        if self.exact and text_lower != keyword:
+            return False
+        if self.chatIds is not None and chat_id not in self.chatIds:
+            return False
+        if self.uids is not None and uid not in self.uids:
+            return False
+        if self.adminOnly and uid != admin_id:
+            return False
+        return True
+
+    # seconds left until uid can use the command again, 0 if it can right now
+    def cooldownLeft(self, uid: int):
+        if not self.cooldown:
+            return 0
+        left = self.lastUsed.get(uid, float('-inf')) + self.cooldown - time.monotonic()
+        return max(left, 0)
+
+    def markUsed(self, uid: int):
+        if self.cooldown:
+            self.lastUsed[uid] = time.monotonic()
+
+    async def run(self, cli, msg, context: dict):
+        self.markUsed(context['uid'])
+        return await self.func(cli, msg, *self.getArgs(context))
+
+# prefix trie over every keyword of every command, built once at startup.
+# a message is walked once and the longest matching keyword wins; if that command's
+# restrictions reject the message the next shorter match gets its turn.
+class CommandRouter:
+    def __init__(self):
+        self.root = {}
+        self.commands = {}
+        self.fallback = None
+
+    def register(self, command: KshkunCommand):
+        self.commands[command.name] = command
+        for keyword in command.keywords:
+            node = self.root
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append((command, keyword))
+        return command
+
+    def setFallback(self, command: KshkunCommand):
+        self.fallback = self.register(command)
+
+    def match(self, text_lower: str):
+        matches = []
+        node = self.root
+        for char in text_lower:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                matches.extend(node[None])
+        matches.reverse()
+        return matches
+
+    def resolve(self, matches: list, stage: str, text_lower: str, chat_id: int, uid: int, admin_id: int):
+        for command, keyword in matches:
+            if command.stage == stage and command.allows(text_lower, keyword, chat_id, uid, admin_id):
+                return command
+        return None
+
+    def get(self, name: str):
+        return self.commands.get(name)
@@ -1,6 +1,10 @@
-import aiosqlite
+import asyncio
 from typing import Callable
-from kshkun_modules.logger import KshkunLogger as klog
+from kshkun_modules.logger import KshkunLogger
+from kshkun_modules.sqlite_pool import SqlitePools
+from kshkun_modules.user_cache import KshkunUserCache
+
+klog = KshkunLogger()
 
 DEFAULT_USER = {
         'id': 0,
@@ -22,6 +26,13 @@ class KshkunUser:
         self.duzhocoins = duzhocoins
         self.menstra_date = menstra_date
 
+    @classmethod
+    def fromDict(cls, user: dict):
+        return cls(user['id'], user['custom_system_prompt'], user['duzhocoins'], user['menstra_date'])
+
+    def toDict(self):
+        return {'id': self.uid, 'custom_system_prompt': self.custom_system_prompt, 'duzhocoins': self.duzhocoins, 'menstra_date': self.menstra_date}
+
 class KshkunChat:
     def __init__(self, chat_id: int, shluhobot_on: bool, shluhobot_custom_prompt: str):
         self.chat_id = chat_id
@@ -29,34 +40,39 @@ class KshkunChat:
         self.shluhobot_custom_prompt = shluhobot_custom_prompt
 
 class DatabaseHandler:
+    userCache = KshkunUserCache(max_users=2048)
+    userCacheFlusher = None
+    flushTasks = set() # early flushes started by saveUserInDb, the loop only keeps weak references to tasks
+
     def __init__(self):
         self.sqlDbsFolder = 'sql_dbs/'
         self.appDataDb = 'app_data.db'
 
+    def getPool(self, filename: str):
+        return SqlitePools.get(self.sqlDbsFolder + filename)
+
+    async def closeConnections(self):
+        await SqlitePools.closeAll()
+
     async def saveInDb(self, filename: str, query: str, *args):   
         try:
-            async with aiosqlite.connect(self.sqlDbsFolder + filename) as db:
-                await db.execute(query, args)
-                await db.commit()
-                return None, None
+            await self.getPool(filename).execute(query, args)
+            return None, None
         except Exception as e:
-            await klog.log(f"SAVE_IN_DB ERROR: {e}", 'ERROR')
+            await klog.err(f"SAVE_IN_DB ERROR: {e}")
             return None, e
         
     async def loadRowFromDb(self, id: int, table_name: str):
         object_name = table_name.replace("_data", "").strip().upper()
         try:
-            async with aiosqlite.connect(self.sqlDbsFolder + self.appDataDb) as db:
-                async with db.execute(f"SELECT * FROM {table_name} WHERE id = ?", (id,)) as cursor:
-                    row = await cursor.fetchone()
-                    if row:
-                        columns = [column[0] for column in cursor.description]
-                        return dict(zip(columns, row)), None
-                    else:
-                        await klog.log(f'{object_name} {id} NOT FOUND IN {table_name}', 'WARNING')
-                        return False, None
+            row, columns = await self.getPool(self.appDataDb).fetchOne(f"SELECT * FROM {table_name} WHERE id = ?", (id,))
+            if row:
+                return dict(zip(columns, row)), None
+            else:
+                await klog.warn(f'{object_name} {id} NOT FOUND IN {table_name}')
+                return False, None
         except Exception as e:
-            await klog.log(f'DB LOAD ERROR WHEN HANDLING {object_name} {id} IN {table_name}: {e}', 'ERROR')
+            await klog.err(f'DB LOAD ERROR WHEN HANDLING {object_name} {id} IN {table_name}: {e}')
             return None, e
     
     async def saveObjectInDb(self, object: dict, default_object: dict, table_name: str):
@@ -64,7 +80,7 @@ class DatabaseHandler:
         required_keys = list(default_object.keys())
         for key in required_keys:
             if key not in object:
-                await klog.log(f"{object_name} {object["id"]} IS MISSING A KEY: '{key}', WON'T SAVE", 'ERROR')
+                await klog.err(f"{object_name} {object["id"]} IS MISSING A KEY: '{key}', WON'T SAVE")
                 return None, Exception("Missing key") 
 
         columns = ', '.join(required_keys)
@@ -73,28 +89,82 @@ class DatabaseHandler:
         query = f"INSERT OR REPLACE INTO {table_name} ({columns}) VALUES ({placeholders})"
         result, err = await self.saveInDb(self.appDataDb, query, *values)
         if err != None:
-            await klog.log(f"COULD NOT SAVE {object_name} {object["id"]} IN DB: {err}", 'ERROR')
+            await klog.err(f"COULD NOT SAVE {object_name} {object["id"]} IN DB: {err}")
 
         return result, err
 
     async def loadUserFromDb(self, uid: int):
         user, err = await self.loadRowFromDb(uid, "user_data")
         if err != None:
-            await klog.log(f"LOAD USER FROM DB ERROR: {err}", "ERROR")
+            await klog.err(f"LOAD USER FROM DB ERROR: {err}")
 
         return user, err
 
     async def saveUserInDb(self, user: dict):
-        result, err = await self.saveObjectInDb(user, DEFAULT_USER, "user_data")
-        if err != None:
-            await klog.log(f"SAVE USER IN DB ERROR: {err}", "ERROR")
+        for key in DEFAULT_USER:
+            if key not in user:
+                await klog.err(f"USER {user.get('id')} IS MISSING A KEY: '{key}', WON'T SAVE")
+                return None, Exception("Missing key")
+
+        new_user = KshkunUser.fromDict(user)
+        cached_user = self.userCache.peek(new_user.uid)
+        if cached_user is not None:
+            new_user.duzhocoins = cached_user.duzhocoins # balance only changes through DuzhocoinHandler
+
+        self.userCache.put(new_user, dirty=True)
+        if self.userCache.needsFlush() and not DatabaseHandler.flushTasks: # one early flush at a time
+            task = asyncio.create_task(self.flushUserCache())
+            DatabaseHandler.flushTasks.add(task)
+            task.add_done_callback(DatabaseHandler.flushTasks.discard)
+
+        return None, None
+
+    async def flushUserCache(self):
+        users = self.userCache.takeDirty()
+        if not users:
+            return None, None
+
+        columns = ', '.join(DEFAULT_USER.keys())
+        placeholders = ', '.join('?' for _ in DEFAULT_USER)
+        query = (f"INSERT INTO user_data ({columns}) VALUES ({placeholders}) "
+                 "ON CONFLICT(id) DO UPDATE SET custom_system_prompt = excluded.custom_system_prompt, menstra_date = excluded.menstra_date")
+        rows = [tuple(user.toDict().values()) for user in users]
+        try:
+            await self.getPool(self.appDataDb).executemany(query, rows)
+        except Exception as e:
+            self.userCache.restoreDirty(users)
+            await klog.err(f"FLUSH USER CACHE ERROR ({len(users)} USERS): {e}")
+            return None, e
 
-        return result, err
+        self.userCache.finishFlush(users)
+        return None, None
+
+    async def runUserCacheFlusher(self, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flushUserCache()
+
+    def startUserCacheFlusher(self, interval: int = 30):
+        if DatabaseHandler.userCacheFlusher is None or DatabaseHandler.userCacheFlusher.done():
+            DatabaseHandler.userCacheFlusher = asyncio.create_task(self.runUserCacheFlusher(interval))
+
+    async def stopUserCacheFlusher(self):
+        flusher = DatabaseHandler.userCacheFlusher
+        if flusher is not None:
+            flusher.cancel()
+            DatabaseHandler.userCacheFlusher = None
+
+        await asyncio.gather(*DatabaseHandler.flushTasks, return_exceptions=True)
+        _, err = await self.flushUserCache()
+        if err != None:
+            await klog.err(f"COULD NOT FLUSH USER CACHE ON SHUTDOWN: {err}")
+        else:
+            await klog.log(f"Flushed user cache: {self.userCache.stats()}")
     
     async def loadInitializeOrUpdateObject(self, id: int, object_name: str, default_object: dict, load_func: Callable, save_func: Callable):
         object, err = await load_func(id)
         if err != None:
-            await klog.log(f"COULD NOT LOAD {object_name} {id} FROM DB: {err}", "ERROR")
+            await klog.err(f"COULD NOT LOAD {object_name} {id} FROM DB: {err}")
             return None, err
         
         if object == False:
@@ -103,7 +173,7 @@ class DatabaseHandler:
             object['id'] = id
             _, err = await save_func(object)
             if err != None:
-                await klog.log(f"COULD NOT SAVE {object_name} {id} IN DB: {err}", "ERROR")
+                await klog.err(f"COULD NOT SAVE {object_name} {id} IN DB: {err}")
                 return None, err
             
             return object, err
@@ -125,46 +195,41 @@ class DatabaseHandler:
         
         _, err = await save_func(object)
         if err != None:
-            await klog.log(f"COULD NOT SAVE UPDATED {object_name} {id} IN DB: {err}", 'ERROR')
+            await klog.err(f"COULD NOT SAVE UPDATED {object_name} {id} IN DB: {err}")
             return None, err 
 
+        return object, None
+
     async def loadInitializeOrUpdateUser(self, uid: int):
+        cached_user = self.userCache.get(uid)
+        if cached_user is not None:
+            return cached_user.toDict(), None
+
         user, err = await self.loadInitializeOrUpdateObject(uid, "USER", DEFAULT_USER, self.loadUserFromDb, self.saveUserInDb)
         if err != None:
-            await klog.log(f"ERROR LOAD INIT OR UPDATE USER {uid}: {err}", "ERROR")
+            await klog.err(f"ERROR LOAD INIT OR UPDATE USER {uid}: {err}")
+            return user, err
 
+        self.userCache.put(KshkunUser.fromDict(user), dirty=False)
         return user, err
     
     async def loadChatFromDb(self, chat_id: int):
         chat, err = await self.loadRowFromDb(chat_id, "chat_data")
         if err != None:
-            await klog.log(f"LOAD CHAT FROM DB ERROR: {err}", 'ERROR')
+            await klog.err(f"LOAD CHAT FROM DB ERROR: {err}")
 
         return chat, err
         
     async def saveChatInDb(self, chat: dict):
         result, err = await self.saveObjectInDb(chat, DEFAULT_CHAT, "chat_data")
         if err != None:
-            await klog.log(f"SAVE CHAT IN DB ERROR: {err}", "ERROR")
+            await klog.err(f"SAVE CHAT IN DB ERROR: {err}")
 
         return result, err
     
     async def loadInitializeOrUpdateChat(self, chat_id: int):
         chat, err = await self.loadInitializeOrUpdateObject(chat_id, "CHAT", DEFAULT_CHAT, self.loadChatFromDb, self.saveChatInDb)
         if err != None:
-            await klog.log(f"LOAD INIT OR UPDATE CHAT ERROR: {err}", "ERROR")
+            await klog.err(f"LOAD INIT OR UPDATE CHAT ERROR: {err}")
 
         return chat, err
-        
-    async def checkFileIdInBuffer(self, filename: str, query: str, *args):
-        try:
-            async with aiosqlite.connect(self.sqlDbsFolder + filename) as db:
-                async with db.execute(query, args) as cursor:
-                    row = await cursor.fetchone()
-                    if row:
-                        return row[0], None
-                    else:
-                        return False, None
-        except Exception as e:
-            await klog.log(f"CHECK_FILE_ID_IN_BUFFER ERROR: {e}", 'ERROR')
-            return None, e
\ No newline at end of file
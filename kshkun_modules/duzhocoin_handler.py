@@ -1,42 +1,139 @@
-from kshkun_modules.logger import KshkunLogger as klog
-from kshkun_modules.database_handler import DatabaseHandler as dbhandler
+from datetime import datetime
+from kshkun_modules.logger import KshkunLogger
+from kshkun_modules.database_handler import DatabaseHandler
 
+klog = KshkunLogger()
+dbh = DatabaseHandler()
+
+class LedgerSQL:
+    CREATE_LEDGER = """CREATE TABLE IF NOT EXISTS ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at TEXT NOT NULL,
+        sender_id INTEGER,
+        reciever_id INTEGER,
+        amount INTEGER NOT NULL,
+        reason TEXT NOT NULL
+    )"""
+    ENSURE_USER = "INSERT OR IGNORE INTO user_data (id, custom_system_prompt, duzhocoins, menstra_date) VALUES (?, '', 0, '')"
+    DEBIT = "UPDATE user_data SET duzhocoins = duzhocoins - ? WHERE id = ? AND duzhocoins >= ? RETURNING duzhocoins"
+    CREDIT = "UPDATE user_data SET duzhocoins = duzhocoins + ? WHERE id = ? RETURNING duzhocoins"
+    CREDIT_MANY = "UPDATE user_data SET duzhocoins = duzhocoins + ? WHERE id IN ({placeholders}) RETURNING id, duzhocoins"
+    LOG = "INSERT INTO ledger (created_at, sender_id, reciever_id, amount, reason) VALUES (?, ?, ?, ?, ?)"
+    BALANCE = "SELECT duzhocoins FROM user_data WHERE id = ?"
+
+# every duzhocoin change is one sql transaction: conditional debit, credit and ledger row commit together.
+# user_data.duzhocoins is owned by the ledger, the user cache only mirrors it.
 class DuzhocoinHandler:
+    ledgerReady = False
+
     def __init__(self):
-        pass
-
-    async def transferDuzhocoins(sender_id: int, reciever_id: int, amount: int):
-        dbh = dbhandler()
-        sender, err = await dbh.loadInitializeOrUpdateUser(sender_id)
-        if err != None:
-            await klog.log(f'COULD NOT LOAD DUZHOCOINS SENDER {sender_id} FROM DB: {err}', 'ERROR')
-            error_text = 'сталася помилочка при завантаженні інформації про відправника.'
-            return error_text, err
-        
-        reciever, err = await dbh.loadInitializeOrUpdateUser(reciever_id)
-        if err != None:
-            await klog.log(f'COULD NOT LOAD DUZHOCOINS RECIEVER {reciever_id} FROM DB: {err}', 'ERROR')
-            error_text = 'сталася помилочка при завантаженні інформації про отримувача.'
-            return error_text, err
-
-        if sender['duzhocoins'] < amount:
-            error_text = f'недостатньо дужокоїнів. баланс: {sender["duzhocoins"]}'
-            err = ValueError
-            return error_text, err
-
-        sender['duzhocoins'] -= amount
-        reciever['duzhocoins'] += amount
-
-        result, err = await dbh.saveUserInDb(sender)
-        if err != None:
-            await klog.log(f'COULD NOT SAVE DUZHOCOINS SENDER {sender_id} IN DB: {err}', 'ERROR')
-            error_text = 'сталася помилочка при збереженні відправника в датабазі.'
-            return error_text, err
-
-        result, err = await dbh.saveUserInDb(reciever)
-        if err != None:
-            await klog.log(f'COULD NOT SAVE DUZHOCOINS RECIEVER {reciever_id} IN DB: {err}', 'ERROR')
-            error_text = 'сталася помилочка при збереженні отримувача в датабазі.'
-            return error_text, err
+        self.pool = dbh.getPool(dbh.appDataDb)
+
+    async def ensureLedger(self):
+        if DuzhocoinHandler.ledgerReady:
+            return
+        async with self.pool.transaction() as conn:
+            await conn.execute(LedgerSQL.CREATE_LEDGER)
+        DuzhocoinHandler.ledgerReady = True
+
+    async def fetchBalance(self, conn, uid: int):
+        async with conn.execute(LedgerSQL.BALANCE, (uid,)) as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row else 0
+
+    async def debitInTransaction(self, conn, uid: int, amount: int):
+        await conn.execute(LedgerSQL.ENSURE_USER, (uid,))
+        async with conn.execute(LedgerSQL.DEBIT, (amount, uid, amount)) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return await self.fetchBalance(conn, uid), False
+        return row[0], True
+
+    async def creditInTransaction(self, conn, uid: int, amount: int):
+        await conn.execute(LedgerSQL.ENSURE_USER, (uid,))
+        async with conn.execute(LedgerSQL.CREDIT, (amount, uid)) as cursor:
+            row = await cursor.fetchone()
+        return row[0]
+
+    async def logInTransaction(self, conn, sender_id, reciever_id, amount: int, reason: str):
+        await conn.execute(LedgerSQL.LOG, (datetime.now().isoformat(timespec='seconds'), sender_id, reciever_id, amount, reason))
+
+    async def getBalance(self, uid: int):
+        try:
+            row, _ = await self.pool.fetchOne(LedgerSQL.BALANCE, (uid,))
+            return (row[0] if row else 0), None
+        except Exception as e:
+            await klog.err(f'GET BALANCE OF {uid} ERROR: {e}')
+            return None, e
+
+    async def debitDuzhocoins(self, uid: int, amount: int, reason: str):
+        try:
+            await self.ensureLedger()
+            async with self.pool.transaction() as conn:
+                balance, debited = await self.debitInTransaction(conn, uid, amount)
+                if debited:
+                    await self.logInTransaction(conn, uid, None, amount, reason)
+        except Exception as e:
+            await klog.err(f'DEBIT {amount} FROM {uid} ({reason}) ERROR: {e}')
+            return None, e
+
+        dbh.userCache.setBalance(uid, balance)
+        if not debited:
+            return balance, ValueError(f'not enough duzhocoins: {balance} < {amount}')
+        return balance, None
+
+    async def creditDuzhocoins(self, uid: int, amount: int, reason: str):
+        try:
+            await self.ensureLedger()
+            async with self.pool.transaction() as conn:
+                balance = await self.creditInTransaction(conn, uid, amount)
+                await self.logInTransaction(conn, None, uid, amount, reason)
+        except Exception as e:
+            await klog.err(f'CREDIT {amount} TO {uid} ({reason}) ERROR: {e}')
+            return None, e
+
+        dbh.userCache.setBalance(uid, balance)
+        return balance, None
+
+    async def payoutDuzhocoins(self, uids: list, amount: int, reason: str):
+        uids = list(dict.fromkeys(uids))
+        if not uids:
+            return {}, None
+
+        now = datetime.now().isoformat(timespec='seconds')
+        query = LedgerSQL.CREDIT_MANY.format(placeholders=', '.join('?' for _ in uids))
+        try:
+            await self.ensureLedger()
+            async with self.pool.transaction() as conn:
+                await conn.executemany(LedgerSQL.ENSURE_USER, [(uid,) for uid in uids])
+                async with conn.execute(query, (amount, *uids)) as cursor:
+                    balances = dict(await cursor.fetchall())
+                await conn.executemany(LedgerSQL.LOG, [(now, None, uid, amount, reason) for uid in uids])
+        except Exception as e:
+            await klog.err(f'PAYOUT {amount} TO {uids} ({reason}) ERROR: {e}')
+            return None, e
+
+        for uid, balance in balances.items():
+            dbh.userCache.setBalance(uid, balance)
+        return balances, None
+
+    async def transferDuzhocoins(self, sender_id: int, reciever_id: int, amount: int):
+        try:
+            await self.ensureLedger()
+            async with self.pool.transaction() as conn:
+                sender_balance, debited = await self.debitInTransaction(conn, sender_id, amount)
+                if debited:
+                    reciever_balance = await self.creditInTransaction(conn, reciever_id, amount)
+                    await self.logInTransaction(conn, sender_id, reciever_id, amount, 'transfer')
+        except Exception as e:
+            await klog.err(f'DUZHOCOINS TRANSFER {sender_id} -> {reciever_id} ({amount}) ERROR: {e}')
+            error_text = 'сталася помилочка при переказі дужокоїнів.'
+            return error_text, e
+
+        dbh.userCache.setBalance(sender_id, sender_balance)
+        if not debited:
+            error_text = f'недостатньо дужокоїнів. баланс: {sender_balance}'
+            return error_text, ValueError(error_text)
 
+        dbh.userCache.setBalance(reciever_id, reciever_balance)
         return None, None
@@ -0,0 +1,182 @@
+import json, os, pickle, tempfile
+import numpy as np
+
+# face encodings on disk as plain .npy files described by manifest.json:
+#   encodings  float32 (n, 128), opened with mmap so every worker shares the page cache
+#   ids        int64 (n,), message id in the mobyk channel for each row
+#   sq_norms   float32 (n,), |e|^2 per row so a query is one matrix-vector product
+# every write produces a new generation of files and then swaps the manifest with os.replace,
+# so readers always see a complete store. rows_generation is the last generation that changed
+# existing rows; appends keep it, so anything built on an older generation can still trust its rows.
+class EncodingStore:
+    def __init__(self, folder: str = 'bin_files/mobyk_store/'):
+        self.folder = folder
+        self.manifestPath = os.path.join(folder, 'manifest.json')
+        self.manifest = None
+        self.manifestMtime = None
+        self.encodings = np.zeros((0, 128), dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.sqNorms = np.zeros(0, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def path(self, filename: str):
+        return os.path.join(self.folder, filename)
+
+    def load(self):
+        mtime = os.stat(self.manifestPath).st_mtime_ns
+        with open(self.manifestPath, 'r') as file:
+            manifest = json.load(file)
+
+        self.encodings = np.load(self.path(manifest['encodings']), mmap_mode='r')
+        self.ids = np.load(self.path(manifest['ids']))
+        self.sqNorms = np.load(self.path(manifest['sq_norms']))
+        if not (len(self.encodings) == len(self.ids) == len(self.sqNorms) == manifest['count']):
+            raise ValueError(f"encoding store {self.folder} is inconsistent with its manifest")
+
+        self.manifest = manifest
+        self.manifestMtime = mtime
+        return self
+
+    def refreshIfChanged(self):
+        try:
+            mtime = os.stat(self.manifestPath).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self.manifestMtime:
+            return False
+        self.load()
+        return True
+
+    def exists(self):
+        return os.path.exists(self.manifestPath)
+
+    # returns [(msg_id, distance)] of the k closest rows, closest first
+    def topK(self, query, k: int = 10):
+        count = len(self.ids)
+        if not count:
+            return []
+
+        query = np.asarray(query, dtype=np.float32)
+        sq_distances = self.sqNorms - 2 * (self.encodings @ query) + np.dot(query, query)
+        k = min(k, count)
+        nearest = np.argpartition(sq_distances, k - 1)[:k]
+        nearest = nearest[np.argsort(sq_distances[nearest])]
+        distances = np.sqrt(np.maximum(sq_distances[nearest], 0))
+        return [(int(self.ids[i]), float(d)) for i, d in zip(nearest, distances)]
+
+    def writeArray(self, filename: str, array):
+        fd, temp_path = tempfile.mkstemp(dir=self.folder, prefix=f'.{filename}.', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            np.save(file, array)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path(filename))
+
+    def meta(self):
+        return (self.manifest or {}).get('meta', {})
+
+    # manifests from before rows_generation existed count every generation as a rewrite
+    def rowsGeneration(self):
+        if self.manifest is None:
+            return None
+        return self.manifest.get('rows_generation', self.manifest['generation'])
+
+    # True if rows 0..n-1 are still the rows this store had at `generation`
+    def keepsRowsOf(self, generation: int):
+        if self.manifest is None:
+            return False
+        return self.rowsGeneration() <= generation <= self.manifest['generation']
+
+    def writeManifest(self, manifest: dict):
+        fd, temp_path = tempfile.mkstemp(dir=self.folder, prefix='.manifest.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(manifest, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.manifestPath)
+
+    # small bookkeeping next to the vectors (e.g. the last ingested message id)
+    def updateMeta(self, **meta):
+        if self.manifest is None:
+            self.writeGeneration(self.encodings, self.ids, meta)
+            return
+        manifest = dict(self.manifest, meta=dict(self.meta(), **meta))
+        self.writeManifest(manifest)
+        self.load()
+
+    def writeGeneration(self, encodings, ids, meta: dict = None, appended: bool = False):
+        os.makedirs(self.folder, exist_ok=True)
+        encodings = np.ascontiguousarray(encodings, dtype=np.float32).reshape(-1, 128)
+        ids = np.asarray(ids, dtype=np.int64)
+        generation = (self.manifest['generation'] + 1) if self.manifest else 1
+        manifest = {
+            'generation': generation,
+            'rows_generation': self.rowsGeneration() if appended and self.manifest else generation,
+            'count': len(ids),
+            'dim': 128,
+            'encodings': f'encodings.{generation}.npy',
+            'ids': f'ids.{generation}.npy',
+            'sq_norms': f'sq_norms.{generation}.npy',
+            'meta': dict(self.meta(), **(meta or {})),
+        }
+        self.writeArray(manifest['encodings'], encodings)
+        self.writeArray(manifest['ids'], ids)
+        self.writeArray(manifest['sq_norms'], np.einsum('ij,ij->i', encodings, encodings))
+        self.writeManifest(manifest)
+
+        old_manifest = self.manifest
+        self.load()
+        if old_manifest:
+            # already mapped readers keep working on unlinked files
+            for key in ('encodings', 'ids', 'sq_norms'):
+                try:
+                    os.unlink(self.path(old_manifest[key]))
+                except FileNotFoundError:
+                    pass
+
+    def loadOrRefresh(self):
+        if self.exists() and self.manifest is None:
+            self.load()
+        else:
+            self.refreshIfChanged()
+        return self
+
+    # adds rows for ids that aren't stored yet, returns how many were added
+    def append(self, ids, encodings, meta: dict = None):
+        self.loadOrRefresh()
+
+        ids = np.asarray(ids, dtype=np.int64)
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, 128)
+        new_rows = ~np.isin(ids, self.ids)
+        ids, encodings = ids[new_rows], encodings[new_rows]
+        ids, first = np.unique(ids, return_index=True)
+        encodings = encodings[first]
+        if not len(ids):
+            if meta:
+                self.updateMeta(**meta)
+            return 0
+
+        self.writeGeneration(np.concatenate([self.encodings, encodings]), np.concatenate([self.ids, ids]), meta, appended=True)
+        return len(ids)
+
+    # one-off migration from the old {"<msg_id>.jpg": encoding} pickle.
+    # keys whose file name isn't a message id have no place in the store and come back in `skipped`
+    @classmethod
+    def fromPickle(cls, pkl_path: str, folder: str = 'bin_files/mobyk_store/'):
+        with open(pkl_path, 'rb') as file:
+            cache = pickle.load(file)
+
+        ids, encodings, skipped = [], [], []
+        for path, encoding in cache.items():
+            stem = os.path.splitext(os.path.basename(path))[0]
+            if not stem.isdigit():
+                skipped.append(path)
+                continue
+            ids.append(int(stem))
+            encodings.append(encoding)
+
+        store = cls(folder)
+        store.append(ids, np.array(encodings, dtype=np.float32).reshape(-1, 128))
+        return store, skipped
@@ -1,59 +1,127 @@
 import sys, cv2
 import numpy as np
 from mtcnn import MTCNN
-import random
 
-file_data = sys.stdin.buffer.read()
-nparr = np.frombuffer(file_data, np.uint8)
-image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-detector = MTCNN()
-faces = detector.detect_faces(image)
+# mtcnn cost grows with the pixel count, faces are found just as well on a downscaled copy
+DETECTION_MAX_SIDE = 1024
+HAT_COLOR = (0, 0, 255)
 
-if not faces:
-    print("SUBPROCESS_MAGA_HAT: NO_FACES")
-    sys.exit(0)
+rng = np.random.default_rng()
 
-for face in faces:
-    face_box = face['box']
-    x, y, w, h = face_box
+def detectionImage(image):
+    h, w = image.shape[:2]
+    scale = min(1.0, DETECTION_MAX_SIDE / max(h, w))
+    if scale < 1.0:
+        image = cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), scale
 
-    drawing_width = w // 15
+# boxes found on the downscaled copy, in full resolution coordinates
+def scaleBoxes(faces, scale: float):
+    return [tuple(int(round(v / scale)) for v in face['box']) for face in faces]
+
+def detectFaces(detector, images):
+    prepared = [detectionImage(image) for image in images]
+    if len(prepared) == 1:
+        batches = [detector.detect_faces(prepared[0][0])]
+    else:
+        batches = detector.detect_faces([small for small, _ in prepared])
+    return [scaleBoxes(faces, scale) for faces, (_, scale) in zip(batches, prepared)]
+
+# point arrays for one hat: a jittered brim, the dome outline and scribbles filling the dome
+def hatShapes(box):
+    x, y, w, h = box
+    drawing_width = max(1, w // 15)
     line_end_x = x + w
 
     circle_radius = w // 3
     half_circle_radius = circle_radius // 2
     circle_center_x = line_end_x - circle_radius - half_circle_radius
-    
-    line_drawing_steps = drawing_width
+    y_offset_max = w // 50
 
-    circle_drawing_steps = drawing_width
+    brim_x = np.arange(x - half_circle_radius, line_end_x - half_circle_radius, drawing_width)
+    brim_y = y + rng.integers(-y_offset_max, y_offset_max + 1, len(brim_x))
+    brim = np.stack([np.stack([brim_x, brim_y], axis=1), np.stack([brim_x + drawing_width, brim_y], axis=1)], axis=1)
 
-    num_fill_lines = 20
+    angles = np.deg2rad(np.arange(0, 180 + drawing_width, drawing_width))
+    dome = np.stack([circle_center_x + (circle_radius * np.cos(angles)).astype(np.int64), y - (circle_radius * np.sin(angles)).astype(np.int64)], axis=1)
 
-    y_offset_max = w // 50
+    fill_count = 20
+    fill_start_x = rng.integers(circle_center_x - circle_radius, circle_center_x + circle_radius + 1, fill_count)
+    fill_angles = np.deg2rad(90 + rng.uniform(-0.3, 0.3, fill_count) * 180)
+    fill_end = np.stack([circle_center_x + (circle_radius * np.cos(fill_angles)).astype(np.int64), y - (circle_radius * np.sin(fill_angles)).astype(np.int64)], axis=1)
+    fill = np.stack([np.stack([fill_start_x, np.full(fill_count, y)], axis=1), fill_end], axis=1)
+
+    return [line.astype(np.int32) for line in (*brim, dome, *fill)], drawing_width
+
+def drawHat(image, box):
+    lines, drawing_width = hatShapes(box)
+    cv2.polylines(image, lines, False, HAT_COLOR, drawing_width)
+
+def decodeImage(file_data: bytes):
+    image = cv2.imdecode(np.frombuffer(file_data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("could not decode image")
+    return image
+
+# jpg bytes with hats drawn, or None if there are no faces, for every image
+def drawMagaHatsBatch(detector, files: list):
+    images = [decodeImage(file_data) for file_data in files]
+    results = []
+    for image, boxes in zip(images, detectFaces(detector, images)):
+        if not boxes:
+            results.append(None)
+            continue
+        for box in boxes:
+            drawHat(image, box)
+        _, buffer = cv2.imencode('.jpg', image)
+        results.append(buffer.tobytes())
+    return results
+
+def drawMagaHats(detector, file_data: bytes):
+    return drawMagaHatsBatch(detector, [file_data])[0]
+
+def serve():
+    from kshkun_modules.worker_pool import serveForever, WorkerStatus
+    detector = MTCNN()
 
-    for i in range(x - half_circle_radius, line_end_x - half_circle_radius, line_drawing_steps):
-        y_offset = random.randint(-y_offset_max, y_offset_max)
-        cv2.line(image, (i, y + y_offset), (i + line_drawing_steps, y + y_offset), (0, 0, 255), drawing_width)
+    # one image per frame, the reply is a status and a payload frame per image
+    def handleRequest(frames):
+        try:
+            results = drawMagaHatsBatch(detector, frames)
+        except Exception:
+            if len(frames) == 1:
+                raise
+            # a broken image shouldn't fail the whole batch
+            results = []
+            for frame in frames:
+                try:
+                    results.append(drawMagaHats(detector, frame))
+                except Exception as e:
+                    results.append(e)
 
-    for angle in range(0, 180, circle_drawing_steps):
-        rad = np.deg2rad(angle)
-        start_x = circle_center_x + int(circle_radius * np.cos(rad))
-        start_y = y - int(circle_radius * np.sin(rad))
-        end_x = circle_center_x + int(circle_radius * np.cos(rad + np.deg2rad(circle_drawing_steps)))
-        end_y = y - int(circle_radius * np.sin(rad + np.deg2rad(circle_drawing_steps)))
+        reply = []
+        for result in results:
+            if isinstance(result, Exception):
+                reply += [WorkerStatus.ERR, f'{type(result).__name__}: {result}'.encode('utf-8')]
+            elif result is None:
+                reply += [WorkerStatus.EMPTY, b'']
+            else:
+                reply += [WorkerStatus.OK, result]
+        return reply
 
-        cv2.line(image, (start_x, start_y), (end_x, end_y), (0, 0, 255), drawing_width)
+    serveForever(handleRequest)
 
-    for _ in range(num_fill_lines):
-        start_x = random.randint(circle_center_x - circle_radius, circle_center_x + circle_radius)
-        start_y = y  
-        angle_offset = random.uniform(-0.3, 0.3)
-        rad = np.deg2rad(90 + angle_offset * 180)
-        end_x = circle_center_x + int(circle_radius * np.cos(rad))
-        end_y = y - int(circle_radius * np.sin(rad))
+def main():
+    file_data = sys.stdin.buffer.read()
+    result = drawMagaHats(MTCNN(), file_data)
+    if result is None:
+        print("SUBPROCESS_MAGA_HAT: NO_FACES")
+        sys.exit(0)
 
-        cv2.line(image, (start_x, start_y), (end_x, end_y), (0, 0, 255), drawing_width)
+    sys.stdout.buffer.write(result)
 
-_, buffer = cv2.imencode('.jpg', image)
-sys.stdout.buffer.write(buffer)
+if __name__ == "__main__":
+    if '--serve' in sys.argv:
+        serve()
+    else:
+        main()
@@ -0,0 +1,132 @@
+import json
+import httpx
+from google import genai
+from google.genai.types import HttpOptions, File
+from kshkun_modules.logger import KshkunLogger
+
+klog = KshkunLogger()
+
+GEMINI_BASE_URL = 'https://generativelanguage.googleapis.com'
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # what genai uses too; the api wants every chunk but the last to be a multiple of 256 KiB
+
+# one genai.Client for the whole bot. every request used to build its own client and open new
+# tls connections; here the async side runs on a single httpx transport whose pool keeps
+# connections to the api alive between requests.
+# passing a transport also pins genai to httpx instead of aiohttp, so the pool settings below apply.
+class KshkunGeminiClient:
+    def __init__(self, apiKey: str, maxConnections: int = 20, maxKeepalive: int = 10, keepaliveExpiry: float = 120, timeoutMs: int = None, transport: httpx.AsyncBaseTransport = None):
+        self.transport = transport or httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=maxConnections, max_keepalive_connections=maxKeepalive, keepalive_expiry=keepaliveExpiry),
+            retries=1, # reconnects once when a kept-alive connection was closed by the server
+        )
+        self.apiKey = apiKey
+        self.client = genai.Client(api_key=apiKey, http_options=HttpOptions(async_client_args={'transport': self.transport}, timeout=timeoutMs))
+        self.http = httpx.AsyncClient(transport=self.transport, timeout=httpx.Timeout(120, connect=10))
+        self.aio = self.client.aio
+        self.models = self.aio.models
+        self.files = self.aio.files
+
+    async def generateContent(self, model: str, contents: list, config):
+        return await self.models.generate_content(model=model, contents=contents, config=config)
+
+    # resumable upload straight from an async iterator of byte chunks. files.upload only takes a path
+    # or a seekable file object, this sends each 8 MiB chunk as soon as it has been received.
+    async def uploadStream(self, chunks, size: int, mimeType: str, displayName: str = None):
+        start = await self.http.post(
+            f'{GEMINI_BASE_URL}/upload/v1beta/files',
+            headers={
+                'x-goog-api-key': self.apiKey,
+                'X-Goog-Upload-Protocol': 'resumable',
+                'X-Goog-Upload-Command': 'start',
+                'X-Goog-Upload-Header-Content-Length': str(size),
+                'X-Goog-Upload-Header-Content-Type': mimeType,
+            },
+            json={'file': {'displayName': displayName}} if displayName else {'file': {}},
+        )
+        start.raise_for_status()
+        upload_url = start.headers.get('x-goog-upload-url')
+        if not upload_url:
+            raise KeyError('no upload url in the gemini start upload response')
+
+        offset = 0
+        buffer = bytearray()
+        response = None
+
+        async def sendChunk(chunk: bytes, final: bool):
+            nonlocal offset
+            response = await self.http.post(upload_url, content=bytes(chunk), headers={
+                'X-Goog-Upload-Command': 'upload, finalize' if final else 'upload',
+                'X-Goog-Upload-Offset': str(offset),
+            })
+            response.raise_for_status()
+            offset += len(chunk)
+            return response
+
+        async for data in chunks:
+            buffer += data
+            while len(buffer) >= UPLOAD_CHUNK_SIZE and offset + UPLOAD_CHUNK_SIZE < size:
+                await sendChunk(buffer[:UPLOAD_CHUNK_SIZE], False)
+                del buffer[:UPLOAD_CHUNK_SIZE]
+
+        if offset + len(buffer) != size:
+            raise ValueError(f'stream ended at {offset + len(buffer)} of {size} bytes')
+        response = await sendChunk(buffer, True)
+        if response.headers.get('x-goog-upload-status') != 'final':
+            raise ValueError('gemini upload was not finalized')
+        return File.model_validate(response.json()['file'])
+
+    async def close(self):
+        try:
+            await self.http.aclose()
+            await self.aio.aclose()
+            await self.transport.aclose()
+        except Exception as e:
+            await klog.err(f"COULD NOT CLOSE GEMINI CLIENT: {e}")
+
+# local transport for trying things without the api: every generate_content call gets `reply` back
+# (or whatever handler(request) returns) and requests are kept in .requests
+class StubGeminiTransport(httpx.MockTransport):
+    def __init__(self, reply: str = "stub reply", handler=None):
+        self.requests = []
+        self.uploads = {} # upload url -> received bytes
+        self.files = {}   # file name -> file json, served back by files.get
+        self.reply = reply
+        self.customHandler = handler
+        super().__init__(self.handle)
+
+    def handle(self, request: httpx.Request):
+        self.requests.append(request)
+        if self.customHandler:
+            return self.customHandler(request)
+        if 'X-Goog-Upload-Command' in request.headers:
+            return self.handleUpload(request)
+        if request.method == 'GET' and '/files/' in request.url.path:
+            name = request.url.path.split('/v1beta/', 1)[-1]
+            if name in self.files:
+                return httpx.Response(200, json=self.files[name])
+            return httpx.Response(404, json={'error': {'code': 404, 'message': f'{name} not found', 'status': 'NOT_FOUND'}})
+        body = {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": self.reply}]}, "finishReason": "STOP"}],
+            "usageMetadata": {"promptTokenCount": 1, "candidatesTokenCount": 1, "totalTokenCount": 2},
+        }
+        return httpx.Response(200, content=json.dumps(body).encode(), headers={'content-type': 'application/json'})
+
+    def handleUpload(self, request: httpx.Request):
+        command = request.headers['X-Goog-Upload-Command']
+        if command == 'start':
+            upload_url = f'{GEMINI_BASE_URL}/upload/stub/{len(self.uploads)}'
+            self.uploads[upload_url] = bytearray()
+            return httpx.Response(200, headers={'x-goog-upload-url': upload_url, 'x-goog-upload-status': 'active'}, json={})
+
+        received = self.uploads[str(request.url)]
+        if int(request.headers['X-Goog-Upload-Offset']) != len(received):
+            return httpx.Response(400, json={'error': {'message': 'bad offset'}})
+        received += request.content
+        if 'finalize' not in command:
+            return httpx.Response(200, headers={'x-goog-upload-status': 'active'})
+        name = f'files/stub{str(request.url).rsplit("/", 1)[-1]}'
+        self.files[name] = {'name': name, 'uri': f'{GEMINI_BASE_URL}/v1beta/{name}', 'sizeBytes': str(len(received)), 'state': 'ACTIVE', 'mimeType': 'application/octet-stream'}
+        return httpx.Response(200, headers={'x-goog-upload-status': 'final'}, json={'file': self.files[name]})
+
+def stubGeminiClient(reply: str = "stub reply", handler=None):
+    return KshkunGeminiClient(apiKey='stub', transport=StubGeminiTransport(reply, handler))
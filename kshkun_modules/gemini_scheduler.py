@@ -0,0 +1,162 @@
+import asyncio, heapq, itertools, time
+from kshkun_modules.logger import KshkunLogger
+
+klog = KshkunLogger()
+
+class GeminiPriority:
+    INTERACTIVE = 0 # someone is waiting for the reply in chat
+    NORMAL = 1
+    BACKGROUND = 2  # shluhobot, quiz generation and the like
+
+# seconds a request may wait for quota before it gives up
+DEFAULT_DEADLINES = {
+    GeminiPriority.INTERACTIVE: 60,
+    GeminiPriority.NORMAL: 120,
+    GeminiPriority.BACKGROUND: 300,
+}
+
+class GeminiQuotaExceeded(Exception):
+    pass
+
+class TokenBucket:
+    def __init__(self, perMinute: int):
+        self.capacity = perMinute
+        self.rate = perMinute / 60
+        self.level = perMinute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # seconds until `amount` is available
+    def waitTime(self, amount: float, now: float):
+        self.refill(now)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount: float):
+        self.level -= amount
+
+class Waiter:
+    def __init__(self, priority: int, seq: int, tokens: int, deadline: float, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.deadline = deadline
+        self.future = future
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class ModelQuota:
+    def __init__(self, model: str, rpm: int, tpm: int, maxQueue: int):
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.maxQueue = maxQueue
+        self.waiters = []
+        self.wakeup = asyncio.Event()
+        self.pumpTask = None
+
+    def waitTime(self, tokens: int, now: float):
+        return max(self.requests.waitTime(1, now), self.tokens.waitTime(tokens, now))
+
+    def take(self, tokens: int):
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+    # hands out quota to waiters in priority order, expiring the ones past their deadline
+    async def pump(self):
+        try:
+            while self.waiters:
+                now = time.monotonic()
+                for waiter in [w for w in self.waiters if w.future.done() or w.deadline <= now]:
+                    self.waiters.remove(waiter)
+                    if not waiter.future.done():
+                        waiter.future.set_exception(GeminiQuotaExceeded(f"{self.model} quota wait deadline passed"))
+                heapq.heapify(self.waiters)
+                if not self.waiters:
+                    return
+
+                head = self.waiters[0]
+                wait = self.waitTime(head.tokens, now)
+                if wait <= 0:
+                    heapq.heappop(self.waiters)
+                    self.take(head.tokens)
+                    head.future.set_result(None)
+                    continue
+
+                self.wakeup.clear()
+                timeout = min(wait, min(w.deadline for w in self.waiters) - now)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=max(timeout, 0.01))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.pumpTask = None
+
+# per-model rpm/tpm token buckets in front of generate_content.
+# a request that fits the buckets goes straight through; otherwise it queues by priority
+# until there is quota or its deadline passes. token counts are estimated up front and
+# corrected with the real usage once the response is in.
+class GeminiScheduler:
+    def __init__(self, limits: dict, maxQueue: int = 32, deadlines: dict = None):
+        self.quotas = {model: ModelQuota(model, limit['rpm'], limit['tpm'], maxQueue) for model, limit in limits.items()}
+        self.deadlines = {**DEFAULT_DEADLINES, **(deadlines or {})}
+        self.seq = itertools.count()
+
+    def quota(self, model: str):
+        return self.quotas.get(model)
+
+    async def acquire(self, model: str, tokens: int, priority: int = GeminiPriority.INTERACTIVE, deadline: float = None):
+        quota = self.quota(model)
+        if quota is None:
+            return # no limits configured for this model
+        tokens = min(tokens, quota.tokens.capacity)
+        now = time.monotonic()
+
+        if not quota.waiters and quota.waitTime(tokens, now) <= 0:
+            quota.take(tokens)
+            return
+
+        if len(quota.waiters) >= quota.maxQueue:
+            worst = max(quota.waiters)
+            if worst.priority <= priority:
+                raise GeminiQuotaExceeded(f"{model} wait queue is full")
+            # a more urgent request pushes out the least urgent one
+            quota.waiters.remove(worst)
+            heapq.heapify(quota.waiters)
+            if not worst.future.done():
+                worst.future.set_exception(GeminiQuotaExceeded(f"{model} wait queue is full"))
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = Waiter(priority, next(self.seq), tokens, now + (deadline or self.deadlines.get(priority, 60)), future)
+        heapq.heappush(quota.waiters, waiter)
+        quota.wakeup.set()
+        if quota.pumpTask is None:
+            quota.pumpTask = asyncio.create_task(quota.pump())
+
+        if len(quota.waiters) > 1 or quota.waitTime(tokens, now) > 1:
+            await klog.debug(f"GEMINI {model} QUEUED priority {priority}, {len(quota.waiters)} waiting")
+        await future
+
+    # the real usage replaces the estimate taken in acquire
+    def settle(self, model: str, estimated: int, actual: int):
+        quota = self.quota(model)
+        if quota is None or actual is None:
+            return
+        quota.tokens.take(actual - min(estimated, quota.tokens.capacity))
+
+    def stats(self, model: str):
+        quota = self.quota(model)
+        if quota is None:
+            return "unlimited"
+        now = time.monotonic()
+        quota.requests.refill(now)
+        quota.tokens.refill(now)
+        return f"{quota.requests.level:.1f}/{quota.requests.capacity} rpm, {quota.tokens.level:.0f}/{quota.tokens.capacity} tpm left, {len(quota.waiters)} waiting"
+
+    # rough input size before the request is made: ~4 chars per token, fixed cost per media file
+    @staticmethod
+    def estimateTokens(*texts, files: int = 0):
+        return sum(len(text or '') for text in texts) // 4 + files * 300 + 1
@@ -1,100 +1,296 @@
 import asyncio
+import mimetypes
 import tempfile
+import time
 
-from google import genai
-from google.genai.types import FileState
-from datetime import datetime
+from google.genai.types import FileState, File
 from kshkun_modules.logger import KshkunLogger
 from kshkun_modules.network_handler import NetworkHandler
 from kshkun_modules.database_handler import DatabaseHandler
+from kshkun_modules.gemini_client import KshkunGeminiClient
 
 nh = NetworkHandler()
 klog = KshkunLogger()
 dbh = DatabaseHandler()
 
 class SQLStrings:
-    CHECK_FILE_ID_IN_BUFFER = "SELECT genai_file_name FROM files_buffer WHERE tg_file_id = ?"
-    SAVE_GENAI_FILE_IN_BUFFER = "INSERT INTO files_buffer (tg_file_id, genai_file_name) VALUES (?, ?)"
+    CREATE_FILES_BUFFER = """CREATE TABLE IF NOT EXISTS files_buffer (
+                tg_file_id TEXT,
+                genai_file_name TEXT
+            )"""
+    FILES_BUFFER_COLUMNS = "PRAGMA table_info(files_buffer)"
+    # columns added after the first version of the table, old rows keep NULL there
+    FILES_BUFFER_NEW_COLUMNS = {
+        'uploaded_at': "ALTER TABLE files_buffer ADD COLUMN uploaded_at REAL",
+        'expires_at': "ALTER TABLE files_buffer ADD COLUMN expires_at REAL",
+        'mime_type': "ALTER TABLE files_buffer ADD COLUMN mime_type TEXT",
+        'uri': "ALTER TABLE files_buffer ADD COLUMN uri TEXT",
+    }
+    CREATE_TG_FILE_ID_INDEX = "CREATE INDEX IF NOT EXISTS files_buffer_tg_file_id ON files_buffer (tg_file_id)"
+    CHECK_FILE_IDS_IN_BUFFER = "SELECT tg_file_id, genai_file_name, expires_at, mime_type, uri FROM files_buffer WHERE tg_file_id IN ({placeholders})"
+    SAVE_GENAI_FILE_IN_BUFFER = "INSERT INTO files_buffer (tg_file_id, genai_file_name, uploaded_at, expires_at, mime_type, uri) VALUES (?, ?, ?, ?, ?, ?)"
     REMOVE_GENAI_FILE_FROM_BUFFER = "DELETE FROM files_buffer WHERE tg_file_id = ?"
+    REMOVE_EXPIRED_FILES = "DELETE FROM files_buffer WHERE expires_at < ?"
+
+class BufferedFile:
+    def __init__(self, genai_file_name: str, expires_at: float, mime_type: str, uri: str):
+        self.genaiFileName = genai_file_name
+        self.expiresAt = expires_at
+        self.mimeType = mime_type
+        self.uri = uri
+
+    # rows from before the expiry columns existed have to be checked with gemini once
+    def isFresh(self, now: float, margin: float):
+        return bool(self.expiresAt and self.uri and self.mimeType) and self.expiresAt - margin > now
+
+    def toFile(self):
+        return File(name=self.genaiFileName, uri=self.uri, mime_type=self.mimeType, state=FileState.ACTIVE)
+
+class FilePoll:
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.task = None
+
+# one poll loop per gemini file, however many requests are waiting for it.
+# polls start at 50ms and back off to 2s, so small images are seen as active almost at once
+# and long videos don't cost a files.get every second.
+class FileStateTracker:
+    polls: dict[str, FilePoll] = {}
+    pollSlots = asyncio.Semaphore(8) # files.get calls in flight across all files
+    firstDelay = 0.05
+    maxDelay = 2.0
+
+    @classmethod
+    async def pollUntilSettled(cls, client, name: str, poll: FilePoll):
+        delay = cls.firstDelay
+        try:
+            while True:
+                async with cls.pollSlots:
+                    file_object = await client.aio.files.get(name=name)
+                if file_object.state == FileState.ACTIVE:
+                    return True
+                if file_object.state == FileState.FAILED:
+                    await klog.err(f"GEMINI FILE {name} PROCESSING FAILED: {file_object.error}")
+                    return False
+
+                remaining = poll.deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay * 2, cls.maxDelay)
+        finally:
+            cls.polls.pop(name, None)
+
+    @classmethod
+    async def waitForActive(cls, client, file_object, timeout: float = 60):
+        if file_object.state == FileState.ACTIVE:
+            return True
+
+        deadline = time.monotonic() + timeout
+        poll = cls.polls.get(file_object.name)
+        if poll is None:
+            poll = cls.polls[file_object.name] = FilePoll(deadline)
+            poll.task = asyncio.create_task(cls.pollUntilSettled(client, file_object.name, poll))
+        else:
+            poll.deadline = max(poll.deadline, deadline) # a later waiter may wait longer
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(poll.task), timeout)
+        except asyncio.TimeoutError:
+            return False
 
 class KshkunGenaiFilesHandler:
-    def __init__(self, kshkunBotToken: str, geminiApiKey: str):
+    bufferReady = False
+    bufferSweeper = None
+    fileTtl = 47 * 3600  # gemini keeps files for 48h, used when the api doesn't say
+    freshMargin = 15 * 60 # a buffered file must outlive the request that uses it
+
+    def __init__(self, kshkunBotToken: str, geminiClient: KshkunGeminiClient, maxConcurrentUploads: int = 4):
         self.kshkunBotToken = kshkunBotToken
         self.filesBufferDb = "files_buffer.db"
-        self.client = genai.Client(api_key=geminiApiKey)
-        klog.log(f"Initialized KshkunGenaiFilesHandler with\n{kshkunBotToken=}\n{self.filesBufferDb=}\n{geminiApiKey=}")
+        self.uploadSlots = asyncio.Semaphore(maxConcurrentUploads)
+        self.client = geminiClient # shared with requestGemini, so uploads reuse the same connection pool
+        klog.log(f"Initialized KshkunGenaiFilesHandler with\n{kshkunBotToken=}\n{self.filesBufferDb=}")
 
-    async def checkFileIdInBuffer(self, file_id: str):
-        result, err = await dbh.checkFileIdInBuffer(self.filesBufferDb, SQLStrings.CHECK_FILE_ID_IN_BUFFER, file_id)
+    async def ensureBuffer(self):
+        if KshkunGenaiFilesHandler.bufferReady:
+            return None
+        try:
+            pool = dbh.getPool(self.filesBufferDb)
+            await pool.execute(SQLStrings.CREATE_FILES_BUFFER)
+            rows, _ = await pool.fetchAll(SQLStrings.FILES_BUFFER_COLUMNS)
+            columns = {row[1] for row in rows}
+            for column, alter in SQLStrings.FILES_BUFFER_NEW_COLUMNS.items():
+                if column not in columns:
+                    await pool.execute(alter)
+                    await klog.log(f"Added files_buffer column {column}")
+            await pool.execute(SQLStrings.CREATE_TG_FILE_ID_INDEX)
+        except Exception as e:
+            await klog.err(f"COULD NOT PREPARE FILES BUFFER: {e}")
+            return e
+        KshkunGenaiFilesHandler.bufferReady = True
+        return None
+
+    # unique id -> BufferedFile for every id found, one query for the whole album
+    async def checkFileIdsInBuffer(self, unique_ids: list):
+        unique_ids = [unique_id for unique_id in dict.fromkeys(unique_ids) if unique_id]
+        if not unique_ids:
+            return {}, None
+        err = await self.ensureBuffer()
         if err != None:
-            await klog.err(f"COULD NOT CHECK FILE ID IN BUFFER: {err}")
-        return result, err
+            return {}, err
+
+        query = SQLStrings.CHECK_FILE_IDS_IN_BUFFER.format(placeholders=', '.join('?' for _ in unique_ids))
+        try:
+            rows, _ = await dbh.getPool(self.filesBufferDb).fetchAll(query, tuple(unique_ids))
+        except Exception as e:
+            await klog.err(f"COULD NOT CHECK FILE IDS IN BUFFER: {e}")
+            return {}, e
+
+        buffered = {}
+        for tg_file_id, genai_file_name, expires_at, mime_type, uri in rows:
+            known = buffered.get(tg_file_id)
+            if known is None or (expires_at or 0) > (known.expiresAt or 0):
+                buffered[tg_file_id] = BufferedFile(genai_file_name, expires_at, mime_type, uri)
+        return buffered, None
     
-    async def saveGenaiFileInBuffer(self, file_id: str, genai_file_name: str):
-        result, err = await dbh.saveInDb(self.filesBufferDb, SQLStrings.SAVE_GENAI_FILE_IN_BUFFER, file_id, genai_file_name)
+    async def saveGenaiFileInBuffer(self, file_id: str, uploaded_file):
+        err = await self.ensureBuffer()
         if err != None:
-            await klog.err(f"COULD NOT SAVE GENAI FILE IN BUFFER: {err}")
-        return result, err
+            return None, err
+
+        now = time.time()
+        expires_at = uploaded_file.expiration_time.timestamp() if uploaded_file.expiration_time else now + self.fileTtl
+        try:
+            async with dbh.getPool(self.filesBufferDb).transaction() as conn:
+                await conn.execute(SQLStrings.REMOVE_GENAI_FILE_FROM_BUFFER, (file_id,))
+                await conn.execute(SQLStrings.SAVE_GENAI_FILE_IN_BUFFER, (file_id, uploaded_file.name, now, expires_at, uploaded_file.mime_type, uploaded_file.uri))
+        except Exception as e:
+            await klog.err(f"COULD NOT SAVE GENAI FILE IN BUFFER: {e}")
+            return None, e
+        return None, None
 
     async def removeGenaiFileFromBuffer(self, file_id: str):
         result, err = await dbh.saveInDb(self.filesBufferDb, SQLStrings.REMOVE_GENAI_FILE_FROM_BUFFER, file_id)
         if err != None:
             await klog.err(f"COULD NOT REMOVE GENAI FILE FROM BUFFER: {err}")
         return result, err
+
+    async def removeExpiredFiles(self):
+        err = await self.ensureBuffer()
+        if err != None:
+            return None, err
+        result, err = await dbh.saveInDb(self.filesBufferDb, SQLStrings.REMOVE_EXPIRED_FILES, time.time())
+        if err != None:
+            await klog.err(f"COULD NOT REMOVE EXPIRED FILES FROM BUFFER: {err}")
+        return result, err
+
+    async def runBufferSweeper(self, interval: int):
+        while True:
+            await self.removeExpiredFiles()
+            await asyncio.sleep(interval)
+
+    def startBufferSweeper(self, interval: int = 3600):
+        if KshkunGenaiFilesHandler.bufferSweeper is None or KshkunGenaiFilesHandler.bufferSweeper.done():
+            KshkunGenaiFilesHandler.bufferSweeper = asyncio.create_task(self.runBufferSweeper(interval))
+
+    def stopBufferSweeper(self):
+        if KshkunGenaiFilesHandler.bufferSweeper is not None:
+            KshkunGenaiFilesHandler.bufferSweeper.cancel()
+            KshkunGenaiFilesHandler.bufferSweeper = None
     
     async def uploadFileToGemini(self, media_data, suffix):
         with tempfile.NamedTemporaryFile(suffix=suffix) as temp_file:
             temp_file.write(media_data)
             uploaded_file = await self.client.aio.files.upload(file=temp_file.name)
-            if not await self.waitForActive(uploaded_file):
-                await klog.warn(f"FILE {uploaded_file.name} UPLOAD TIMED OUT")
+        if not await self.waitForActive(uploaded_file):
+            await klog.warn(f"FILE {uploaded_file.name} DID NOT BECOME ACTIVE, LEAVING IT OUT")
+            return None
         return uploaded_file
     
+    async def streamTgFileToGemini(self, file_id, suffix):
+        mime_type = mimetypes.guess_type(f'media{suffix}')[0] or 'application/octet-stream'
+
+        async def upload(chunks, size):
+            return await self.client.uploadStream(chunks, size, mime_type)
+
+        uploaded_file, err = await nh.streamTgFile(file_id, self.kshkunBotToken, upload)
+        if err != None:
+            return None, err
+        if not await self.waitForActive(uploaded_file):
+            await klog.warn(f"FILE {uploaded_file.name} DID NOT BECOME ACTIVE, LEAVING IT OUT")
+            return None, None
+        return uploaded_file, None
+
+    # streams telegram -> gemini; the old download + temp file route is only the fallback
+    async def uploadTgFileToGemini(self, file_id, suffix):
+        uploaded_file, err = await self.streamTgFileToGemini(file_id, suffix)
+        if err == None:
+            return uploaded_file
+        await klog.warn(f"STREAMING UPLOAD OF {file_id} FAILED ({err}), FALLING BACK TO TEMP FILE")
+
+        media_data, err = await nh.downloadTgFile(file_id, self.kshkunBotToken)
+        if err != None:
+            await klog.err(f"ERROR DOWNLOADING FILE {file_id}: {err}")
+            return None
+        return await self.uploadFileToGemini(media_data, suffix)
+
     async def waitForActive(self, file_object, timeout=60):
-        start_time = datetime.now()
-        while (datetime.now() - start_time).total_seconds() < timeout:
-            file_object = await self.client.aio.files.get(name=file_object.name)
-            if file_object.state == FileState.ACTIVE:
-                return True
-            await asyncio.sleep(1)
-        return False
+        return await FileStateTracker.waitForActive(self.client, file_object, timeout)
 
-    async def uploadMediaToGemini(self, file_ids, suffix, unique_media_ids):
-        uploaded_files = []
-        for file_id in file_ids:
-            unique_id = unique_media_ids.get(file_id)
-            genai_file_name_in_buffer, err = await self.checkFileIdInBuffer(unique_id)
-            if err != None:
-                await klog.err(f"COULD NOT CHECK FILE {unique_id} IN BUFFER: {err}")
+    async def uploadOneToGemini(self, file_id, suffix, unique_media_ids, buffered: BufferedFile = None):
+        unique_id = unique_media_ids.get(file_id)
+        if buffered is not None:
+            if buffered.isFresh(time.time(), self.freshMargin):
+                return buffered.toFile()
 
-            if genai_file_name_in_buffer:
+            if not buffered.expiresAt:
+                # legacy row without expiry, ask gemini once and keep what it says
                 try:
-                    uploaded_file = await self.client.aio.files.get(name=genai_file_name_in_buffer)
+                    uploaded_file = await self.client.aio.files.get(name=buffered.genaiFileName)
                     if await self.waitForActive(uploaded_file, 1):
-                        uploaded_files.append(uploaded_file)
                         await klog.log(f"FILE {unique_id} IS IN BUFFER, SKIPPING UPLOAD")
-                        continue
+                        await self.saveGenaiFileInBuffer(unique_id, uploaded_file)
+                        return uploaded_file
                 except Exception as e:
                     await klog.err(f"COULD NOT GET FILE {file_id} IN BUFFER FROM GEMINI: {e}; REMOVING FROM BUFFER")
-                    result, err = await self.removeGenaiFileFromBuffer(unique_id)
-                    if err != None:
-                        await klog.err(f"ERROR REMOVING FILE {unique_id} FROM BUFFER: {err}")
 
-            media_data, err = await nh.downloadTgFile(file_id, self.kshkunBotToken)
-            if err != None:
-                await klog.err(f"ERROR DOWNLOADING FILE {file_id}: {err}")
-                continue
-            
-            uploaded_file = await self.uploadFileToGemini(media_data, suffix)
-            uploaded_files.append(uploaded_file)
-            result, err = await self.saveGenaiFileInBuffer(unique_id, uploaded_file.name)
+            result, err = await self.removeGenaiFileFromBuffer(unique_id)
             if err != None:
-                await klog.err(f"ERROR SAVING FILE {unique_id} IN BUFFER: {err}")
+                await klog.err(f"ERROR REMOVING FILE {unique_id} FROM BUFFER: {err}")
+
+        # only files that became ACTIVE come back, a failed or still processing one must not be buffered
+        uploaded_file = await self.uploadTgFileToGemini(file_id, suffix)
+        if uploaded_file is None:
+            return None
+        result, err = await self.saveGenaiFileInBuffer(unique_id, uploaded_file)
+        if err != None:
+            await klog.err(f"ERROR SAVING FILE {unique_id} IN BUFFER: {err}")
+        return uploaded_file
 
-        return uploaded_files
+    async def uploadOneLimited(self, file_id, suffix, unique_media_ids, buffered: BufferedFile = None):
+        if buffered is not None and buffered.isFresh(time.time(), self.freshMargin):
+            return buffered.toFile() # no network involved, no need for an upload slot
+        async with self.uploadSlots:
+            try:
+                return await self.uploadOneToGemini(file_id, suffix, unique_media_ids, buffered)
+            except Exception as e:
+                await klog.err(f"ERROR UPLOADING FILE {file_id} TO GEMINI: {e}")
+                return None
+
+    # all files go through buffer check/download/upload at once (up to maxConcurrentUploads),
+    # results keep the input order and a failed file is just left out
+    async def uploadFilesToGemini(self, files, unique_media_ids):
+        buffered, err = await self.checkFileIdsInBuffer([unique_media_ids.get(file_id) for file_id, _ in files])
+        if err != None:
+            await klog.err(f"COULD NOT CHECK FILES IN BUFFER: {err}")
+        results = await asyncio.gather(*(self.uploadOneLimited(file_id, suffix, unique_media_ids, buffered.get(unique_media_ids.get(file_id))) for file_id, suffix in files))
+        return [uploaded_file for uploaded_file in results if uploaded_file is not None]
+
+    async def uploadMediaToGemini(self, file_ids, suffix, unique_media_ids):
+        return await self.uploadFilesToGemini([(file_id, suffix) for file_id in file_ids], unique_media_ids)
     
     async def uploadAllMediaToGemini(self, media_ids, unique_media_ids):
-        all_uploaded_files = []
         media_types = {
             'photos': (media_ids.get('photos', []), ".png"),
             'animations': (media_ids.get('animations', []), ".mp4"),
@@ -103,7 +299,5 @@ class KshkunGenaiFilesHandler:
             'audio': (media_ids.get('audio', []), ".mp3")
         }
 
-        for media_type, (media_list, extension) in media_types.items():
-            all_uploaded_files.extend(await self.uploadMediaToGemini(media_list, extension, unique_media_ids))
-
-        return all_uploaded_files
\ No newline at end of file
+        files = [(file_id, extension) for media_list, extension in media_types.values() for file_id in media_list]
+        return await self.uploadFilesToGemini(files, unique_media_ids)
@@ -6,5 +6,12 @@ from kshkun_modules.predator_handler import PredatorHandler
 from kshkun_modules.duzhocoin_handler import DuzhocoinHandler
 from kshkun_modules.menstra_handler import MenstruationHandler
 from kshkun_modules.genai_files_handler import KshkunGenaiFilesHandler
+from kshkun_modules.gemini_client import KshkunGeminiClient
+from kshkun_modules.gemini_scheduler import GeminiScheduler, GeminiPriority, GeminiQuotaExceeded
+from kshkun_modules.llm_cache import LlmResponseCache
+from kshkun_modules.prompt_templates import PromptTemplates
+from kshkun_modules.membership_handler import MembershipHandler
+from kshkun_modules.command_router import CommandRouter, CommandStage, KshkunCommand
+from kshkun_modules.worker_pool import WorkerPool, WorkerStatus
 from kshkun_modules.helper_funcs import HelperFuncs
-from kshkun_modules.logger import KshkunLogger
\ No newline at end of file
+from kshkun_modules.logger import KshkunLogger, Levels
\ No newline at end of file
@@ -0,0 +1,87 @@
+import hashlib, json, time
+from kshkun_modules.logger import KshkunLogger
+from kshkun_modules.database_handler import DatabaseHandler
+
+klog = KshkunLogger()
+dbh = DatabaseHandler()
+
+class LlmCacheSQL:
+    CREATE_TABLE = """CREATE TABLE IF NOT EXISTS llm_cache (
+        cache_key TEXT PRIMARY KEY NOT NULL,
+        model TEXT NOT NULL,
+        response TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        expires_at REAL NOT NULL,
+        last_used_at REAL NOT NULL
+    )"""
+    CREATE_LRU_INDEX = "CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used_at)"
+    LOAD = "SELECT response FROM llm_cache WHERE cache_key = ? AND expires_at >= ?"
+    TOUCH = "UPDATE llm_cache SET last_used_at = ? WHERE cache_key = ?"
+    SAVE = "INSERT OR REPLACE INTO llm_cache (cache_key, model, response, created_at, expires_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)"
+    PURGE_EXPIRED = "DELETE FROM llm_cache WHERE expires_at < ?"
+    EVICT_LRU = "DELETE FROM llm_cache WHERE cache_key IN (SELECT cache_key FROM llm_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)"
+
+# gemini text responses keyed by everything that went into the request.
+# media is keyed by telegram file_unique_id, so the same sticker/audio sent again hits the cache
+# without being downloaded or uploaded to gemini.
+class LlmResponseCache:
+    tableReady = False
+    savesSinceEviction = 0
+
+    def __init__(self, max_entries: int = 5000, evict_every: int = 50):
+        self.llmCacheDb = 'llm_cache.db'
+        self.maxEntries = max_entries
+        self.evictEvery = evict_every
+
+    def makeKey(self, model: str, sys_prompt: str, prompt: str, media_unique_ids: list, config: dict):
+        payload = json.dumps([model, sys_prompt, prompt, sorted(media_unique_ids), config], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    async def ensureTable(self):
+        if LlmResponseCache.tableReady:
+            return None
+        _, err = await dbh.saveInDb(self.llmCacheDb, LlmCacheSQL.CREATE_TABLE)
+        if err == None:
+            _, err = await dbh.saveInDb(self.llmCacheDb, LlmCacheSQL.CREATE_LRU_INDEX)
+        if err == None:
+            LlmResponseCache.tableReady = True
+            await self.evict()
+        return err
+
+    async def load(self, cache_key: str):
+        err = await self.ensureTable()
+        if err != None:
+            return None, err
+        now = time.time()
+        try:
+            row, _ = await dbh.getPool(self.llmCacheDb).fetchOne(LlmCacheSQL.LOAD, (cache_key, now))
+        except Exception as e:
+            await klog.err(f"LLM CACHE LOAD ERROR FOR {cache_key}: {e}")
+            return None, e
+
+        if not row:
+            return None, None
+        await dbh.saveInDb(self.llmCacheDb, LlmCacheSQL.TOUCH, now, cache_key)
+        return row[0], None
+
+    async def save(self, cache_key: str, model: str, response: str, ttl: int):
+        err = await self.ensureTable()
+        if err != None:
+            return None, err
+        now = time.time()
+        result, err = await dbh.saveInDb(self.llmCacheDb, LlmCacheSQL.SAVE, cache_key, model, response, now, now + ttl, now)
+
+        LlmResponseCache.savesSinceEviction += 1
+        if LlmResponseCache.savesSinceEviction >= self.evictEvery:
+            await self.evict()
+        return result, err
+
+    # drops expired rows, then the least recently used ones above maxEntries
+    async def evict(self):
+        LlmResponseCache.savesSinceEviction = 0
+        _, err = await dbh.saveInDb(self.llmCacheDb, LlmCacheSQL.PURGE_EXPIRED, time.time())
+        if err == None:
+            _, err = await dbh.saveInDb(self.llmCacheDb, LlmCacheSQL.EVICT_LRU, self.maxEntries)
+        if err != None:
+            await klog.err(f"LLM CACHE EVICTION ERROR: {err}")
+        return err
@@ -1,7 +1,8 @@
-import asyncio
+import asyncio, atexit, os, queue, sys, threading, time
 from datetime import datetime
 
 class Colors:
+    DEBUG = '\033[94m'
     INFO = '\033[92m'
     WARN = '\033[93m'
     ERR = '\033[91m'
@@ -11,44 +12,174 @@ class Formats:
     BOLD = '\033[1m'
     END = '\033[0m'
 
+class Levels:
+    DEBUG = 10
+    INFO = 20
+    WARN = 30
+    ERR = 40
+
+    @classmethod
+    def fromName(cls, name: str):
+        return getattr(cls, (name or 'INFO').upper(), cls.INFO)
+
 class _CompletedAwaitable:
     def __await__(self):
         return asyncio.sleep(0).__await__()
 
+COMPLETED = _CompletedAwaitable()
+
+# plain text copy of the log, rotated by size: kshkun.log -> kshkun.log.1 -> ... -> kshkun.log.{backups}
+class RotatingFileSink:
+    def __init__(self, path: str, max_bytes: int = 5 * 1024 * 1024, backups: int = 3):
+        self.path = path
+        self.maxBytes = max_bytes
+        self.backups = backups
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        self.file = open(self.path, 'w', encoding='utf-8')
+        self.size = 0
+
+    # max_bytes counts utf-8 bytes, cyrillic lines are about twice as long as their character count
+    def write(self, text: str):
+        size = len(text.encode('utf-8'))
+        if self.size and self.size + size > self.maxBytes:
+            self.rotate()
+        self.file.write(text)
+        self.file.flush()
+        self.size += size
+
+    def close(self):
+        self.file.close()
+
+# every KshkunLogger instance feeds one bounded queue drained by one daemon thread.
+# the caller only does a level check and a put_nowait; dates, colors and io happen in the writer.
+class LogSink:
+    queue = queue.Queue(maxsize=10000)
+    writer = None
+    writerLock = threading.Lock()
+    fileSink = None
+    fileSinkLock = threading.Lock() # configure() must not close the sink in the middle of a write
+    dropped = 0
+    droppedLock = threading.Lock()
+    batchSize = 256
+
+    @classmethod
+    def put(cls, entry: tuple):
+        cls.ensureWriter()
+        try:
+            cls.queue.put_nowait(entry)
+        except queue.Full:
+            with cls.droppedLock:
+                cls.dropped += 1
+
+    @classmethod
+    def ensureWriter(cls):
+        if cls.writer is not None:
+            return
+        with cls.writerLock:
+            if cls.writer is None:
+                cls.writer = threading.Thread(target=cls.runWriter, name='kshkun-log-writer', daemon=True)
+                cls.writer.start()
+                atexit.register(cls.drain)
+
+    @classmethod
+    def takeDropped(cls):
+        with cls.droppedLock:
+            dropped, cls.dropped = cls.dropped, 0
+        return dropped
+
+    @classmethod
+    def formatEntry(cls, entry: tuple):
+        created, color, text, cutoff = entry
+        date = datetime.fromtimestamp(created).strftime('%d.%m.%y %H:%M:%S')
+        text = text[:cutoff]
+        return f"{color}{Formats.BOLD}{date}{Formats.END} {color}{text}{Formats.END}\n", f"{date} {text}\n"
+
+    @classmethod
+    def runWriter(cls):
+        while True:
+            batch = [cls.queue.get()]
+            while len(batch) < cls.batchSize:
+                try:
+                    batch.append(cls.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            dropped = cls.takeDropped()
+            if dropped:
+                batch.append((time.time(), Colors.WARN, f"LOGGER OVERLOADED, DROPPED {dropped} LINES", None))
+
+            try:
+                console_lines, file_lines = zip(*(cls.formatEntry(entry) for entry in batch))
+                sys.stdout.write(''.join(console_lines))
+                sys.stdout.flush()
+                with cls.fileSinkLock:
+                    if cls.fileSink is not None:
+                        cls.fileSink.write(''.join(file_lines))
+            except Exception as e:
+                sys.stderr.write(f"LOG WRITER ERROR: {e}\n")
+            finally:
+                for _ in range(len(batch) - bool(dropped)):
+                    cls.queue.task_done()
+
+    @classmethod
+    def drain(cls, timeout: float = 2.0):
+        deadline = time.monotonic() + timeout
+        while cls.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
 class KshkunLogger:
+    minLevel = Levels.fromName(os.environ.get('KSHKUN_LOG_LEVEL'))
+
     def __init__(self):
         self.colors = Colors()
         self.formats = Formats()
 
-    def baseLog(self, text: str, type: str, cutoff: int):
-        if not text:
-            return
-        color = type
-        bold = self.formats.BOLD
-        end = self.formats.END
-        date = datetime.now().strftime('%d.%m.%y %H:%M:%S')
-        date_formatted = f"{color}{bold}{date}{end}"
-        text_formatted = f"{color}{text[:cutoff]}{end}"
-        print(f"{date_formatted} {text_formatted}")
+    @classmethod
+    def configure(cls, level: str = None, log_file: str = None, max_bytes: int = 5 * 1024 * 1024, backups: int = 3):
+        if level:
+            cls.minLevel = Levels.fromName(level)
+        if log_file and (LogSink.fileSink is None or LogSink.fileSink.path != log_file):
+            new_sink = RotatingFileSink(log_file, max_bytes, backups)
+            with LogSink.fileSinkLock:
+                old_sink, LogSink.fileSink = LogSink.fileSink, new_sink
+                if old_sink is not None:
+                    old_sink.close()
 
-    async def logToThread(self, text: str, type: str, cutoff: int):
-        await asyncio.to_thread(self.baseLog, text, type, cutoff)
+    def isEnabledFor(self, level: int):
+        return level >= KshkunLogger.minLevel
 
-    def log(self, text: str, cutoff:int=None):
-        return self.schedule(text, self.colors.INFO, cutoff)
+    # text can be a zero-arg callable, so expensive debug dumps are only built when the level is on
+    def schedule(self, text, level: int, color: str, cutoff: int):
+        if level < KshkunLogger.minLevel or not text:
+            return COMPLETED
+        if callable(text):
+            text = text()
+        LogSink.put((time.time(), color, str(text), cutoff))
+        return COMPLETED
 
-    def warn(self, text: str, cutoff:int=None):
-        return self.schedule(text, self.colors.WARN, cutoff)
+    def debug(self, text, cutoff: int = None):
+        return self.schedule(text, Levels.DEBUG, self.colors.DEBUG, cutoff)
 
-    def err(self, text: str, cutoff:int=None):
-        return self.schedule(text, self.colors.ERR, cutoff)
+    def log(self, text, cutoff: int = None):
+        return self.schedule(text, Levels.INFO, self.colors.INFO, cutoff)
 
-    def schedule(self, text: str, type: str, cutoff: int):
-        try:
-            asyncio.get_running_loop()
-        except RuntimeError:
-            asyncio.run(self.logToThread(text, type, cutoff))
-            return _CompletedAwaitable()
-        else:
-            asyncio.create_task(self.logToThread(text, type, cutoff))
-            return _CompletedAwaitable()
\ No newline at end of file
+    def warn(self, text, cutoff: int = None):
+        return self.schedule(text, Levels.WARN, self.colors.WARN, cutoff)
+
+    def err(self, text, cutoff: int = None):
+        return self.schedule(text, Levels.ERR, self.colors.ERR, cutoff)
+
+    def flush(self, timeout: float = 2.0):
+        LogSink.drain(timeout)
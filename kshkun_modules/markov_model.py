@@ -0,0 +1,127 @@
+import mmap, os, random, re, struct, time
+from array import array
+from bisect import bisect_right
+from collections import Counter, defaultdict
+
+END_TOKEN = '<END>'
+
+# magic, format version, item size, tokens, edges, vocab bytes, source mtime (ns), built at (unix)
+HEADER = struct.Struct('=4sHHIIIqd4x')
+MAGIC = b'KMRK'
+FORMAT_VERSION = 1
+
+def tokenize(lowered_msg: str):
+    return [t for t in re.findall(r'\b\w+\b|.', lowered_msg) if t.strip()]
+
+# successors of token t live in [offsets[t], offsets[t + 1]) of successors/cumweights,
+# cumweights is a running sum inside each token's range so a sample is one bisect
+class CompiledMarkovModel:
+    def __init__(self, vocab: list, offsets, successors, cumweights, source_mtime: int, built_at: float, mapped=None):
+        self.vocab = vocab
+        self.tokenIds = {token: token_id for token_id, token in enumerate(vocab)}
+        self.offsets = offsets
+        self.successors = successors
+        self.cumweights = cumweights
+        self.sourceMtime = source_mtime
+        self.builtAt = built_at
+        self.mapped = mapped
+        self.endId = self.tokenIds.get(END_TOKEN)
+
+    @classmethod
+    def build(cls, lowered_msgs: list, source_mtime: int):
+        vocab = [END_TOKEN]
+        token_ids = {END_TOKEN: 0}
+        transitions = defaultdict(Counter)
+        for msg in lowered_msgs:
+            ids = []
+            for token in tokenize(msg):
+                token_id = token_ids.get(token)
+                if token_id is None:
+                    token_id = token_ids[token] = len(vocab)
+                    vocab.append(token)
+                ids.append(token_id)
+            ids.append(0)
+            for current_id, next_id in zip(ids, ids[1:]):
+                transitions[current_id][next_id] += 1
+
+        offsets, successors, cumweights = array('I', [0]), array('I'), array('I')
+        for token_id in range(len(vocab)):
+            total = 0
+            for next_id, count in transitions.get(token_id, {}).items():
+                total += count
+                successors.append(next_id)
+                cumweights.append(total)
+            offsets.append(len(successors))
+
+        return cls(vocab, offsets, successors, cumweights, source_mtime, time.time())
+
+    def save(self, path: str):
+        vocab_bytes = '\0'.join(self.vocab).encode('utf-8')
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.offsets.itemsize, len(self.vocab), len(self.successors), len(vocab_bytes), self.sourceMtime, self.builtAt))
+            self.offsets.tofile(file)
+            self.successors.tofile(file)
+            self.cumweights.tofile(file)
+            file.write(vocab_bytes)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(mapped)
+        magic, version, itemsize, n_tokens, n_edges, vocab_len, source_mtime, built_at = HEADER.unpack_from(view)
+        if magic != MAGIC or version != FORMAT_VERSION or itemsize != array('I').itemsize:
+            view.release()
+            mapped.close()
+            raise ValueError(f'incompatible markov model artifact: {path}')
+
+        start = HEADER.size
+        sections = []
+        for length in (n_tokens + 1, n_edges, n_edges):
+            end = start + length * itemsize
+            sections.append(view[start:end].cast('I'))
+            start = end
+        vocab = bytes(view[start:start + vocab_len]).decode('utf-8').split('\0')
+        return cls(vocab, *sections, source_mtime, built_at, mapped=mapped)
+
+    def close(self):
+        if self.mapped is None:
+            return
+        for section in (self.offsets, self.successors, self.cumweights):
+            section.release()
+        self.mapped.close()
+        self.mapped = None
+
+    def isStale(self, source_mtime: int, max_age: float):
+        return self.sourceMtime != source_mtime or time.time() - self.builtAt > max_age
+
+    def nextToken(self, token_id: int):
+        start, end = self.offsets[token_id], self.offsets[token_id + 1]
+        if start == end:
+            return None
+        roll = random.randrange(self.cumweights[end - 1])
+        return self.successors[bisect_right(self.cumweights, roll, start, end)]
+
+    def generate(self, seed: str = '', max_steps: int = 99):
+        if not seed and len(self.vocab) < 2:
+            return None
+        start_word = seed or self.vocab[random.randrange(1, len(self.vocab))]
+        msg = [start_word]
+        token_id = self.tokenIds.get(start_word)
+        for _ in range(max_steps):
+            if token_id is None:
+                break
+            token_id = self.nextToken(token_id)
+            if token_id is None or token_id == self.endId:
+                break
+            msg.append(self.vocab[token_id])
+
+        return ' '.join(msg) + "."
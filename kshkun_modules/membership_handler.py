@@ -0,0 +1,113 @@
+import asyncio, json, os, tempfile, time
+from kshkun_modules.logger import KshkunLogger
+
+klog = KshkunLogger()
+
+# a json list of ids (banned.json, rusosvyni.json, ...) kept in memory as a set.
+# the file stays the source of truth: it is re-read when its mtime changes and
+# every write replaces it atomically, so other readers never see half a file.
+class MembershipList:
+    def __init__(self, filename: str, folder: str = 'json_files/', check_interval: float = 2.0):
+        self.filename = filename
+        self.path = folder + filename
+        self.checkInterval = check_interval
+        self.ids = []
+        self.members = set()
+        self.mtime = None
+        self.lastCheck = 0.0
+        self.writeLock = asyncio.Lock()
+        self.loadSync()
+
+    def loadSync(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, 'r') as file:
+                ids = json.load(file)
+        except FileNotFoundError:
+            mtime, ids = None, []
+        except Exception as e:
+            klog.err(f"MEMBERSHIP LOAD ERROR FOR {self.path}: {e}")
+            return
+
+        self.ids = list(dict.fromkeys(ids))
+        self.members = set(self.ids)
+        self.mtime = mtime
+        self.lastCheck = time.monotonic()
+
+    def refreshIfChanged(self):
+        now = time.monotonic()
+        if now - self.lastCheck < self.checkInterval:
+            return
+        self.lastCheck = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self.mtime:
+            klog.log(f"{self.filename} changed on disk, reloading")
+            self.loadSync()
+
+    def __contains__(self, uid):
+        self.refreshIfChanged()
+        return uid in self.members
+
+    def toList(self):
+        self.refreshIfChanged()
+        return list(self.ids)
+
+    def saveSync(self, ids: list):
+        folder = os.path.dirname(self.path) or '.'
+        fd, temp_path = tempfile.mkstemp(dir=folder, prefix=f'.{self.filename}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(ids, file, ensure_ascii=False, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+        return os.stat(self.path).st_mtime_ns
+
+    async def persist(self):
+        self.mtime = await asyncio.to_thread(self.saveSync, list(self.ids))
+
+    async def add(self, uid):
+        async with self.writeLock:
+            self.refreshIfChanged()
+            if uid in self.members:
+                return False, None
+            self.ids.append(uid)
+            self.members.add(uid)
+            try:
+                await self.persist()
+            except Exception as e:
+                await klog.err(f"MEMBERSHIP SAVE ERROR FOR {self.path}: {e}")
+                return True, e
+            return True, None
+
+    async def remove(self, uid):
+        async with self.writeLock:
+            self.refreshIfChanged()
+            if uid not in self.members:
+                return False, None
+            self.members.discard(uid)
+            self.ids = [member for member in self.ids if member != uid]
+            try:
+                await self.persist()
+            except Exception as e:
+                await klog.err(f"MEMBERSHIP SAVE ERROR FOR {self.path}: {e}")
+                return True, e
+            return True, None
+
+class MembershipHandler:
+    banned = None
+    rusosvyni = None
+    verified = None
+
+    def __init__(self):
+        if MembershipHandler.banned is None:
+            MembershipHandler.banned = MembershipList('banned.json')
+            MembershipHandler.rusosvyni = MembershipList('rusosvyni.json')
+            MembershipHandler.verified = MembershipList('verified_users.json')
+            klog.log(f"Initialized MembershipHandler: {len(self.banned.members)} banned, {len(self.rusosvyni.members)} rusosvyni, {len(self.verified.members)} verified")
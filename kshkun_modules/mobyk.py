@@ -1,61 +1,125 @@
 import face_recognition
-import pickle
 import asyncio
 import numpy as np
 from io import BytesIO
 import sys
 import json
+import os
+from kshkun_modules.encoding_store import EncodingStore
+from kshkun_modules.ann_index import IvfPqIndex
 
 class FaceComparer:
-    def __init__(self, encoding_cache_file="encodings.pkl", imgs_folder="/home/duzho/Desktop/duzhobots/face_comparer/imgs_storage/"):
-        self.encoding_cache_file = encoding_cache_file
+    def __init__(self, store_folder="bin_files/mobyk_store/", imgs_folder="/home/duzho/Desktop/duzhobots/face_comparer/imgs_storage/"):
+        self.store = EncodingStore(store_folder)
+        self.index_path = os.path.join(store_folder, 'ivfpq.npz')
+        self.index = None
+        self.index_mtime = None
         self.imgs_folder = imgs_folder
 
-    async def load_encodings(self):
+    def load_encodings(self):
         try:
-            with open(self.encoding_cache_file, "rb") as f:
-                return pickle.load(f)
+            if self.store.manifest is None:
+                self.store.load()
+            else:
+                self.store.refreshIfChanged()
         except Exception as e:
-            print(f"Error loading encodings: {e}.")
-            return {}
+            print(f"Error loading encodings: {e}.", file=sys.stderr)
+        return self.store
 
-    async def compare_faces(self, img_bytes):
+    def load_index(self):
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            self.index, self.index_mtime = None, None
+            return None
+        if mtime != self.index_mtime:
+            try:
+                self.index = IvfPqIndex.load(self.index_path)
+                self.index_mtime = mtime
+            except Exception as e:
+                print(f"Error loading ann index: {e}.", file=sys.stderr)
+                self.index = None
+        return self.index
+
+    # mode: "exact" scans every encoding, "approx" uses the ivf-pq index, "auto" uses the index when there is one
+    def search(self, store, img_encoding, top_k, mode, nprobe):
+        if mode != "exact":
+            index = self.load_index()
+            # an index from before the store rows were rewritten maps rows to the wrong ids
+            if index is not None and store.keepsRowsOf(index.storeGeneration) and len(store) >= len(index):
+                return index.search(store, img_encoding, top_k, nprobe=nprobe)
+            if mode == "approx":
+                print("No usable ann index, falling back to exact search.", file=sys.stderr)
+        return store.topK(img_encoding, top_k)
+
+    def encode_image(self, img_bytes):
+        img = face_recognition.load_image_file(BytesIO(img_bytes))
+        img_encoding = face_recognition.face_encodings(img)
+        if not img_encoding:
+            return None
+        return np.asarray(img_encoding[0], dtype=np.float32)
+
+    def compare_faces_sync(self, img_bytes, top_k=10, mode="auto", nprobe=8):
         try:
-            img = face_recognition.load_image_file(BytesIO(img_bytes))
-            img_encoding = face_recognition.face_encodings(img)
-            if not img_encoding:
+            img_encoding = self.encode_image(img_bytes)
+            if img_encoding is None:
                 return [], "No faces found in the image"
-            img_encoding = img_encoding[0]
         except Exception as e:
             return [], f"Error processing image: {e}"
 
-        encodings_cache = await self.load_encodings()
-        comparison_encodings = np.array([encoding for encoding in encodings_cache.values()])
-        image_paths_in_storage = list(encodings_cache.keys())
-
-        if not comparison_encodings.size:
+        store = self.load_encodings()
+        if not len(store):
             return [], "No encodings in the cache to compare against"
 
-        distances = face_recognition.face_distance(comparison_encodings, img_encoding)
-        results = {path: 100 * (1 - dist) for path, dist in zip(image_paths_in_storage, distances)}
-        sorted_results = sorted(results.items(), key=lambda item: item[1], reverse=True)
+        top_matches_with_scores = []
+        for msg_id, dist in self.search(store, img_encoding, top_k, mode, nprobe):
+            top_matches_with_scores.append({"path": f"{self.imgs_folder}{msg_id}.jpg", "similarity": f"{100 * (1 - dist):.2f}%"})
 
-        top_10_matches_with_scores = []
-        for path, sim in sorted_results[:10]:
-            top_10_matches_with_scores.append({"path": self.imgs_folder + path, "similarity": f"{sim:.2f}%"})
+        return top_matches_with_scores, None
 
-        return top_10_matches_with_scores, None
+    async def compare_faces(self, img_bytes):
+        return self.compare_faces_sync(img_bytes)
 
-async def main():
-    file_data = sys.stdin.buffer.read()
-    face_comparer = FaceComparer()
-    paths_with_scores, err = await face_comparer.compare_faces(file_data)
+def compare_result_json(face_comparer, img_bytes, mode="auto", nprobe=8):
+    paths_with_scores, err = face_comparer.compare_faces_sync(img_bytes, mode=mode, nprobe=nprobe)
     if err:
         result = {"error": err}
     else:
         result = {"matches": paths_with_scores}
+    return json.dumps(result, ensure_ascii=False)
 
-    print(json.dumps(result, ensure_ascii=False))
+# `python3 -m kshkun_modules.mobyk --serve`: the store is mapped once per worker and reused for every request
+def serve():
+    from kshkun_modules.worker_pool import serveForever, WorkerStatus
+    face_comparer = FaceComparer()
+    face_comparer.load_encodings()
+
+    # frames: image bytes, then optionally search mode and nprobe
+    def handle_request(frames):
+        mode = frames[1].decode() if len(frames) > 1 else "auto"
+        nprobe = int(frames[2]) if len(frames) > 2 else 8
+        return [WorkerStatus.OK, compare_result_json(face_comparer, frames[0], mode, nprobe).encode('utf-8')]
+
+    serveForever(handle_request)
+
+def convert(pkl_path, store_folder="bin_files/mobyk_store/"):
+    store, skipped = EncodingStore.fromPickle(pkl_path, store_folder)
+    print(f"Converted {pkl_path}: {len(store)} encodings in {store_folder}")
+    # the store only keeps message ids, a path without one can't be rebuilt and its encoding is dropped
+    if skipped:
+        print(f"Skipped {len(skipped)} entries without a message id filename:", file=sys.stderr)
+        for path in skipped:
+            print(f"  skipped {path}", file=sys.stderr)
+
+async def main():
+    file_data = sys.stdin.buffer.read()
+    face_comparer = FaceComparer()
+    print(compare_result_json(face_comparer, file_data))
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if '--serve' in sys.argv:
+        serve()
+    elif len(sys.argv) > 2 and sys.argv[1] == 'convert':
+        convert(*sys.argv[2:4])
+    else:
+        asyncio.run(main())
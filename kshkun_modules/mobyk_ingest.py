@@ -0,0 +1,109 @@
+import argparse, asyncio, inspect, multiprocessing, sys, time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import numpy as np
+from kshkun_modules.encoding_store import EncodingStore
+
+# runs in the encoder processes, face_recognition is only imported there
+def encodeImage(img_bytes: bytes):
+    import face_recognition
+    img = face_recognition.load_image_file(BytesIO(img_bytes))
+    encodings = face_recognition.face_encodings(img)
+    if not encodings:
+        return None
+    return np.asarray(encodings[0], dtype=np.float32)
+
+# photo messages newer than after_id that aren't in the store, oldest first
+async def listNewPhotos(client, channel, after_id: int, known_ids: set):
+    messages = []
+    async for message in client.get_chat_history(channel):
+        if message.id <= after_id:
+            break # history comes newest first, everything older was ingested already
+        if message.photo and message.id not in known_ids:
+            messages.append(message)
+    messages.reverse()
+    return messages
+
+# encodes every photo posted in `channel` after the last ingested message and appends the vectors
+# to the store. photos are encoded in chunks, but the store gets one new generation for the whole
+# run, written off the event loop. a cancelled or failed run still writes what it finished, so the
+# next run resumes from there. photos without a face only move last_ingested_id forward; a photo
+# that failed to download or encode holds it back, so the next run tries that photo again.
+async def ingestChannel(client, channel, store_folder: str = 'bin_files/mobyk_store/', workers: int = 4, chunk_size: int = 500, full: bool = False, log=print):
+    async def report(text):
+        result = log(text) # print from the cli, klog.log inside the bot
+        if inspect.isawaitable(result):
+            await result
+
+    store = await asyncio.to_thread(EncodingStore(store_folder).loadOrRefresh)
+    after_id = 0 if full else store.meta().get('last_ingested_id', 0)
+    messages = await listNewPhotos(client, channel, after_id, set(store.ids.tolist()))
+    await report(f"Mobyk ingest: {len(messages)} new photos in {channel} after message {after_id} ({len(store)} already encoded)")
+
+    loop = asyncio.get_running_loop()
+    downloads = asyncio.Semaphore(workers * 2)
+    found_ids, found_encodings = [], []
+    ingested_id = store.meta().get('last_ingested_id', 0)
+    first_failed_id = None
+    started = time.perf_counter()
+
+    async def encodeMessage(message):
+        async with downloads:
+            media = await client.download_media(message, in_memory=True)
+        return await loop.run_in_executor(pool, encodeImage, bytes(media.getbuffer()))
+
+    # spawned, not forked: the bot process runs threads (log writer, to_thread workers, pyrogram)
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        for start in range(0, len(messages), chunk_size):
+            chunk = messages[start:start + chunk_size]
+            results = await asyncio.gather(*(encodeMessage(message) for message in chunk), return_exceptions=True)
+
+            for message, result in zip(chunk, results):
+                if isinstance(result, Exception):
+                    await report(f"Mobyk ingest: message {message.id} failed: {result}")
+                    if first_failed_id is None:
+                        first_failed_id = message.id
+                elif result is not None:
+                    found_ids.append(message.id)
+                    found_encodings.append(result)
+
+            # ids grow with time, everything below the first failure has been handled
+            ingested_id = max(ingested_id, chunk[-1].id if first_failed_id is None else first_failed_id - 1)
+            await report(f"Mobyk ingest: {start + len(chunk)}/{len(messages)} photos, {len(found_ids)} faces found, {time.perf_counter() - started:.0f}s")
+    finally:
+        # a cancelled run doesn't wait for encodes nobody will collect
+        pool.shutdown(wait=False, cancel_futures=True)
+        added = 0
+        if found_ids or ingested_id != store.meta().get('last_ingested_id', 0):
+            encodings = np.array(found_encodings, dtype=np.float32).reshape(-1, 128)
+            added = await asyncio.to_thread(store.append, found_ids, encodings, {'last_ingested_id': ingested_id})
+
+    return added, len(store)
+
+async def main():
+    from pyrogram import Client
+    from kshkun_modules.data_handler import SimpleDataHandler
+
+    parser = argparse.ArgumentParser(prog='python3 -m kshkun_modules.mobyk_ingest', description='encode new mobyk channel photos into the encoding store')
+    parser.add_argument('--store', default='bin_files/mobyk_store/')
+    parser.add_argument('--workers', type=int, default=4, help='encoder processes')
+    parser.add_argument('--chunk', type=int, default=500, help='photos encoded per batch')
+    parser.add_argument('--full', action='store_true', help='rescan the whole channel, still skipping encoded ids')
+    args = parser.parse_args()
+
+    data = SimpleDataHandler().handleDataSync('init.json') or {}
+    credentials = data.get("CHECKER_ACC_CREDENTIALS", {})
+    channel = data.get("EXTRA", {}).get("mobyk_channel_username", "")
+    if not channel:
+        print("EXTRA.mobyk_channel_username is not set in init.json")
+        return 1
+
+    client = Client(name="checker", phone_number=credentials.get("pnumber", ''), api_id=credentials.get("id", ''), api_hash=credentials.get("hash", ''))
+    async with client:
+        added, total = await ingestChannel(client, channel, args.store, args.workers, args.chunk, args.full)
+    print(f"Mobyk ingest done: {added} new encodings, {total} total")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -1,35 +1,158 @@
-import aiohttp, asyncio, tempfile, re, os, yt_dlp
+import aiohttp, asyncio, multiprocessing, tempfile, re, os, yt_dlp
 from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
-from kshkun_modules.logger import KshkunLogger as klog
+from kshkun_modules.logger import KshkunLogger
+from kshkun_modules.search_cache import SearchResultsCache
 from .data_handler import SimpleDataHandler as sdhandler
 
+klog = KshkunLogger()
+
+# the download stays open while the consumer uploads it, so the session's 60s total can't apply;
+# only a stalled read or connect fails it
+TG_STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=10, sock_read=60)
+
+# runs in the parse process pool, so it has to stay a plain module-level function
+def htmlToText(html: str, max_chars: int = 3000):
+    soup = BeautifulSoup(html, 'html.parser')
+
+    for tag in soup(['script', 'style', 'footer', 'nav']):
+        tag.decompose()
+
+    for link in soup.find_all('a'):
+        link.replace_with("[LINK]")
+
+    processed_text = re.sub(r'(\[LINK]\s*)+', lambda m: f"[{len(m.group(0)) // len('[LINK]')} LINKS]", soup.get_text(separator=' '))
+    processed_text = processed_text.replace('[1 LINKS]', '[LINK]')
+    processed_text = re.sub(r'\s+', ' ', processed_text).strip()
+    return processed_text[:max_chars]
+
+class ConnectionStats:
+    def __init__(self):
+        self.requests = 0
+        self.newConnections = 0
+        self.reusedConnections = 0
+        self.dnsCacheHits = 0
+        self.dnsCacheMisses = 0
+
+    def asDict(self):
+        return {
+            'requests': self.requests,
+            'new_connections': self.newConnections,
+            'reused_connections': self.reusedConnections,
+            'dns_cache_hits': self.dnsCacheHits,
+            'dns_cache_misses': self.dnsCacheMisses,
+        }
+
 class NetworkHandler:
+    # one keep-alive session for the whole bot, shared by every NetworkHandler instance
+    session = None
+    stats = ConnectionStats()
+    parsePool = None
+    searchCache = SearchResultsCache()
+    searchesInFlight = {} # normalized query -> task, so identical queries share one fetch
+
     def __init__(self):
         pass
+
+    def createTraceConfig(self):
+        stats = NetworkHandler.stats
+        trace_config = aiohttp.TraceConfig()
+
+        async def onRequestStart(session, ctx, params):
+            stats.requests += 1
+
+        async def onConnectionCreate(session, ctx, params):
+            stats.newConnections += 1
+
+        async def onConnectionReuse(session, ctx, params):
+            stats.reusedConnections += 1
+
+        async def onDnsCacheHit(session, ctx, params):
+            stats.dnsCacheHits += 1
+
+        async def onDnsCacheMiss(session, ctx, params):
+            stats.dnsCacheMisses += 1
+
+        trace_config.on_request_start.append(onRequestStart)
+        trace_config.on_connection_create_end.append(onConnectionCreate)
+        trace_config.on_connection_reuseconn.append(onConnectionReuse)
+        trace_config.on_dns_cache_hit.append(onDnsCacheHit)
+        trace_config.on_dns_cache_miss.append(onDnsCacheMiss)
+        return trace_config
+
+    async def startSession(self):
+        if NetworkHandler.session is not None and not NetworkHandler.session.closed:
+            return NetworkHandler.session
+
+        connector = aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=10,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+            enable_cleanup_closed=True,
+        )
+        NetworkHandler.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=60, connect=10),
+            trace_configs=[self.createTraceConfig()],
+        )
+        await klog.log("Started shared aiohttp session")
+        return NetworkHandler.session
+
+    async def getSession(self):
+        if NetworkHandler.session is None or NetworkHandler.session.closed:
+            return await self.startSession()
+        return NetworkHandler.session
+
+    async def closeSession(self):
+        if NetworkHandler.session is not None and not NetworkHandler.session.closed:
+            await NetworkHandler.session.close()
+            await klog.log(f"Closed shared aiohttp session. Stats: {self.getConnectionStats()}")
+        NetworkHandler.session = None
+
+        if NetworkHandler.parsePool is not None:
+            NetworkHandler.parsePool.shutdown(wait=False, cancel_futures=True)
+            NetworkHandler.parsePool = None
+
+    # spawned, not forked: the pool is created lazily from inside the threaded bot
+    def getParsePool(self):
+        if NetworkHandler.parsePool is None:
+            NetworkHandler.parsePool = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn'))
+        return NetworkHandler.parsePool
+
+    # a crashed or oom-killed parser breaks the pool for good, the next crawl gets a fresh one
+    def resetParsePool(self, pool: ProcessPoolExecutor):
+        if NetworkHandler.parsePool is pool:
+            NetworkHandler.parsePool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def getConnectionStats(self):
+        return NetworkHandler.stats.asDict()
         
     async def aiohttpGet(self, link: str, params=None, headers=None, content_type='application/json'):
         response = None
         err = None
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(link, params=params, headers=headers) as result:
-                    result.raise_for_status()
+            session = await self.getSession()
+            async with session.get(link, params=params, headers=headers) as result:
+                result.raise_for_status()
 
-                    if content_type == 'application/json':
-                        response = await result.json()
+                if content_type == 'application/json':
+                    response = await result.json()
 
-                    elif content_type == 'text/plain':
-                        response = await result.text()
+                elif content_type == 'text/plain':
+                    response = await result.text()
 
-                    elif content_type == 'bytes':
-                        response = await result.read()
+                elif content_type == 'bytes':
+                    response = await result.read()
 
-                    else:
-                        raise ValueError(f"Unsupported content type: {content_type}")
+                else:
+                    raise ValueError(f"Unsupported content type: {content_type}")
 
         except Exception as e:
-            await klog.log(f'AIOHTTP GET ERROR: {e}', 'ERROR')
+            await klog.err(f'AIOHTTP GET ERROR: {e}')
             err = e
             return response, err
         
@@ -38,15 +161,38 @@ class NetworkHandler:
     async def downloadTgFile(self, fileId: str, botToken: str):
         response, err = await self.aiohttpGet(f"https://api.telegram.org/bot{botToken}/getFile?file_id={fileId}")
         if err != None:
-            await klog.log(f"TG GET FILE PATH ERROR: {err}", 'ERROR')
+            await klog.err(f"TG GET FILE PATH ERROR: {err}")
             return response, err
 
         path = response['result']['file_path']
         response, err = await self.aiohttpGet(f"https://api.telegram.org/file/bot{botToken}/{path}", content_type='bytes')
         if err != None:
-            await klog.log(f"TG DOWNLOAD FILE ERROR: {err}", 'ERROR')
+            await klog.err(f"TG DOWNLOAD FILE ERROR: {err}")
 
         return response, err
+
+    # hands the telegram download to consumer(chunks, size) while it is still arriving,
+    # so the file is never held in memory as a whole
+    async def streamTgFile(self, fileId: str, botToken: str, consumer):
+        response, err = await self.aiohttpGet(f"https://api.telegram.org/bot{botToken}/getFile?file_id={fileId}")
+        if err != None:
+            await klog.err(f"TG GET FILE PATH ERROR: {err}")
+            return None, err
+
+        try:
+            # ok:false from telegram has no result, that has to reach the caller as an err too
+            path = response['result']['file_path']
+            size = response['result'].get('file_size')
+            session = await self.getSession()
+            async with session.get(f"https://api.telegram.org/file/bot{botToken}/{path}", timeout=TG_STREAM_TIMEOUT) as result:
+                result.raise_for_status()
+                size = result.content_length or size
+                if not size:
+                    raise ValueError(f"unknown size of telegram file {fileId}")
+                return await consumer(result.content.iter_chunked(256 * 1024), size), None
+        except Exception as e:
+            await klog.err(f"TG STREAM FILE ERROR: {e}")
+            return None, e
     
     async def getAndSaveRusoskotData(self, period: str, date: str):
         err = None
@@ -54,10 +200,11 @@ class NetworkHandler:
         sdhand = sdhandler()
         data = await sdhand.handleData(filename)
         if not data or not data.get('data').get(date) or period == 'monthly':
-            await klog.log(f"RU_LOSSES FOR: {period}, {date}, COULD NOT GET DATA OR DATA FOR DATE", 'ERROR' if period == 'daily' else 'INFO')
+            log_func = klog.err if period == 'daily' else klog.log
+            await log_func(f"RU_LOSSES FOR: {period}, {date}, COULD NOT GET DATA OR DATA FOR DATE")
             data, err = await self.aiohttpGet(f"https://russian-casualties.in.ua/api/v1/data/json/{period}")
             if err != None:
-                await klog.log(f"RU_LOSSES ERROR: DATA FETCH ERROR: {err}", 'ERROR')
+                await klog.err(f"RU_LOSSES ERROR: DATA FETCH ERROR: {err}")
             
             if data and data.get('data').get(date):
                 await sdhand.handleData(filename, data)
@@ -71,57 +218,120 @@ class NetworkHandler:
 
         yesterdayData, legend, err1 = await self.getAndSaveRusoskotData('daily', yesterday)
         if err1 != None:
-            await klog.log(f"RU_LOSSES_DAILY ERROR: {err1}", 'ERROR')
+            await klog.err(f"RU_LOSSES_DAILY ERROR: {err1}")
 
         thisMonthData, legend, err2 = await self.getAndSaveRusoskotData('monthly', thisMonth)
         if err2 != None:
-            await klog.log(f"RU_LOSSES_MONTHLY ERROR: {err2}", 'ERROR')
+            await klog.err(f"RU_LOSSES_MONTHLY ERROR: {err2}")
 
         return yesterdayData, thisMonthData, legend, err1, err2
         
-    async def extractTextFromWebsite(self, url: str):
+    async def readCapped(self, response: aiohttp.ClientResponse, max_bytes: int):
+        chunks = []
+        total = 0
+        async for chunk in response.content.iter_chunked(16 * 1024):
+            chunks.append(chunk)
+            total += len(chunk)
+            if total >= max_bytes:
+                break # the rest of the page is never read off the socket
+        return b''.join(chunks)[:max_bytes]
+
+    async def extractTextFromWebsite(self, url: str, max_bytes: int = 256 * 1024):
         crawled_tuple = (url, '')
         err = None
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, timeout=10) as response:
-                    response.raise_for_status()
-
-                    html = await response.text()
-                    soup = BeautifulSoup(html, 'html.parser')
-
-                    for tag in soup(['script', 'style', 'footer', 'nav']):
-                        tag.decompose()
+            session = await self.getSession()
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                response.raise_for_status()
+                raw_html = await self.readCapped(response, max_bytes)
+                html = raw_html.decode(response.charset or 'utf-8', errors='replace')
 
-                    for link in soup.find_all('a'):
-                        link.replace_with("[LINK]")
-
-                    processed_text = re.sub(r'(\[LINK]\s*)+', lambda m: f"[{len(m.group(0)) // len('[LINK]')} LINKS]", soup.get_text(separator=' '))
-                    processed_text = processed_text.replace('[1 LINKS]', '[LINK]')
-                    processed_text = re.sub(r'\s+', ' ', processed_text).strip()
-                    crawled_tuple = (url, processed_text[:3000])
+            loop = asyncio.get_running_loop()
+            pool = self.getParsePool()
+            try:
+                processed_text = await loop.run_in_executor(pool, htmlToText, html)
+            except BrokenProcessPool:
+                self.resetParsePool(pool)
+                raise
+            crawled_tuple = (url, processed_text)
         except Exception as e:
-            await klog.log(f'EXTRACTING TEXT ERROR: {e}', 'ERROR')
+            await klog.err(f'EXTRACTING TEXT ERROR: {e}')
             err = e
             
         return crawled_tuple, err
-        
-    async def fetchCrawledContent(self, search_results: dict):
+
+    async def fetchCrawledContent(self, search_results: dict, max_concurrency: int = 5, deadline: float = 15):
         crawled_content = []
         err = None
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def crawl(url: str):
+            async with semaphore:
+                return await self.extractTextFromWebsite(url)
+
         try:
-            for item in search_results['items']:
-                url = item['link']
-                crawled_tuple, err = await self.extractTextFromWebsite(url)
-                if err != None:
-                    await klog.log(f'FETCH_CRAWLED_CONTENT ERROR: {err}', 'ERROR')
+            urls = [item['link'] for item in search_results.get('items', [])]
+            tasks = [asyncio.create_task(crawl(url)) for url in urls]
+            if tasks:
+                _, pending = await asyncio.wait(tasks, timeout=deadline)
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await klog.warn(f'FETCH_CRAWLED_CONTENT: {len(pending)}/{len(tasks)} PAGES MISSED THE {deadline}s DEADLINE')
+
+            for task in tasks:
+                if task.cancelled() or not task.done():
+                    continue
+                crawled_tuple, crawl_err = task.result()
+                if crawl_err != None:
+                    await klog.err(f'FETCH_CRAWLED_CONTENT ERROR: {crawl_err}') # one dead page shouldn't fail the whole search
                 crawled_content.append(crawled_tuple)
         except Exception as e:
-            await klog.log(f'FETCH_CRAWLED_CONTENT ERROR: {e}', 'ERROR')
+            await klog.err(f'FETCH_CRAWLED_CONTENT ERROR: {e}')
             err = e
 
         return crawled_content, err
     
+    async def fetchSearchResults(self, query: str, query_key: str, api_key: str, cse_id: str):
+        params = {'key': api_key, 'cx': cse_id, 'q': query}
+        google_results, err = await self.aiohttpGet("https://www.googleapis.com/customsearch/v1", params=params)
+        if err != None:
+            await klog.err(f"GOOGLE SEARCH ERROR FOR '{query}': {err}")
+            return None, None, err
+
+        crawled_content, err = await self.fetchCrawledContent(google_results)
+        if err != None:
+            await klog.err(f"CRAWL SEARCH RESULTS ERROR FOR '{query}': {err}")
+            return google_results, None, err
+
+        if google_results.get('items'):
+            _, cache_err = await self.searchCache.save(query_key, query, google_results, crawled_content)
+            if cache_err != None:
+                await klog.warn(f"COULD NOT CACHE SEARCH RESULTS FOR '{query}': {cache_err}")
+
+        return google_results, crawled_content, None
+
+    async def getSearchResults(self, query: str, api_key: str, cse_id: str):
+        query_key = self.searchCache.normalizeQuery(query)
+        cached, err = await self.searchCache.load(query_key)
+        if err != None:
+            await klog.warn(f"SEARCH CACHE UNAVAILABLE, FETCHING '{query}': {err}")
+        elif cached is not None:
+            await klog.log(f"Search cache hit: '{query_key}'")
+            google_results, crawled_content = cached
+            return google_results, crawled_content, None
+
+        task = NetworkHandler.searchesInFlight.get(query_key)
+        if task is None:
+            task = asyncio.create_task(self.fetchSearchResults(query, query_key, api_key, cse_id))
+            NetworkHandler.searchesInFlight[query_key] = task
+            task.add_done_callback(lambda _: NetworkHandler.searchesInFlight.pop(query_key, None))
+        else:
+            await klog.log(f"Joining in-flight search: '{query_key}'")
+
+        # shield so a cancelled caller doesn't cancel the fetch for everyone else waiting on it
+        return await asyncio.shield(task)
+
     async def downloadYtVideo(self, yt_link: str):
         temp_file_path = None
         err = None
@@ -154,17 +364,17 @@ class NetworkHandler:
 
                         if not os.path.exists(output_filepath) or os.path.getsize(output_filepath) == 0:
                             err = Exception(f"Downloaded file is empty or not found at {output_filepath}")
-                            await klog.log(f'YT-DLP DOWNLOAD ERROR: {err}', 'ERROR')
+                            await klog.err(f'YT-DLP DOWNLOAD ERROR: {err}')
                             return None, err
 
                         return output_filepath, None
 
                     else:
                         err = Exception("yt-dlp could not extract video information.")
-                        await klog.log(f'YT-DLP ERROR: Could not extract video info for {yt_link}', 'ERROR')
+                        await klog.err(f'YT-DLP ERROR: Could not extract video info for {yt_link}')
                         return None, err
 
         except Exception as e:
-            await klog.log(f'YT-DLP DOWNLOAD ERROR: {e}', 'ERROR')
+            await klog.err(f'YT-DLP DOWNLOAD ERROR: {e}')
             err = e
             return None, err
@@ -0,0 +1,114 @@
+import asyncio, json, os, random, time
+from array import array
+from kshkun_modules.logger import KshkunLogger
+
+klog = KshkunLogger()
+
+def trigramsOf(text: str):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# builds postings for msgs[start:], ids are global so they can be merged into an existing index
+def buildTrigramIndex(lowered: list, start: int = 0):
+    index = {}
+    for msg_id in range(start, len(lowered)):
+        for trigram in trigramsOf(lowered[msg_id]):
+            posting = index.get(trigram)
+            if posting is None:
+                index[trigram] = posting = array('I')
+            posting.append(msg_id)
+    return index
+
+# msgs.json held in memory once: original text, pre-lowered text and a trigram -> msg ids index.
+# postings are ascending, so walking the rarest one yields matches in corpus order.
+class PredatorCorpus:
+    msgs = []
+    lowered = []
+    index = {}
+    version = 0 # bumped on every change so derived structures know to rebuild
+    mtime = None
+    lastCheck = 0.0
+    lock = None
+
+    def __init__(self, path: str = 'json_files/msgs.json', check_interval: float = 5.0):
+        self.path = path
+        self.checkInterval = check_interval
+
+    def readMsgs(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path, 'r') as file:
+            return json.load(file), mtime
+
+    def buildFull(self, msgs: list):
+        lowered = [m.lower() for m in msgs]
+        return lowered, buildTrigramIndex(lowered)
+
+    async def refresh(self, forced: bool = False):
+        now = time.monotonic()
+        if not forced and PredatorCorpus.mtime is not None and now - PredatorCorpus.lastCheck < self.checkInterval:
+            return None
+        PredatorCorpus.lastCheck = now
+
+        if PredatorCorpus.lock is None:
+            PredatorCorpus.lock = asyncio.Lock()
+        async with PredatorCorpus.lock:
+            try:
+                if not forced and os.stat(self.path).st_mtime_ns == PredatorCorpus.mtime:
+                    return None
+                msgs, mtime = await asyncio.to_thread(self.readMsgs)
+            except Exception as e:
+                await klog.err(f"PREDATOR CORPUS LOAD ERROR: {e}")
+                return e
+
+            old_msgs = PredatorCorpus.msgs
+            start = time.perf_counter()
+            if old_msgs and len(msgs) >= len(old_msgs) and msgs[:len(old_msgs)] == old_msgs:
+                # appended messages only: index the tail and merge it in on the loop, so readers never see half an index
+                tail_lowered = [m.lower() for m in msgs[len(old_msgs):]]
+                tail_index = await asyncio.to_thread(buildTrigramIndex, PredatorCorpus.lowered + tail_lowered, len(old_msgs))
+                for trigram, posting in tail_index.items():
+                    if trigram in PredatorCorpus.index:
+                        PredatorCorpus.index[trigram].extend(posting)
+                    else:
+                        PredatorCorpus.index[trigram] = posting
+                PredatorCorpus.lowered.extend(tail_lowered)
+                PredatorCorpus.msgs = msgs
+                action = f"appended {len(tail_lowered)}"
+            else:
+                lowered, index = await asyncio.to_thread(self.buildFull, msgs)
+                PredatorCorpus.msgs, PredatorCorpus.lowered, PredatorCorpus.index = msgs, lowered, index
+                action = "indexed"
+
+            PredatorCorpus.mtime = mtime
+            PredatorCorpus.version += 1
+            await klog.log(f"Predator corpus {action} msgs ({len(msgs)} total, {len(PredatorCorpus.index)} trigrams) in {time.perf_counter() - start:.2f}s")
+            return None
+
+    def randomMsg(self):
+        if not PredatorCorpus.msgs:
+            return None
+        return random.choice(PredatorCorpus.msgs)
+
+    # same results as `[m for m in msgs if seed in m.lower()][:limit]`, seed must already be lowercased
+    def search(self, seed: str, limit: int = 49):
+        msgs, lowered = PredatorCorpus.msgs, PredatorCorpus.lowered
+        if not seed:
+            return []
+
+        if len(seed) < 3:
+            candidates = range(len(lowered))
+        else:
+            postings = []
+            for trigram in trigramsOf(seed):
+                posting = PredatorCorpus.index.get(trigram)
+                if posting is None:
+                    return []
+                postings.append(posting)
+            candidates = min(postings, key=len)
+
+        results = []
+        for msg_id in candidates:
+            if seed in lowered[msg_id]:
+                results.append(msgs[msg_id])
+                if len(results) >= limit:
+                    break
+        return results
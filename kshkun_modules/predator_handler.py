@@ -1,53 +1,108 @@
-import re
-import random
-from datetime import datetime, timedelta
-from collections import defaultdict, Counter
-from kshkun_modules.data_handler import SimpleDataHandler as sdhandler
+import asyncio, os, random, time
+from array import array
+from bisect import bisect_left
+from kshkun_modules.logger import KshkunLogger
+from kshkun_modules.predator_corpus import PredatorCorpus
+from kshkun_modules.markov_model import CompiledMarkovModel
+
+klog = KshkunLogger()
 
 class PredatorHandler:
+    corpus = PredatorCorpus()
+    markov = None
+    markovLock = None
+    markovPath = 'bin_files/markov_model.bin'
+    markovMaxAge = 7 * 24 * 3600
+    predatorKeywords = ['русоскот', 'русосвин', 'крокус', 'русня', 'хуйло', 'чучело']
+    keywordBuckets = {}
+    keywordBucketsVersion = -1
+
     def __init__(self):
         pass
 
-    async def getPredatorMsg(max_length:int=2000):
-        keywords = ['русоскот', 'русосвин', 'крокус', 'русня', 'хуйло', 'чучело']
-        keyword = random.choice(keywords)
-        sdh = sdhandler()
-        msgs = await sdh.handleData('msgs.json')
-        filtered_msgs = [m for m in msgs if keyword in m.lower() and len(m) < max_length]  
-        return random.choice(filtered_msgs)
-    
-    async def loadFrequencies(forced:bool=False):
-        sdh = sdhandler()
-        file = await sdh.handleData('freqs.json')
-        current_time = datetime.now()
-        if (current_time - datetime.fromtimestamp(file['timestamp']) > timedelta(days=7)) or forced:
-            f = defaultdict(Counter)
-            for m in await sdh.handleData('msgs.json'):
-                tks = []
-                for t in re.findall(r'\b\w+\b|.', m.lower()):
-                    if t.strip():
-                        tks.append(t)
-                tks.append('<END>')
-                for i in range(len(tks) - 1):
-                    f[tks[i]][tks[i + 1]] += 1
-            await sdh.handleData('freqs.json', {'timestamp': current_time.timestamp(), 'word_frequencies': {w: dict(sorted(f_freq.items(), key=lambda x: x[1], reverse=True)) for w, f_freq in f.items()}})
-        else:
-            f = defaultdict(Counter, {word: Counter(follower) for word, follower in file['word_frequencies'].items()})
-
-        return f
+    async def loadCorpus(self, forced: bool = False):
+        return await self.corpus.refresh(forced)
+
+    async def searchMsgs(self, seed: str, limit: int = 49):
+        await self.corpus.refresh()
+        return self.corpus.search(seed, limit)
+
+    async def getRandomMsg(self):
+        await self.corpus.refresh()
+        return self.corpus.randomMsg()
+
+    # keyword -> (msg lengths ascending, msg ids in the same order), rebuilt when the corpus changes
+    def buildKeywordBuckets(self):
+        buckets = {}
+        for keyword in self.predatorKeywords:
+            matches = sorted((len(PredatorCorpus.msgs[msg_id]), msg_id) for msg_id, m in enumerate(PredatorCorpus.lowered) if keyword in m)
+            buckets[keyword] = (array('I', [length for length, _ in matches]), array('I', [msg_id for _, msg_id in matches]))
+        PredatorHandler.keywordBuckets = buckets
+        PredatorHandler.keywordBucketsVersion = PredatorCorpus.version
+
+    async def getPredatorMsg(self, max_length: int = 2000):
+        await self.corpus.refresh()
+        if PredatorHandler.keywordBucketsVersion != PredatorCorpus.version:
+            self.buildKeywordBuckets()
+
+        # msgs shorter than max_length are a prefix of each bucket
+        eligible = []
+        for keyword in self.predatorKeywords:
+            lengths, msg_ids = PredatorHandler.keywordBuckets[keyword]
+            count = bisect_left(lengths, max_length)
+            if count:
+                eligible.append((msg_ids, count))
+
+        if not eligible:
+            await klog.warn(f"NO PREDATOR MSGS SHORTER THAN {max_length}, SENDING A RANDOM ONE")
+            return self.corpus.randomMsg()
+
+        msg_ids, count = random.choice(eligible)
+        return PredatorCorpus.msgs[msg_ids[random.randrange(count)]]
+
+    async def loadMarkovModel(self, forced: bool = False):
+        await self.corpus.refresh()
+        model = PredatorHandler.markov
+        if not forced and model is not None and not model.isStale(PredatorCorpus.mtime, self.markovMaxAge):
+            return None
+
+        if PredatorHandler.markovLock is None:
+            PredatorHandler.markovLock = asyncio.Lock()
+        async with PredatorHandler.markovLock:
+            source_mtime = PredatorCorpus.mtime
+            old_model = PredatorHandler.markov
+            if not forced and old_model is not None and not old_model.isStale(source_mtime, self.markovMaxAge):
+                return None # rebuilt while we were waiting for the lock
+
+            try:
+                if not forced and old_model is None and os.path.exists(self.markovPath):
+                    model = await asyncio.to_thread(CompiledMarkovModel.load, self.markovPath)
+                    if not model.isStale(source_mtime, self.markovMaxAge):
+                        PredatorHandler.markov = model
+                        await klog.log(f"Loaded markov model: {len(model.vocab)} tokens, {len(model.successors)} edges")
+                        return None
+                    model.close()
+
+                start = time.perf_counter()
+                model = await asyncio.to_thread(self.compileMarkovModel, list(PredatorCorpus.lowered), source_mtime)
+            except Exception as e:
+                await klog.err(f"MARKOV MODEL LOAD ERROR: {e}")
+                return e
+
+            PredatorHandler.markov = model
+            if old_model is not None:
+                old_model.close()
+            await klog.log(f"Compiled markov model: {len(model.vocab)} tokens, {len(model.successors)} edges in {time.perf_counter() - start:.2f}s")
+            return None
+
+    def compileMarkovModel(self, lowered_msgs: list, source_mtime: int):
+        CompiledMarkovModel.build(lowered_msgs, source_mtime).save(self.markovPath)
+        return CompiledMarkovModel.load(self.markovPath)
 
     async def generateMsg(self, seed: str):
-        word_frequencies = await self.loadFrequencies()
-        start_word = seed or random.choice(list(word_frequencies.keys()))
-        msg = [start_word]
-        current_word = start_word
-        for _ in range(random.randint(1, 100) - 1):
-            if current_word not in word_frequencies or not word_frequencies[current_word]:
-                break
-            next_words = word_frequencies[current_word]
-            current_word = random.choices(list(next_words.keys()), weights=next_words.values())[0]
-            if current_word == '<END>':
-                break
-            msg.append(current_word)
-
-        return ' '.join(msg) + "."
\ No newline at end of file
+        err = await self.loadMarkovModel()
+        if PredatorHandler.markov is None:
+            await klog.err(f"GENERATE MSG ERROR: NO MARKOV MODEL: {err}")
+            return f"{seed}."
+
+        return PredatorHandler.markov.generate(seed, max_steps=random.randint(1, 100) - 1)
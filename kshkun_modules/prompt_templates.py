@@ -0,0 +1,130 @@
+import asyncio, os, re, time
+from kshkun_modules.logger import KshkunLogger
+
+klog = KshkunLogger()
+
+# {name} placeholders and {{name}} for a literal {name} (json examples in the quiz prompt);
+# any other braces stay literal
+PLACEHOLDER = re.compile(r'\{\{(\w+)\}\}|\{(\w+)\}')
+
+# a template split once into literals and placeholder names:
+# literals[0] names[0] literals[1] names[1] ... literals[-1]
+class CompiledTemplate:
+    def __init__(self, filename: str, text: str, mtime: int):
+        self.filename = filename
+        self.mtime = mtime
+        self.lastCheck = time.monotonic()
+        self.literals, self.names = [], []
+        literal, position = [], 0
+        for match in PLACEHOLDER.finditer(text):
+            literal.append(text[position:match.start()])
+            escaped, name = match.groups()
+            if escaped:
+                literal.append('{' + escaped + '}')
+            else:
+                self.literals.append(''.join(literal))
+                self.names.append(name)
+                literal = []
+            position = match.end()
+        literal.append(text[position:])
+        self.literals.append(''.join(literal))
+        self.placeholders = frozenset(self.names)
+        self.reportedUnused = set()
+
+    # one pass, so values are never searched for placeholders themselves.
+    # a placeholder without a value is an error, it would reach gemini as literal text
+    def render(self, values: dict):
+        missing = self.placeholders - values.keys()
+        if missing:
+            raise ValueError(f"no values for placeholders {sorted(missing)} in template {self.filename}")
+        parts = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            parts.append(str(values[name]))
+            parts.append(literal)
+        return ''.join(parts)
+
+    def unusedValues(self, values: dict):
+        unused = set(values) - self.placeholders - self.reportedUnused
+        self.reportedUnused |= unused
+        return unused
+
+# txt_files/ templates compiled once and kept in memory.
+# the file mtime is checked at most every `checkInterval` seconds, edited prompts are picked up without a restart.
+# every (re)compiled template is checked against the values its call sites pass, see validate()
+class PromptTemplates:
+    templates: dict[str, CompiledTemplate] = {}
+    expectedValues: dict[str, frozenset] = {} # filename -> names its call sites pass
+    loadLock = asyncio.Lock()
+
+    def __init__(self, folder: str = 'txt_files/', check_interval: float = 5.0):
+        self.folder = folder
+        self.checkInterval = check_interval
+
+    def readTemplate(self, filename: str):
+        path = os.path.join(self.folder, filename)
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, 'r') as file:
+            return CompiledTemplate(filename, file.read(), mtime)
+
+    def isStale(self, template: CompiledTemplate):
+        now = time.monotonic()
+        if now - template.lastCheck < self.checkInterval:
+            return False
+        template.lastCheck = now
+        try:
+            return os.stat(os.path.join(self.folder, template.filename)).st_mtime_ns != template.mtime
+        except FileNotFoundError:
+            return False # keep serving the last good version
+
+    async def get(self, filename: str):
+        template = PromptTemplates.templates.get(filename)
+        if template is not None and not self.isStale(template):
+            return template, None
+
+        async with PromptTemplates.loadLock:
+            current = PromptTemplates.templates.get(filename)
+            if current is not None and current is not template:
+                return current, None # reloaded while we waited
+            try:
+                compiled = await asyncio.to_thread(self.readTemplate, filename)
+            except Exception as e:
+                await klog.err(f"COULD NOT LOAD TEMPLATE {filename}: {e}")
+                return template, e if template is None else None
+
+            PromptTemplates.templates[filename] = compiled
+            await klog.log(f"{'Reloaded' if template else 'Compiled'} template {filename}: placeholders {sorted(compiled.placeholders)}")
+            await self.checkPlaceholders(compiled)
+            return compiled, None
+
+    # placeholders no call site fills, logged when the template is loaded rather than on first use
+    async def checkPlaceholders(self, template: CompiledTemplate):
+        expected = PromptTemplates.expectedValues.get(template.filename)
+        if expected is None:
+            return set()
+        missing = template.placeholders - expected
+        if missing:
+            await klog.err(f"TEMPLATE {template.filename} HAS PLACEHOLDERS NO CALL SITE FILLS: {sorted(missing)}")
+        unused = expected - template.placeholders
+        if unused:
+            await klog.warn(f"TEMPLATE {template.filename} HAS NO PLACEHOLDERS FOR {sorted(unused)}")
+        return missing
+
+    # loads every template in `expected` ({filename: names its call sites pass}) and checks it.
+    # returns the filenames that failed to load or have unfilled placeholders
+    async def validate(self, expected: dict):
+        PromptTemplates.expectedValues.update({filename: frozenset(names) for filename, names in expected.items()})
+        broken = []
+        for filename in expected:
+            template, err = await self.get(filename)
+            if err != None or template is None:
+                broken.append(filename)
+            elif template.placeholders - PromptTemplates.expectedValues[filename]:
+                broken.append(filename)
+        return broken
+
+    async def render(self, template: CompiledTemplate, values: dict):
+        unused = template.unusedValues(values)
+        if unused:
+            await klog.warn(f"TEMPLATE {template.filename} HAS NO PLACEHOLDERS FOR {sorted(unused)}")
+        return template.render(values)
+
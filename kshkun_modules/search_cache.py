@@ -0,0 +1,71 @@
+import json, re, time
+from kshkun_modules.logger import KshkunLogger
+from kshkun_modules.database_handler import DatabaseHandler
+
+klog = KshkunLogger()
+dbh = DatabaseHandler()
+
+class SearchCacheSQL:
+    CREATE_TABLE = """CREATE TABLE IF NOT EXISTS search_cache (
+        query_key TEXT PRIMARY KEY NOT NULL,
+        query TEXT NOT NULL,
+        google_results TEXT NOT NULL,
+        crawled_content TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )"""
+    LOAD = "SELECT google_results, crawled_content FROM search_cache WHERE query_key = ? AND created_at >= ?"
+    SAVE = "INSERT OR REPLACE INTO search_cache (query_key, query, google_results, crawled_content, created_at) VALUES (?, ?, ?, ?, ?)"
+    PURGE = "DELETE FROM search_cache WHERE created_at < ?"
+
+# google cse json + crawled page text, keyed by the normalized query
+class SearchResultsCache:
+    tableReady = False
+
+    def __init__(self, ttl: int = 6 * 3600):
+        self.searchCacheDb = 'search_cache.db'
+        self.ttl = ttl
+
+    def normalizeQuery(self, query: str):
+        query = query.casefold()
+        query = re.sub(r'[^\w\s]', ' ', query)
+        return re.sub(r'\s+', ' ', query).strip()
+
+    async def ensureTable(self):
+        if SearchResultsCache.tableReady:
+            return
+        _, err = await dbh.saveInDb(self.searchCacheDb, SearchCacheSQL.CREATE_TABLE)
+        if err == None:
+            SearchResultsCache.tableReady = True
+            _, err = await dbh.saveInDb(self.searchCacheDb, SearchCacheSQL.PURGE, time.time() - self.ttl)
+        return err
+
+    async def load(self, query_key: str):
+        err = await self.ensureTable()
+        if err != None:
+            return None, err
+        try:
+            row, _ = await dbh.getPool(self.searchCacheDb).fetchOne(SearchCacheSQL.LOAD, (query_key, time.time() - self.ttl))
+        except Exception as e:
+            await klog.err(f"SEARCH CACHE LOAD ERROR FOR '{query_key}': {e}")
+            return None, e
+
+        if not row:
+            return None, None
+
+        google_results = json.loads(row[0])
+        crawled_content = [tuple(item) for item in json.loads(row[1])]
+        return (google_results, crawled_content), None
+
+    async def save(self, query_key: str, query: str, google_results: dict, crawled_content: list):
+        err = await self.ensureTable()
+        if err != None:
+            return None, err
+        return await dbh.saveInDb(
+            self.searchCacheDb,
+            SearchCacheSQL.SAVE,
+            query_key,
+            query,
+            json.dumps(google_results, ensure_ascii=False),
+            json.dumps(crawled_content, ensure_ascii=False),
+            time.time()
+        )
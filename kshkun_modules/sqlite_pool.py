@@ -0,0 +1,144 @@
+import asyncio
+import aiosqlite
+from contextlib import asynccontextmanager
+from kshkun_modules.logger import KshkunLogger
+
+klog = KshkunLogger()
+
+class PoolPragmas:
+    JOURNAL_MODE = "PRAGMA journal_mode=WAL"
+    SYNCHRONOUS = "PRAGMA synchronous=NORMAL"
+    CACHE_SIZE = "PRAGMA cache_size=-8000" # negative = KiB, ~8 MB per connection
+    TEMP_STORE = "PRAGMA temp_store=MEMORY"
+    BUSY_TIMEOUT = "PRAGMA busy_timeout=5000"
+    QUERY_ONLY = "PRAGMA query_only=ON"
+
+# one writer connection + a bounded set of reader connections per .db file.
+# WAL lets readers run next to the writer, so lookups never wait for a commit.
+class SqliteConnectionPool:
+    def __init__(self, path: str, max_readers: int = 4, cached_statements: int = 256):
+        self.path = path
+        self.maxReaders = max_readers
+        self.cachedStatements = cached_statements
+        self.writer = None
+        self.writerLock = asyncio.Lock()
+        self.readers = asyncio.Queue()
+        self.readersOpened = 0
+        self.openLock = asyncio.Lock()
+        self.closed = False
+
+    async def connect(self, read_only: bool):
+        conn = await aiosqlite.connect(self.path, cached_statements=self.cachedStatements)
+        for pragma in (PoolPragmas.JOURNAL_MODE, PoolPragmas.SYNCHRONOUS, PoolPragmas.CACHE_SIZE, PoolPragmas.TEMP_STORE, PoolPragmas.BUSY_TIMEOUT):
+            await conn.execute(pragma)
+        if read_only:
+            await conn.execute(PoolPragmas.QUERY_ONLY)
+        return conn
+
+    async def getWriter(self):
+        if self.writer is None:
+            async with self.openLock:
+                if self.writer is None:
+                    self.writer = await self.connect(read_only=False)
+                    await klog.log(f"Opened writer connection to {self.path}")
+        return self.writer
+
+    async def acquireReader(self):
+        if self.readers.empty() and self.readersOpened < self.maxReaders:
+            self.readersOpened += 1
+            try:
+                return await self.connect(read_only=True)
+            except Exception:
+                self.readersOpened -= 1
+                raise
+        return await self.readers.get()
+
+    def releaseReader(self, conn):
+        if self.closed:
+            asyncio.create_task(conn.close())
+            return
+        self.readers.put_nowait(conn)
+
+    async def execute(self, query: str, args: tuple = ()):
+        async with self.writerLock:
+            conn = await self.getWriter()
+            try:
+                await conn.execute(query, args)
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+
+    async def executemany(self, query: str, args_list: list):
+        async with self.writerLock:
+            conn = await self.getWriter()
+            try:
+                await conn.executemany(query, args_list)
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+
+    # BEGIN IMMEDIATE takes the write lock up front, so conditional updates inside see a stable snapshot
+    @asynccontextmanager
+    async def transaction(self):
+        async with self.writerLock:
+            conn = await self.getWriter()
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                await conn.rollback()
+                raise
+            else:
+                await conn.commit()
+
+    async def fetchOne(self, query: str, args: tuple = ()):
+        conn = await self.acquireReader()
+        try:
+            async with conn.execute(query, args) as cursor:
+                row = await cursor.fetchone()
+                columns = [column[0] for column in cursor.description] if cursor.description else []
+                return row, columns
+        finally:
+            self.releaseReader(conn)
+
+    async def fetchAll(self, query: str, args: tuple = ()):
+        conn = await self.acquireReader()
+        try:
+            async with conn.execute(query, args) as cursor:
+                rows = await cursor.fetchall()
+                columns = [column[0] for column in cursor.description] if cursor.description else []
+                return rows, columns
+        finally:
+            self.releaseReader(conn)
+
+    async def close(self):
+        self.closed = True
+        while not self.readers.empty():
+            conn = self.readers.get_nowait()
+            await conn.close()
+        self.readersOpened = 0
+        async with self.writerLock:
+            if self.writer is not None:
+                await self.writer.close()
+                self.writer = None
+        await klog.log(f"Closed connection pool for {self.path}")
+
+# one pool per database file, shared by every DatabaseHandler instance
+class SqlitePools:
+    pools: dict[str, SqliteConnectionPool] = {}
+
+    @classmethod
+    def get(cls, path: str):
+        pool = cls.pools.get(path)
+        if pool is None or pool.closed:
+            pool = SqliteConnectionPool(path)
+            cls.pools[path] = pool
+        return pool
+
+    @classmethod
+    async def closeAll(cls):
+        for pool in list(cls.pools.values()):
+            await pool.close()
+        cls.pools.clear()
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+
+# bounded LRU of KshkunUser objects sitting in front of user_data.
+# saves only mark users dirty; DatabaseHandler.flushUserCache writes them in one batch.
+class KshkunUserCache:
+    def __init__(self, max_users: int = 2048):
+        self.maxUsers = max_users
+        self.users = OrderedDict()
+        self.dirty = set()
+        self.evicted = {} # dirty users pushed out of the LRU before they were flushed
+        self.flushing = {} # evicted users whose batch is being written right now
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uid: int):
+        user = self.users.get(uid)
+        if user is not None:
+            self.users.move_to_end(uid)
+            self.hits += 1
+            return user
+
+        user = self.evicted.pop(uid, None) or self.flushing.get(uid)
+        if user is not None:
+            # still not written (or being written right now), so it stays dirty back in the LRU
+            self.hits += 1
+            self.insert(uid, user)
+            self.dirty.add(uid)
+            return user
+
+        self.misses += 1
+        return None
+
+    def peek(self, uid: int):
+        return self.users.get(uid) or self.evicted.get(uid) or self.flushing.get(uid)
+
+    # balances are written by the duzhocoin ledger, so this never marks the user dirty
+    def setBalance(self, uid: int, duzhocoins: int):
+        user = self.peek(uid)
+        if user is not None:
+            user.duzhocoins = duzhocoins
+
+    def put(self, user, dirty: bool):
+        uid = user.uid
+        if not dirty and (uid in self.users or uid in self.evicted):
+            return # never let a db read overwrite a newer in-memory copy
+
+        self.evicted.pop(uid, None)
+        self.insert(uid, user)
+        if dirty:
+            self.dirty.add(uid)
+
+    def insert(self, uid: int, user):
+        self.users[uid] = user
+        self.users.move_to_end(uid)
+        while len(self.users) > self.maxUsers:
+            old_uid, old_user = self.users.popitem(last=False)
+            if old_uid in self.dirty:
+                self.dirty.discard(old_uid)
+                self.evicted[old_uid] = old_user
+
+    def needsFlush(self):
+        return len(self.evicted) >= self.maxUsers // 4
+
+    def takeDirty(self):
+        users = [self.users[uid] for uid in self.dirty if uid in self.users]
+        users.extend(self.evicted.values())
+        self.flushing.update(self.evicted)
+        self.dirty.clear()
+        self.evicted.clear()
+        return users
+
+    def finishFlush(self, users: list):
+        for user in users:
+            if self.flushing.get(user.uid) is user:
+                del self.flushing[user.uid]
+
+    def restoreDirty(self, users: list):
+        self.finishFlush(users)
+        for user in users:
+            if self.users.get(user.uid) is user:
+                self.dirty.add(user.uid)
+            elif user.uid not in self.users and user.uid not in self.evicted:
+                self.evicted[user.uid] = user
+
+    def stats(self):
+        return {'size': len(self.users), 'dirty': len(self.dirty) + len(self.evicted), 'hits': self.hits, 'misses': self.misses}
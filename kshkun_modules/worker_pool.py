@@ -0,0 +1,209 @@
+import asyncio, os, struct, sys, time
+from kshkun_modules.logger import KshkunLogger
+
+klog = KshkunLogger()
+
+# one message = frame count + that many length-prefixed frames, all big-endian uint32
+FRAME_HEADER = struct.Struct('>I')
+# written once the worker's model is loaded; whatever the imports printed before it is skipped
+READY_MARKER = b'\x00KSHKUN_WORKER_READY\x00'
+
+class WorkerStatus:
+    OK = b'OK'
+    EMPTY = b'EMPTY' # handled fine, nothing to return (e.g. no faces)
+    ERR = b'ERR'
+
+def packMessage(frames: list):
+    parts = [FRAME_HEADER.pack(len(frames))]
+    for frame in frames:
+        parts.append(FRAME_HEADER.pack(len(frame)))
+        parts.append(frame)
+    return b''.join(parts)
+
+def readExactly(stream, size: int):
+    data = stream.read(size)
+    if len(data) != size:
+        raise EOFError
+    return data
+
+def readMessage(stream):
+    count, = FRAME_HEADER.unpack(readExactly(stream, FRAME_HEADER.size))
+    frames = []
+    for _ in range(count):
+        length, = FRAME_HEADER.unpack(readExactly(stream, FRAME_HEADER.size))
+        frames.append(readExactly(stream, length))
+    return frames
+
+# worker side: `python3 -m kshkun_modules.<module> --serve` loads its model once and calls
+# handler(frames) -> frames for every request until the pool closes its stdin
+def serveForever(handler):
+    # libraries love printing to stdout, so the protocol gets a private copy of fd 1 and fd 1 goes to stderr
+    sys.stdout.flush()
+    protocol_out = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    stdin = sys.stdin.buffer
+    protocol_out.write(READY_MARKER)
+    protocol_out.flush()
+
+    while True:
+        try:
+            frames = readMessage(stdin)
+        except EOFError:
+            return
+
+        try:
+            reply = handler(frames)
+        except Exception as e:
+            reply = [WorkerStatus.ERR, f'{type(e).__name__}: {e}'.encode('utf-8')]
+        protocol_out.write(packMessage(reply))
+        protocol_out.flush()
+
+class WorkerCrashed(Exception):
+    pass
+
+class WorkerProcess:
+    def __init__(self, name: str, proc: asyncio.subprocess.Process):
+        self.name = name
+        self.proc = proc
+        self.stderrTask = asyncio.create_task(self.drainStderr())
+
+    async def drainStderr(self):
+        async for line in self.proc.stderr:
+            await klog.debug(f"{self.name.upper()} WORKER {self.proc.pid}: {line.decode(errors='replace').rstrip()}")
+
+    async def waitReady(self):
+        try:
+            skipped = await self.proc.stdout.readuntil(READY_MARKER)
+        except asyncio.IncompleteReadError as e:
+            raise WorkerCrashed(f'{self.name} worker {self.proc.pid} exited before it was ready (exit code {self.proc.returncode}): {e.partial[-200:]!r}')
+        if len(skipped) > len(READY_MARKER):
+            await klog.debug(f"{self.name.upper()} WORKER {self.proc.pid} STARTUP OUTPUT: {skipped[:-len(READY_MARKER)].decode(errors='replace')}")
+
+    def alive(self):
+        return self.proc.returncode is None
+
+    async def readMessage(self):
+        stdout = self.proc.stdout
+        count, = FRAME_HEADER.unpack(await stdout.readexactly(FRAME_HEADER.size))
+        frames = []
+        for _ in range(count):
+            length, = FRAME_HEADER.unpack(await stdout.readexactly(FRAME_HEADER.size))
+            frames.append(await stdout.readexactly(length))
+        return frames
+
+    async def request(self, frames: list):
+        try:
+            self.proc.stdin.write(packMessage(frames))
+            await self.proc.stdin.drain()
+            return await self.readMessage()
+        except (asyncio.IncompleteReadError, BrokenPipeError, ConnectionResetError) as e:
+            raise WorkerCrashed(f'{self.name} worker {self.proc.pid} died (exit code {self.proc.returncode}): {e!r}')
+
+    async def close(self, timeout: float = 5):
+        if self.alive():
+            self.proc.stdin.close()
+            try:
+                await asyncio.wait_for(self.proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.proc.kill()
+                await self.proc.wait()
+        self.stderrTask.cancel()
+
+# long-lived worker processes that are spawned on demand up to `size`, replaced when they crash
+# and all shut down after `idle_timeout` seconds without requests
+class WorkerPool:
+    def __init__(self, name: str, argv: list, size: int = 1, idle_timeout: float = 300, request_timeout: float = 120):
+        self.name = name
+        self.argv = argv
+        self.size = max(1, int(size))
+        self.idleTimeout = idle_timeout
+        self.requestTimeout = request_timeout
+        self.idle = []
+        self.workers = set()
+        self.slots = asyncio.Semaphore(self.size)
+        self.lastUsed = time.monotonic()
+        self.reaper = None
+
+    async def spawn(self):
+        proc = await asyncio.create_subprocess_exec(
+            *self.argv,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=1024 * 1024
+        )
+        worker = WorkerProcess(self.name, proc)
+        self.workers.add(worker)
+        try:
+            await asyncio.wait_for(worker.waitReady(), self.requestTimeout)
+        except BaseException:
+            await self.discard(worker)
+            raise
+        await klog.log(f"Started {self.name} worker. PID: {proc.pid} ({len(self.workers)}/{self.size})")
+        return worker
+
+    async def discard(self, worker: WorkerProcess):
+        self.workers.discard(worker)
+        if worker.alive():
+            worker.proc.kill()
+        await worker.close()
+
+    async def takeWorker(self):
+        while self.idle:
+            worker = self.idle.pop()
+            if worker.alive():
+                return worker
+            await klog.warn(f"{self.name.upper()} WORKER {worker.proc.pid} EXITED WHILE IDLE ({worker.proc.returncode}), REPLACING")
+            await self.discard(worker)
+        return await self.spawn()
+
+    async def request(self, frames: list):
+        self.lastUsed = time.monotonic()
+        self.ensureReaper()
+        async with self.slots:
+            for attempt in range(2):
+                worker = await self.takeWorker()
+                try:
+                    reply = await asyncio.wait_for(worker.request(frames), self.requestTimeout)
+                except (WorkerCrashed, asyncio.TimeoutError) as e:
+                    await klog.err(f"{self.name.upper()} WORKER {worker.proc.pid} FAILED (ATTEMPT {attempt + 1}): {e!r}")
+                    await self.discard(worker)
+                    if isinstance(e, asyncio.TimeoutError) or attempt:
+                        raise
+                    continue
+                except BaseException:
+                    await self.discard(worker) # cancelled mid-request, its reply would desync the stream
+                    raise
+
+                self.idle.append(worker)
+                self.lastUsed = time.monotonic()
+                return reply
+
+    def ensureReaper(self):
+        if self.reaper is None or self.reaper.done():
+            self.reaper = asyncio.create_task(self.reapWhenIdle())
+
+    async def reapWhenIdle(self):
+        while True:
+            await asyncio.sleep(min(30, self.idleTimeout))
+            if time.monotonic() - self.lastUsed < self.idleTimeout or len(self.idle) != len(self.workers):
+                continue
+            if self.workers:
+                await klog.log(f"Stopping {len(self.workers)} {self.name} worker(s) after {self.idleTimeout}s idle")
+            await self.closeWorkers()
+            return
+
+    async def closeWorkers(self):
+        idle, self.idle = self.idle, []
+        for worker in idle:
+            self.workers.discard(worker)
+        await asyncio.gather(*(worker.close() for worker in idle), return_exceptions=True)
+
+    async def close(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+            self.reaper = None
+        await self.closeWorkers()
+        for worker in list(self.workers):
+            await self.discard(worker)